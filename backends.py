@@ -0,0 +1,158 @@
+import os
+import time
+
+import requests
+
+from outbound import threading
+
+BACKEND_MODE = os.environ.get('BACKEND_MODE', 'firebase')  # 'local': in-memory stand-ins, no credentials or network
+FIREBASE_KEY_FILE = os.environ.get('FIREBASE_KEY_FILE', '/etc/secrets/debate-center-firebase-key.json')
+LOCAL_BACKEND_LATENCY = float(os.environ.get('LOCAL_BACKEND_LATENCY', 0))  # seconds slept per local auth call
+IDENTITY_TOOLKIT_URL = os.environ.get('IDENTITY_TOOLKIT_URL', 'https://identitytoolkit.googleapis.com/v1')
+
+
+class Deferred:
+    """Stands in for the object factory() returns, which is only created on first attribute access."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+
+    def _resolve(self):
+        if self._target is None:
+            object.__setattr__(self, '_target', self._factory())
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+class IdentityToolkit:
+    """The pyrebase Auth calls the server makes, sent through an Outbound session.
+
+    pyrebase posts with the module level requests functions, so its calls would
+    bypass the pools, deadlines, retries and breaker of Outbound. The REST
+    endpoints are called directly instead, with pyrebase's payloads, return
+    values and errors (requests.HTTPError carrying the response body).
+    """
+
+    def __init__(self, api_key, session, base_url=IDENTITY_TOOLKIT_URL):
+        self.api_key = api_key
+        self.session = session
+        self.base_url = base_url
+
+    def post(self, operation, payload) -> dict:
+        response = self.session.post(f'{self.base_url}/accounts:{operation}', params={'key': self.api_key},
+                                     json=payload)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            raise requests.HTTPError(e, response.text)
+        return response.json()
+
+    def create_user_with_email_and_password(self, email, password) -> dict:
+        return self.post('signUp', {'email': email, 'password': password, 'returnSecureToken': True})
+
+    def sign_in_with_email_and_password(self, email, password) -> dict:
+        return self.post('signInWithPassword', {'email': email, 'password': password, 'returnSecureToken': True})
+
+    def get_account_info(self, id_token) -> dict:
+        return self.post('lookup', {'idToken': id_token})
+
+    def delete_user_account(self, id_token) -> dict:
+        return self.post('delete', {'idToken': id_token})
+
+
+class Backends:
+    """Auth, Firestore and Storage clients, each created on first use.
+
+    In 'firebase' mode this loads the service account key, initializes the
+    admin app and creates the Firestore and Storage clients, and
+    their imports, only when something needs them, so importing the server
+    costs none of it. In 'local' mode the stand-ins of local_backend are used
+    instead and nothing touches the network. Creation times are kept for the
+    startup report.
+    """
+
+    def __init__(self, config, outbound, mode=BACKEND_MODE):
+        if mode not in ('firebase', 'local'):
+            raise ValueError(f'unknown BACKEND_MODE {mode!r}')
+        self.config = config
+        self.outbound = outbound  # mounts the HTTP clients on its pools
+        self.mode = mode
+        self.project_id = config['projectId'] or ('debate-center-local' if mode == 'local' else None)
+        self.lock = threading.RLock()
+        self.clients = {}
+        self.timings = {}  # client -> ms it took to create
+
+    def client(self, name, create):
+        if name not in self.clients:
+            with self.lock:
+                if name not in self.clients:
+                    started = time.time()
+                    client = create()
+                    self.timings[name] = (time.time() - started) * 1000
+                    self.clients[name] = client
+                    print(f"backends: {self.mode} {name} ready in {self.timings[name]:.1f} ms")
+        return self.clients[name]
+
+    def deferred(self, name) -> Deferred:
+        return Deferred(lambda: getattr(self, name))
+
+    def collection(self, name) -> Deferred:
+        return Deferred(lambda: self.firestore.collection(name))
+
+    @property
+    def firebase_app(self):
+        def create():
+            import firebase_admin
+            from firebase_admin import credentials
+            os.environ.setdefault('GOOGLE_APPLICATION_CREDENTIALS', FIREBASE_KEY_FILE)
+            return firebase_admin.initialize_app(credentials.Certificate(FIREBASE_KEY_FILE), name='Firestore',
+                                                 options={'storageBucket': self.config['storageBucket']})
+        return self.client('firebase_app', create)
+
+    @property
+    def firestore(self):
+        def create():
+            if self.mode == 'local':
+                from local_backend import MemoryFirestore
+                return MemoryFirestore()
+            from firebase_admin import firestore
+            return firestore.client(self.firebase_app)
+        return self.client('firestore', create)
+
+    @property
+    def bucket(self):
+        def create():
+            if self.mode == 'local':
+                from local_backend import MemoryBucket
+                return MemoryBucket(self.config['storageBucket'] or 'local')
+            from firebase_admin import storage
+            bucket = storage.bucket(app=self.firebase_app)
+            self.outbound.mount(bucket.client._http)
+            return bucket
+        return self.client('bucket', create)
+
+    @property
+    def auth(self):
+        def create():
+            if self.mode == 'local':
+                from local_backend import MemoryAuth
+                return MemoryAuth(self.project_id, latency=LOCAL_BACKEND_LATENCY)
+            return IdentityToolkit(self.config['apiKey'], self.outbound.session('auth'))
+        return self.client('auth', create)
+
+    def signing_keys(self):
+        # TokenVerifier's fetch_keys
+        if self.mode == 'local':
+            return self.auth.signing_keys()
+        from tokens import fetch_google_certs
+        return fetch_google_certs(self.client('certs', lambda: self.outbound.session('certs')))
+
+    def warm(self) -> None:
+        for name in ('firestore', 'bucket', 'auth'):
+            getattr(self, name)
+
+    def metrics(self) -> dict:
+        return {'mode': self.mode, 'created_ms': dict(self.timings)}
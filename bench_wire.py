@@ -0,0 +1,62 @@
+"""Encode time and size of the busiest payloads, JSON against msgpack.
+
+Run with: python bench_wire.py
+"""
+import json
+import time
+import timeit
+
+from lobby import MAX_PAGE_SIZE
+from models import Room, User
+from room_delta import set_op
+from wire import encode
+
+
+def make_room(room_id, users=10, spectators=20) -> Room:
+    room = Room(
+        id=room_id,
+        name='aristotle philosophy debate',
+        tags=['Education', 'Politics'],
+        teams=True,
+        team_names=['Cola', 'Pepsi'],
+        room_size=users,
+        time_to_start=time.time() + 600,
+        allow_spectators=True,
+        users_list={},
+        spectators_list={},
+        moderator='user-0',
+        is_conversation=False,
+        pictureId=164336,
+        blacklist=[],
+        user_reports={},
+    )
+    photo_url = 'https://firebasestorage.googleapis.com/v0/b/debate-center-dd720.appspot.com/o/images%2Fuser.jpg'
+    for i in range(users):
+        room.add_user(f'user-{i}', User(sid=f'{i:020d}', team=bool(i % 2), photo_url=photo_url))
+        room.reports.add_target(f'user-{i}')
+    for i in range(spectators):
+        room.spectators_list[f'spectator-{i}'] = User(sid=f'{i:020x}', photo_url=photo_url)
+    return room
+
+
+def measure(name, payload, number=2000) -> None:
+    json_bytes = len(json.dumps(payload, separators=(',', ':')).encode())
+    msgpack_bytes = len(encode(payload))
+    json_us = timeit.timeit(lambda: json.dumps(payload, separators=(',', ':')), number=number) / number * 1e6
+    msgpack_us = timeit.timeit(lambda: encode(payload), number=number) / number * 1e6
+    print(f'{name:<16} json {json_bytes:>7} B {json_us:>8.1f} us   msgpack {msgpack_bytes:>7} B {msgpack_us:>8.1f} us'
+          f'   {100 * (1 - msgpack_bytes / json_bytes):>4.0f}% smaller')
+
+
+if __name__ == '__main__':
+    room = make_room('5f0c2b1e9d4a4f7c8e2b6a1d3c5e7f90')
+    measure('room snapshot', room.to_dict())
+    measure('room delta', {'roomId': room.id, 'version': 42,
+                           'ops': [set_op(['users_list', 'user-3', 'ready'], True)]})
+    lobby = [make_room(f'{i:032x}', users=4, spectators=0).to_dict() for i in range(MAX_PAGE_SIZE)]
+    measure('lobby batch', {'new': lobby[:10], 'updated': lobby[10:], 'deleted': []}, number=200)
+    candidate = {'candidate': 'candidate:842163049 1 udp 1677729535 203.0.113.7 46154 typ srflx raddr 0.0.0.0 rport 0',
+                 'sdpMid': '0', 'sdpMLineIndex': 0}
+    measure('signal batch', {'from': 'a' * 20, 'signals': [
+        {'event': 'sendingSignalAck', 'data': {'signal': {'candidate': candidate}, 'callerId': 'a' * 20,
+                                               'userId': 'user-1', 'isSpectator': False}}] * 8})
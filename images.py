@@ -0,0 +1,195 @@
+import hashlib
+import hmac
+import io
+import os
+import time
+import uuid
+from urllib.parse import quote, unquote, urlsplit
+
+import eventlet
+from cachetools import LRUCache
+from eventlet import tpool
+from eventlet.queue import LightQueue
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow images are published as uploaded
+    Image = None
+
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_THUMBNAIL_SIZE = int(os.environ.get('IMAGE_THUMBNAIL_SIZE', 256))  # pixels, square
+IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+IMAGE_PUBLISH_WORKERS = int(os.environ.get('IMAGE_PUBLISH_WORKERS', 2))
+IMAGE_TOKEN_SECRET = os.environ.get('IMAGE_TOKEN_SECRET', '').encode()  # same on every worker for stable URLs
+IMAGE_KNOWN = 10000  # content hashes remembered as published
+LEGACY_IMAGE_NAME = 'users/{}/profile _image'  # one object per user, written before images were content addressed
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def content_hash(stream, max_bytes=IMAGE_MAX_BYTES):
+    """Hash a seekable stream in chunks and rewind it, (sha256 hex, size)."""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise ImageTooLarge(f'image larger than {max_bytes} bytes')
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+
+def thumbnail(source, size=IMAGE_THUMBNAIL_SIZE, quality=IMAGE_WEBP_QUALITY):
+    """Square WebP of source cropped to its center, None if Pillow is missing or can't read it."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (size, size))  # JPEGs decode at a fraction of their size
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, 'WEBP', quality=quality, method=4)
+            return out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+class ImagePublisher:
+    """Publishes profile images to Storage in the background, under their content hash.
+
+    submit() hashes an upload where it already is (Werkzeug spools request
+    files) and returns the image's download URL right away: the object name comes from the hash
+    and the download token is derived from the name, so the URL is known before
+    anything is written. Workers then make a square WebP thumbnail (the
+    upload itself if Pillow can't) and upload it once with the token in its
+    metadata, which replaces make_public() and patch(). Images already
+    published, by anyone, aren't uploaded again. delete() removes an image
+    once no profile refers to it anymore, delete_legacy() a user's photo from
+    before content addressing.
+    """
+
+    def __init__(self, bucket, call, workers=IMAGE_PUBLISH_WORKERS, secret=IMAGE_TOKEN_SECRET):
+        self.bucket = bucket
+        self.call = call  # see outbound.direct_call
+        self.workers = workers
+        self.secret = secret or os.urandom(32)  # without a shared secret, URLs only dedup within this process
+        self.queue = LightQueue()
+        self.known = LRUCache(maxsize=IMAGE_KNOWN)  # object name -> URL, published or queued
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'published': 0, 'existing': 0, 'failed': 0,
+                      'thumbnails': 0, 'deleted': 0, 'bytes_in': 0, 'bytes_out': 0, 'publish_ms': 0.0}
+
+    def object_name(self, digest) -> str:
+        return f'images/{digest}-{IMAGE_THUMBNAIL_SIZE}'
+
+    def token(self, name) -> str:
+        return str(uuid.UUID(bytes=hmac.new(self.secret, name.encode(), hashlib.sha256).digest()[:16], version=4))
+
+    def url(self, name) -> str:
+        return 'https://firebasestorage.googleapis.com/v0/b/{}/o/{}?alt=media&token={}'.format(
+            self.bucket.name, quote(name, safe=''), self.token(name))
+
+    def name_of(self, url):
+        """Object name behind a URL made by url(), None for any other URL."""
+        parts = urlsplit(url or '')
+        if '/o/' not in parts.path:
+            return None
+        name = unquote(parts.path.rsplit('/o/', 1)[1])
+        return name if name.startswith('images/') and self.url(name) == url else None
+
+    def submit(self, stream, content_type=None) -> str:
+        """Download URL of the image in stream. Takes ownership of stream, which is closed once published."""
+        try:
+            digest, size = content_hash(stream)
+        except Exception:
+            stream.close()
+            raise
+        name = self.object_name(digest)
+        self.stats['submitted'] += 1
+        self.stats['bytes_in'] += size
+        url = self.known.get(name)
+        if url is not None:
+            stream.close()
+            self.stats['deduplicated'] += 1
+            return url
+        url = self.known[name] = self.url(name)
+        self.queue.put((name, stream, content_type))
+        return url
+
+    def delete(self, url) -> bool:
+        """Delete the image behind url, callers check that no profile uses it. False if it isn't ours."""
+        name = self.name_of(url)
+        if name is None:
+            return False
+        self.known.pop(name, None)
+        blob = self.call(self.bucket.get_blob, name)
+        if blob is not None:
+            self.call(blob.delete)
+            self.stats['deleted'] += 1
+        return True
+
+    def delete_legacy(self, username) -> bool:
+        blob = self.call(self.bucket.get_blob, LEGACY_IMAGE_NAME.format(username))
+        if blob is None:
+            return False
+        self.call(blob.delete)
+        self.stats['deleted'] += 1
+        return True
+
+    def run(self) -> None:
+        for _ in range(self.workers - 1):
+            eventlet.spawn(self.work)
+        self.work()
+
+    def work(self) -> None:
+        while True:
+            name, stream, content_type = self.queue.get()
+            started = time.time()
+            try:
+                # thumbnailing and the blocking Storage client run off the hub
+                tpool.execute(self.publish, name, stream, content_type)
+            except Exception as e:
+                self.known.pop(name, None)  # the next upload of this image tries again
+                self.stats['failed'] += 1
+                print(f"images: publishing {name} failed: {e}")
+            finally:
+                stream.close()
+                self.stats['publish_ms'] = (time.time() - started) * 1000
+
+    def publish(self, name, stream, content_type) -> None:
+        token = self.token(name)
+        existing = self.call(self.bucket.get_blob, name)
+        if existing is not None:
+            tokens = (existing.metadata or {}).get('firebaseStorageDownloadTokens', '')
+            if token not in tokens.split(','):
+                # published by a worker with another secret, our token is added next to its own
+                existing.metadata = {'firebaseStorageDownloadTokens': ','.join(filter(None, [tokens, token]))}
+                self.call(existing.patch)
+            self.stats['existing'] += 1
+            return
+        data = thumbnail(stream)
+        if data is None:
+            stream.seek(0)
+            data = stream.read()
+            content_type = content_type or 'application/octet-stream'
+        else:
+            content_type = 'image/webp'
+            self.stats['thumbnails'] += 1
+        blob = self.bucket.blob(name)
+        blob.metadata = {'firebaseStorageDownloadTokens': token}
+        blob.cache_control = 'public, max-age=31536000, immutable'  # the name changes with the content
+        self.call(blob.upload_from_string, data, content_type=content_type)
+        self.stats['published'] += 1
+        self.stats['bytes_out'] += len(data)
+
+    def metrics(self) -> dict:
+        return dict(self.stats, queued=self.queue.qsize(), pillow=Image is not None)
@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import time
+
+import eventlet
+from eventlet import tpool
+
+from models import Room
+
+ROOM_JOURNAL_DIR = os.environ.get('ROOM_JOURNAL_DIR')  # journaling is off if unset
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get('ROOM_JOURNAL_FLUSH_INTERVAL', 0.2))  # seconds
+SNAPSHOT_INTERVAL = float(os.environ.get('ROOM_SNAPSHOT_INTERVAL', 300))  # seconds
+SNAPSHOT_AFTER_RECORDS = int(os.environ.get('ROOM_SNAPSHOT_AFTER_RECORDS', 50000))  # bounds the tail to replay
+
+SNAPSHOT_FILE = re.compile(r'snapshot-(\d+)\.json$')
+JOURNAL_FILE = re.compile(r'journal-(\d+)\.log$')
+
+
+class RoomJournal:
+    """Append-only journal of room changes with periodic compacted snapshots.
+
+    record() / record_delete() only remember the room in memory. Every flush
+    interval the latest state of each changed room is appended as one JSON line
+    per room to journal-<seq>.log, from a tpool thread so the eventlet loop never
+    waits on the disk. snapshot-<seq>.json holds every room as of the start of
+    journal-<seq>.log, so recovery is the newest snapshot plus the journals after it.
+    """
+
+    def __init__(self, directory, flush_interval=JOURNAL_FLUSH_INTERVAL, snapshot_interval=SNAPSHOT_INTERVAL,
+                 snapshot_after_records=SNAPSHOT_AFTER_RECORDS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_after_records = snapshot_after_records
+        self.pending = {}  # room_id -> Room, or None if deleted
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.last_snapshot = time.time()
+        self.stats = {'records': 0, 'batches': 0, 'bytes': 0, 'snapshots': 0,
+                      'last_flush_ms': 0.0, 'last_snapshot_ms': 0.0, 'recovery_ms': 0.0, 'recovered_rooms': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, kind, seq) -> str:
+        return os.path.join(self.directory, f'{kind}-{seq}.{"json" if kind == "snapshot" else "log"}')
+
+    def files(self, pattern):
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def record(self, room) -> None:
+        self.pending[room.id] = room
+
+    def record_delete(self, room_id) -> None:
+        self.pending[room_id] = None
+
+    def recover(self):
+        """Rebuild room_id -> Room from the newest snapshot and the journal tail."""
+        started = time.time()
+        rooms = {}
+        snapshots = self.files(SNAPSHOT_FILE)
+        if snapshots:
+            self.seq, snapshot_path = snapshots[-1]
+            with open(snapshot_path) as f:
+                for data in json.load(f)['rooms']:
+                    rooms[data['id']] = data
+        for seq, journal_path in self.files(JOURNAL_FILE):
+            if seq < self.seq:
+                continue
+            self.seq = seq
+            with open(journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn write at crash time, nothing after it was acknowledged
+                    if 'put' in record:
+                        rooms[record['put']['id']] = record['put']
+                    else:
+                        rooms.pop(record['del'], None)
+        # append to a fresh journal, the last one may end with a torn line
+        self.seq += 1
+        recovered = {room_id: Room.from_dict(data) for room_id, data in rooms.items()}
+        self.stats['recovery_ms'] = (time.time() - started) * 1000
+        self.stats['recovered_rooms'] = len(recovered)
+        print(f"journal: recovered {len(recovered)} rooms from {self.directory} in {self.stats['recovery_ms']:.1f} ms")
+        return recovered
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        started = time.time()
+        pending, self.pending = self.pending, {}
+        records = [{'put': room.snapshot()} if room is not None else {'del': room_id}
+                   for room_id, room in pending.items()]
+        try:
+            written = tpool.execute(append_records, self.path('journal', self.seq), records)
+        except Exception:
+            # keep the batch for the next flush, unless the room changed again meanwhile
+            for room_id, room in pending.items():
+                self.pending.setdefault(room_id, room)
+            raise
+        self.records_since_snapshot += len(records)
+        self.stats['records'] += len(records)
+        self.stats['batches'] += 1
+        self.stats['bytes'] += written
+        self.stats['last_flush_ms'] = (time.time() - started) * 1000
+
+    def snapshot(self, rooms) -> None:
+        """Compact: write every room to a new snapshot and start a new journal after it."""
+        self.flush()
+        started = time.time()
+        self.seq += 1
+        self.records_since_snapshot = 0
+        self.last_snapshot = started
+        # the room snapshots are built on the loop so they match this instant, writing happens in a thread
+        data = [room.snapshot() for room in rooms.values()]
+        tpool.execute(write_snapshot, self.directory, self.path('snapshot', self.seq), data, self.seq,
+                      self.files(SNAPSHOT_FILE) + self.files(JOURNAL_FILE))
+        self.stats['snapshots'] += 1
+        self.stats['last_snapshot_ms'] = (time.time() - started) * 1000
+
+    def run(self, rooms) -> None:
+        while True:
+            eventlet.sleep(self.flush_interval)
+            try:
+                if (time.time() - self.last_snapshot >= self.snapshot_interval
+                        or self.records_since_snapshot >= self.snapshot_after_records):
+                    self.snapshot(rooms)
+                else:
+                    self.flush()
+            except Exception as e:
+                print(f"journal: write failed: {e}")
+
+    def metrics(self) -> dict:
+        return dict(self.stats, pending=len(self.pending), seq=self.seq)
+
+
+def append_records(path, records) -> int:
+    data = ''.join(json.dumps(record) + '\n' for record in records)
+    with open(path, 'a') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+
+def write_snapshot(directory, path, rooms, seq, old_files) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'seq': seq, 'rooms': rooms}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # the new snapshot covers everything older, only now is it safe to drop
+    for old_seq, old_path in old_files:
+        if old_seq < seq:
+            os.remove(old_path)
@@ -0,0 +1,9 @@
+def percentile_ms(ordered, q) -> float:
+    """q-quantile of sorted samples in seconds, as milliseconds, 0.0 without samples."""
+    if not ordered:
+        return 0.0
+    return 1000 * ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def mean_ms(samples) -> float:
+    return 1000 * sum(samples) / len(samples) if samples else 0.0
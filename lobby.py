@@ -0,0 +1,219 @@
+import bisect
+import os
+
+import eventlet
+
+MAX_PAGE_SIZE = 50
+LOBBY_FLUSH_INTERVAL = float(os.environ.get('LOBBY_FLUSH_INTERVAL', 0.25))  # seconds
+LOBBY_TOPIC = 'lobby'
+
+
+class InvalidQuery(ValueError):
+    """A lobby query with a malformed filter, limit or cursor."""
+
+
+def lobby_topic(tag=None) -> str:
+    # name of the Socket.IO room lobby viewers join, optionally narrowed to a single tag
+    return LOBBY_TOPIC if tag is None else f'{LOBBY_TOPIC}:tag:{tag}'
+
+
+class LobbyIndex:
+    """Secondary indexes over the rooms for paginated lobby queries.
+
+    Every index is a list of (time_to_start, room_id) kept sorted, one for all
+    rooms, one per tag and one per teams / allow_spectators value. A page is a
+    bisect to the cursor followed by a walk over the most selective index, so it
+    costs about the page size instead of the number of rooms.
+    """
+
+    def __init__(self):
+        self.indexes = {}  # index key -> sorted list of (time_to_start, room_id)
+        self.room_entries = {}  # room_id -> (entry, index keys) to remove a room without looking it up
+
+    @staticmethod
+    def index_keys(room):
+        keys = [('all',), ('teams', bool(room.teams)), ('spectators', bool(room.allow_spectators))]
+        keys += [('tag', tag) for tag in room.tags or []]
+        return keys
+
+    def add(self, room) -> None:
+        if room.id in self.room_entries:
+            self.remove(room.id)
+        entry = (room.time_to_start, room.id)
+        keys = self.index_keys(room)
+        for key in keys:
+            bisect.insort(self.indexes.setdefault(key, []), entry)
+        self.room_entries[room.id] = (entry, keys)
+
+    def remove(self, room_id) -> None:
+        if room_id not in self.room_entries:
+            return
+        entry, keys = self.room_entries.pop(room_id)
+        for key in keys:
+            index = self.indexes[key]
+            position = bisect.bisect_left(index, entry)
+            if position < len(index) and index[position] == entry:
+                index.pop(position)
+            if not index:
+                self.indexes.pop(key)
+
+    def update(self, room) -> None:
+        # only needed when an indexed field (tags, teams, allow_spectators, time_to_start) changes
+        self.add(room)
+
+    def query(self, rooms, tag=None, teams=None, allow_spectators=None, not_full=False, cursor=None, limit=20):
+        """Return (rooms page sorted by time_to_start, next cursor or None)."""
+        limit = page_limit(limit)
+        candidates = query_indexes(tag, teams, allow_spectators)
+        index = min((self.indexes.get(key, []) for key in candidates), key=len)
+
+        start = 0
+        if cursor:
+            start = bisect.bisect_right(index, decode_cursor(cursor))
+
+        page = []
+        for position in range(start, len(index)):
+            room = rooms.get(index[position][1])
+            if room is None:
+                continue
+            if tag is not None and tag not in (room.tags or []):
+                continue
+            if teams is not None and bool(room.teams) != bool(teams):
+                continue
+            if allow_spectators is not None and bool(room.allow_spectators) != bool(allow_spectators):
+                continue
+            if not_full and len(room.users_list) >= room.room_size:
+                continue
+            page.append(room)
+            if len(page) == limit:
+                next_cursor = encode_cursor(index[position]) if position + 1 < len(index) else None
+                return page, next_cursor
+        return page, None
+
+
+def encode_cursor(entry) -> str:
+    time_to_start, room_id = entry
+    return f'{time_to_start!r}:{room_id}'
+
+
+def decode_cursor(cursor):
+    if not isinstance(cursor, str):
+        raise InvalidQuery('cursor must be a string')
+    time_to_start, _, room_id = cursor.partition(':')
+    try:
+        return float(time_to_start), room_id
+    except ValueError:
+        raise InvalidQuery(f'malformed cursor {cursor!r}')
+
+
+def page_limit(limit) -> int:
+    try:
+        return max(1, min(int(limit), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise InvalidQuery(f'malformed limit {limit!r}')
+
+
+class LobbyBroadcaster:
+    """Coalesces rooms_new / rooms_updated / rooms_deleted into one lobby_changes frame.
+
+    Changes are buffered per room for flush_interval seconds, a later change to the
+    same room replaces the earlier one, and the room snapshot is taken at flush time.
+    Frames only go to subscribed lobby topics: everything to the lobby topic and the
+    matching subset to each subscribed tag topic. When shared, subscribers may sit on
+    other workers, so every topic of a changed room gets its frame.
+    """
+
+    def __init__(self, emit, flush_interval=LOBBY_FLUSH_INTERVAL, shared=False, on_flush=None):
+        self.emit = emit  # emit(event, payload, topic)
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.on_flush = on_flush  # on_flush(changed rooms, deleted room ids), before anything is emitted
+        self.pending = {}  # room_id -> ('new' | 'updated' | 'deleted', room)
+        self.flush_scheduled = False
+        self.subscribers = {}  # topic -> set of sids
+        self.topics_by_sid = {}  # sid -> set of topics
+        self.stats = {'changes': 0, 'frames': 0, 'topic_frames': 0}
+
+    def subscribe(self, sid, topic) -> None:
+        self.subscribers.setdefault(topic, set()).add(sid)
+        self.topics_by_sid.setdefault(sid, set()).add(topic)
+
+    def unsubscribe(self, sid, topic=None):
+        """Drop one topic, or every topic when topic is None. Returns the dropped topics."""
+        topics = self.topics_by_sid.get(sid, set())
+        dropped = set(topics) if topic is None else topics & {topic}
+        for dropped_topic in dropped:
+            topics.discard(dropped_topic)
+            sids = self.subscribers[dropped_topic]
+            sids.discard(sid)
+            if not sids:
+                self.subscribers.pop(dropped_topic)
+        if not topics:
+            self.topics_by_sid.pop(sid, None)
+        return dropped
+
+    def room_new(self, room) -> None:
+        self.queue(room, 'new')
+
+    def room_updated(self, room) -> None:
+        kind, _ = self.pending.get(room.id, ('updated', None))
+        # a room created in this window is still new to the lobby
+        self.queue(room, 'new' if kind == 'new' else 'updated')
+
+    def room_deleted(self, room) -> None:
+        kind, _ = self.pending.get(room.id, ('updated', None))
+        if kind == 'new':
+            # created and deleted in the same window, the lobby never has to know
+            self.pending.pop(room.id)
+            self.stats['changes'] += 1
+            return
+        self.queue(room, 'deleted')
+
+    def queue(self, room, kind) -> None:
+        self.pending[room.id] = (kind, room)
+        self.stats['changes'] += 1
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            eventlet.spawn_after(self.flush_interval, self.flush)
+
+    def flush(self) -> None:
+        self.flush_scheduled = False
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.stats['frames'] += 1
+        if self.on_flush is not None:
+            self.on_flush([room for kind, room in pending.values() if kind != 'deleted'],
+                          [room_id for room_id, (kind, _) in pending.items() if kind == 'deleted'])
+        if not self.subscribers and not self.shared:
+            return
+        frames = {}  # topic -> changes
+        for room_id, (kind, room) in pending.items():
+            entry = room_id if kind == 'deleted' else room.snapshot()
+            for topic in [LOBBY_TOPIC] + [lobby_topic(tag) for tag in room.tags or []]:
+                if self.shared or topic in self.subscribers:
+                    changes = frames.setdefault(topic, {'new': [], 'updated': [], 'deleted': []})
+                    changes[kind].append(entry)
+        for topic, changes in frames.items():
+            self.emit('lobby_changes', changes, topic)
+            self.stats['topic_frames'] += 1
+
+    def metrics(self) -> dict:
+        # every change used to be its own broadcast frame
+        return dict(self.stats, frames_saved=self.stats['changes'] - self.stats['frames'],
+                    pending=len(self.pending), subscribers=len(self.topics_by_sid))
+
+
+def query_indexes(tag, teams, allow_spectators):
+    """Index keys a query can walk, the filters come straight from the client."""
+    if tag is not None and not isinstance(tag, str):
+        raise InvalidQuery(f'tag must be a string, not {tag!r}')
+    candidates = [('all',)]
+    if tag is not None:
+        candidates.append(('tag', tag))
+    for name, key, value in (('teams', 'teams', teams), ('allow_spectators', 'spectators', allow_spectators)):
+        if value is not None:
+            if not isinstance(value, bool):
+                raise InvalidQuery(f'{name} must be true or false, not {value!r}')
+            candidates.append((key, value))
+    return candidates
@@ -0,0 +1,266 @@
+"""In-memory stand-ins for the Firebase services the server uses, for local runs and benchmarks."""
+import copy
+import hashlib
+import itertools
+import operator
+import time
+import uuid
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+MISSING = object()
+# Firestore's where() operators. a document without the field matches none of them, not even '!='
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, options: value in options,
+    'not-in': lambda value, options: value not in options,
+    'array-contains': lambda value, item: isinstance(value, list) and item in value,
+    'array-contains-any': lambda value, items: isinstance(value, list) and any(item in value for item in items),
+}
+
+
+def field_value(data, path):
+    # a dotted path reaches into maps, as in Firestore
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return MISSING
+        data = data[part]
+    return data
+
+
+def satisfies(value, op, expected) -> bool:
+    if value is MISSING:
+        return False
+    try:
+        return OPERATORS[op](value, expected)
+    except TypeError:
+        return False  # Firestore only compares values of the same type
+
+
+class MemoryDocumentSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        if self._data is None:
+            return None
+        value = field_value(self._data, field)
+        if value is MISSING:
+            raise KeyError(field)
+        return copy.deepcopy(value)
+
+
+class MemoryDocument:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self, timeout=None) -> MemoryDocumentSnapshot:
+        return MemoryDocumentSnapshot(self.id, self.collection.docs.get(self.id))
+
+    def set(self, data, merge=False, timeout=None) -> None:
+        current = self.collection.docs.get(self.id) if merge else None
+        self.collection.docs[self.id] = dict(current or {}, **copy.deepcopy(data))
+
+    def create(self, data, timeout=None) -> None:
+        if self.id in self.collection.docs:
+            raise AlreadyExists(f'Document already exists: {self.collection.name}/{self.id}')
+        self.collection.docs[self.id] = copy.deepcopy(data)
+
+    def update(self, fields, timeout=None) -> None:
+        if self.id not in self.collection.docs:
+            raise NotFound(f'No document to update: {self.collection.name}/{self.id}')
+        for path, value in copy.deepcopy(fields).items():
+            *parents, name = path.split('.')
+            data = self.collection.docs[self.id]
+            for part in parents:
+                if not isinstance(data.get(part), dict):
+                    data[part] = {}
+                data = data[part]
+            data[name] = value
+
+    def delete(self, timeout=None) -> None:
+        self.collection.docs.pop(self.id, None)
+
+
+class MemoryQuery:
+    def __init__(self, collection, filters=(), limit=None):
+        self.collection = collection
+        self.filters = list(filters)
+        self.limit_count = limit
+
+    def where(self, field, op, value) -> 'MemoryQuery':
+        if op not in OPERATORS:
+            # what the Firestore client raises for an unknown operator
+            raise ValueError(f'Operator string {op!r} is invalid. Valid choices are: {", ".join(OPERATORS)}.')
+        return MemoryQuery(self.collection, self.filters + [(field, op, value)], self.limit_count)
+
+    def select(self, field_paths) -> 'MemoryQuery':
+        # every field comes back, callers only read the selected ones
+        return self
+
+    def limit(self, count) -> 'MemoryQuery':
+        return MemoryQuery(self.collection, self.filters, count)
+
+    def stream(self, timeout=None):
+        matches = (MemoryDocumentSnapshot(doc_id, data) for doc_id, data in list(self.collection.docs.items())
+                   if all(satisfies(field_value(data, field), op, value) for field, op, value in self.filters))
+        return itertools.islice(matches, self.limit_count)
+
+
+class MemoryCollection(MemoryQuery):
+    def __init__(self, name):
+        super().__init__(self)
+        self.name = name
+        self.docs = {}  # doc_id -> data
+
+    def document(self, doc_id) -> MemoryDocument:
+        return MemoryDocument(self, doc_id)
+
+
+class MemoryFirestore:
+    """The subset of firestore.Client that server.py uses."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def collection(self, name) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def get_all(self, references, timeout=None):
+        for reference in references:
+            yield reference.get()
+
+
+class MemoryAuth:
+    """backends.IdentityToolkit with accounts kept in memory.
+
+    Issued ID tokens are real RS256 JWTs signed with a key generated at startup,
+    so they pass tokens.TokenVerifier when it is given signing_keys. latency
+    (seconds) is slept in every call to mimic the round trip to Google. clock
+    dates the tokens and decides when they expire.
+    """
+
+    def __init__(self, project_id, latency=0.0, clock=time.time):
+        self.project_id = project_id
+        self.latency = latency
+        self.clock = clock
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.accounts = {}  # email -> {'localId', 'password'}
+        self.emails = {}  # localId -> email
+
+    def signing_keys(self):
+        # same shape as tokens.fetch_google_certs
+        return {'local': self.key.public_key()}, 3600
+
+    def issue(self, email) -> dict:
+        now = int(self.clock())
+        user_id = self.accounts[email]['localId']
+        token = jwt.encode({'iss': f'https://securetoken.google.com/{self.project_id}', 'aud': self.project_id,
+                            'sub': user_id, 'user_id': user_id, 'email': email, 'auth_time': now, 'iat': now,
+                            'exp': now + 3600, 'firebase': {'sign_in_provider': 'password'}},
+                           self.key, algorithm='RS256', headers={'kid': 'local'})
+        return {'idToken': token, 'refreshToken': uuid.uuid4().hex, 'localId': user_id, 'email': email,
+                'expiresIn': '3600'}
+
+    def account_of(self, token) -> str:
+        claims = jwt.decode(token, self.key.public_key(), algorithms=['RS256'], audience=self.project_id,
+                            options={'verify_exp': False, 'verify_iat': False})
+        if claims['exp'] <= self.clock():
+            raise ValueError('TOKEN_EXPIRED')
+        if claims['sub'] not in self.emails:
+            raise ValueError('USER_NOT_FOUND')
+        return claims['sub']
+
+    @staticmethod
+    def hash_password(password) -> str:
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    def create_user_with_email_and_password(self, email, password) -> dict:
+        time.sleep(self.latency)
+        if email in self.accounts:
+            raise ValueError('EMAIL_EXISTS')
+        user_id = uuid.uuid4().hex[:28]
+        self.accounts[email] = {'localId': user_id, 'password': self.hash_password(password)}
+        self.emails[user_id] = email
+        return self.issue(email)
+
+    def sign_in_with_email_and_password(self, email, password) -> dict:
+        time.sleep(self.latency)
+        account = self.accounts.get(email)
+        if account is None or account['password'] != self.hash_password(password):
+            raise ValueError('INVALID_LOGIN_CREDENTIALS')
+        return self.issue(email)
+
+    def get_account_info(self, token) -> dict:
+        time.sleep(self.latency)
+        user_id = self.account_of(token)
+        return {'users': [{'localId': user_id, 'email': self.emails[user_id],
+                           'providerUserInfo': [{'providerId': 'password'}]}]}
+
+    def delete_user_account(self, token) -> None:
+        time.sleep(self.latency)
+        user_id = self.account_of(token)
+        self.accounts.pop(self.emails.pop(user_id))
+
+
+class MemoryBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.cache_control = None
+        self.content_type = None
+        self.data = b''
+
+    @property
+    def public_url(self) -> str:
+        return f'memory://{self.bucket.name}/{self.name}'
+
+    def upload_from_string(self, data, content_type=None, timeout=None) -> None:
+        self.data = data.encode() if isinstance(data, str) else bytes(data)
+        self.content_type = content_type
+        self.bucket.blobs[self.name] = self
+
+    def upload_from_file(self, file, content_type=None, timeout=None) -> None:
+        self.upload_from_string(file.read(), content_type=content_type)
+
+    def make_public(self, timeout=None) -> None:
+        pass
+
+    def patch(self, timeout=None, **kwargs) -> None:
+        pass
+
+    def delete(self, timeout=None) -> None:
+        self.bucket.blobs.pop(self.name, None)
+
+
+class MemoryBucket:
+    """The subset of a google.cloud.storage Bucket that server.py uses."""
+
+    def __init__(self, name):
+        self.name = name
+        self.blobs = {}  # name -> MemoryBlob, uploaded ones only
+
+    def blob(self, name) -> MemoryBlob:
+        return MemoryBlob(self, name)
+
+    def get_blob(self, name, timeout=None):
+        return self.blobs.get(name)
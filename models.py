@@ -1,28 +1,176 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from typing import Optional, List, Dict
-@dataclass
+from reports import ReportTally
+
+
 class User:
-    sid: str
-    ready: bool = False
-    team: bool = False
-    camera_ready: bool = False
-    photo_url: Optional[str] = None
+    __slots__ = ('sid', 'ready', 'team', 'camera_ready', 'photo_url')
+
+    def __init__(self, sid: str, ready: bool = False, team: bool = False,
+                 camera_ready: bool = False, photo_url: Optional[str] = None):
+        self.sid = sid
+        self.ready = ready
+        self.team = team
+        self.camera_ready = camera_ready
+        self.photo_url = photo_url
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'User':
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return {'sid': self.sid, 'ready': self.ready, 'team': self.team,
+                'camera_ready': self.camera_ready, 'photo_url': self.photo_url}
+
 
-@dataclass
 class Room:
-    id: str
-    name: str
-    tags: List[str]
-    teams: bool
-    team_names: List[str]
-    room_size: int
-    time_to_start: float
-    allow_spectators: bool
-    users_list: Dict[str, User]
-    spectators_list: Dict[str, User]
-    moderator: Optional[str]
-    is_conversation: bool
-    pictureId: Optional[int]
-    user_reports: Dict[str, List[str]]
-    blacklist: List[str]
-    disconnected: List[str] = field(default_factory=list)
\ No newline at end of file
+    """A debate room.
+
+    users_list (the debaters) must be changed through add_user / pop_user / set_team /
+    set_ready so the team and ready counters stay in sync. It is an insertion ordered
+    dict, so the longest present debater is always first.
+    The wire format is snapshot(), the same dict dataclasses.asdict used to produce.
+    """
+    __slots__ = ('id', 'name', 'tags', 'teams', 'team_names', 'room_size', 'time_to_start',
+                 'allow_spectators', 'users_list', 'spectators_list', 'moderator', 'is_conversation',
+                 'pictureId', 'reports', 'disconnected', 'version',
+                 'team_counts', 'ready_count', '_snapshot', '_snapshot_version')
+
+    def __init__(self, id: str, name: str, tags: List[str], teams: bool, team_names: List[str],
+                 room_size: int, time_to_start: float, allow_spectators: bool,
+                 users_list: Dict[str, User], spectators_list: Dict[str, User],
+                 moderator: Optional[str], is_conversation: bool, pictureId: Optional[int],
+                 user_reports: Dict[str, List[str]], blacklist: List[str],
+                 disconnected: Optional[List[str]] = None, version: int = 0):
+        self.id = id
+        self.name = name
+        self.tags = tags
+        self.teams = teams
+        self.team_names = team_names
+        self.room_size = room_size
+        self.time_to_start = time_to_start
+        self.allow_spectators = allow_spectators
+        self.users_list = {}
+        self.spectators_list = spectators_list
+        self.moderator = moderator
+        self.is_conversation = is_conversation
+        self.pictureId = pictureId
+        self.reports = ReportTally(user_reports, blacklist)  # user_reports and blacklist on the wire
+        self.disconnected = disconnected if disconnected is not None else []
+        self.version = version  # bumped on every mutation, see emit_room_delta
+        self.team_counts = [0, 0]  # debaters per team, indexed by User.team
+        self.ready_count = 0
+        self._snapshot = None
+        self._snapshot_version = -1
+        for user_id, user in users_list.items():
+            self.add_user(user_id, user)
+
+    def add_user(self, user_id: str, user: User) -> None:
+        self.users_list[user_id] = user
+        self.team_counts[user.team] += 1
+        self.ready_count += user.ready
+
+    def pop_user(self, user_id: str) -> User:
+        user = self.users_list.pop(user_id)
+        self.team_counts[user.team] -= 1
+        self.ready_count -= user.ready
+        return user
+
+    def disconnect_all(self) -> None:
+        # nobody is connected after a restart: debaters of a conversation may come back
+        # through disconnected, everyone else has left
+        for user_id in list(self.users_list):
+            self.pop_user(user_id)
+            if self.is_conversation and user_id not in self.disconnected:
+                self.disconnected.append(user_id)
+        self.spectators_list.clear()
+        self.touch()
+
+    def set_team(self, user_id: str, team: bool) -> None:
+        user = self.users_list[user_id]
+        self.team_counts[user.team] -= 1
+        self.team_counts[team] += 1
+        user.team = team
+
+    def set_ready(self, user_id: str, ready: bool) -> None:
+        user = self.users_list[user_id]
+        self.ready_count += ready - user.ready
+        user.ready = ready
+
+    def first_user(self) -> Optional[str]:
+        return next(iter(self.users_list), None)
+
+    def first_spectator(self) -> Optional[str]:
+        return next(iter(self.spectators_list), None)
+
+    def majority(self) -> int:
+        # number of reports needed to blacklist a debater
+        return len(self.users_list) // 2 + 1
+
+    def is_full(self) -> bool:
+        return len(self.users_list) >= self.room_size
+
+    def touch(self) -> None:
+        self.version += 1
+
+    def snapshot(self) -> dict:
+        # serialized room, rebuilt at most once per version.
+        # the returned dict is shared between emits and must not be mutated
+        if self._snapshot_version != self.version:
+            self._snapshot = self.to_dict()
+            self._snapshot_version = self.version
+        return self._snapshot
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'tags': list(self.tags) if self.tags is not None else None,
+            'teams': self.teams,
+            'team_names': list(self.team_names) if self.team_names is not None else None,
+            'room_size': self.room_size,
+            'time_to_start': self.time_to_start,
+            'allow_spectators': self.allow_spectators,
+            'users_list': {user_id: user.to_dict() for user_id, user in self.users_list.items()},
+            'spectators_list': {user_id: user.to_dict() for user_id, user in self.spectators_list.items()},
+            'moderator': self.moderator,
+            'is_conversation': self.is_conversation,
+            'pictureId': self.pictureId,
+            'user_reports': self.reports.user_reports(),
+            'blacklist': list(self.reports.blacklist),
+            'disconnected': list(self.disconnected),
+            'version': self.version,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Room':
+        # inverse of to_dict, the dict is reused as the snapshot of its version
+        room = cls(
+            id=data['id'],
+            name=data['name'],
+            tags=data['tags'],
+            teams=data['teams'],
+            team_names=data['team_names'],
+            room_size=data['room_size'],
+            time_to_start=data['time_to_start'],
+            allow_spectators=data['allow_spectators'],
+            users_list={user_id: User.from_dict(user) for user_id, user in data['users_list'].items()},
+            spectators_list={user_id: User.from_dict(user) for user_id, user in data['spectators_list'].items()},
+            moderator=data['moderator'],
+            is_conversation=data['is_conversation'],
+            pictureId=data['pictureId'],
+            user_reports=data['user_reports'],
+            blacklist=data['blacklist'],
+            disconnected=list(data.get('disconnected', [])),
+            version=data.get('version', 0),
+        )
+        room._snapshot = data
+        room._snapshot_version = room.version
+        return room
+
+
+@dataclass
+class Presence:
+    room_id: str
+    role: str  # 'debater', 'spectator' or 'disconnected'
+    sid: Optional[str]
@@ -0,0 +1,232 @@
+import os
+import random
+import time
+from collections import deque
+
+import eventlet
+import requests
+from eventlet.patcher import original
+from requests.adapters import HTTPAdapter
+
+from latency import percentile_ms
+
+# real locks and sleeps, whether or not the process is monkey patched. the clients are called from the
+# hub and from tpool / pipeline threads, so every module that shares state with them locks with these
+threading = original('threading')
+blocking_sleep = original('time').sleep
+
+OUTBOUND_POOL_SIZE = int(os.environ.get('OUTBOUND_POOL_SIZE', 20))  # keep-alive connections per host
+OUTBOUND_TIMEOUT = float(os.environ.get('OUTBOUND_TIMEOUT', 10))  # seconds, deadline of one call
+OUTBOUND_RETRIES = int(os.environ.get('OUTBOUND_RETRIES', 2))
+BREAKER_FAILURES = int(os.environ.get('OUTBOUND_BREAKER_FAILURES', 5))  # consecutive failures that open the circuit
+BREAKER_RESET = float(os.environ.get('OUTBOUND_BREAKER_RESET', 30))  # seconds before a trial call is let through
+BACKOFF_BASE = 0.1  # seconds
+BACKOFF_CAP = 2.0
+LATENCY_SAMPLES = 1000
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+UNSENT_STATUSES = {429, 503}  # the server refused the request, safe to retry even a POST
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+class CircuitOpen(Exception):
+    """Too many recent failures of a service, calls fail fast until it gets a trial call through."""
+
+
+class RetryableResponse(Exception):
+    def __init__(self, response):
+        super().__init__(f'HTTP {response.status_code}')
+        self.response = response
+
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET, clock=time.monotonic):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.clock = clock
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.trial else 'open'
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.trial and self.clock() - self.opened_at >= self.reset_after:
+            self.trial = True  # exactly one call finds out if the service is back
+            return True
+        return False
+
+    def record(self, ok) -> None:
+        if ok:
+            self.consecutive = 0
+            self.opened_at = None
+        else:
+            self.consecutive += 1
+            if self.trial or self.consecutive >= self.failures:
+                self.opened_at = self.clock()
+        self.trial = False
+
+
+def is_failure(error) -> bool:
+    # transport errors and server side errors count against a service, client errors (404, 409, ...) don't
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, RetryableResponse, CircuitOpen)):
+        return True
+    code = getattr(error, 'code', None)  # google.api_core exceptions carry their HTTP status
+    return isinstance(code, int) and (code >= 500 or code == 429)
+
+
+def pause(seconds) -> None:
+    if threading.current_thread() is threading.main_thread():
+        eventlet.sleep(seconds)
+    else:
+        blocking_sleep(seconds)
+
+
+def direct_call(fn, *args, **kwargs):
+    """The call runner of clients used without Outbound.
+
+    ProfileCache, UsernameIndex and ImagePublisher take a call(fn,
+    *args, **kwargs) that runs each of their backend calls. The server passes
+    Outbound.call bound to a service, tests and tools this.
+    """
+    return fn(*args, **kwargs)
+
+
+class Outbound:
+    """The one client layer for calls to Firebase and Google.
+
+    call(service, fn, ...) gives any client call a deadline (as its timeout
+    argument), a per-service circuit breaker, retries with full-jitter backoff
+    and latency metrics. session(service) is a requests.Session on bounded
+    keep-alive pools that sends every request through call(). Google's own
+    clients (Firestore, Storage) already retry with backoff, so their calls are
+    not retried here.
+    """
+
+    def __init__(self, pool_size=OUTBOUND_POOL_SIZE, timeout=OUTBOUND_TIMEOUT, retries=OUTBOUND_RETRIES):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.breakers = {}  # service -> CircuitBreaker
+        self.stats = {}  # service -> counters
+        self.latency = {}  # service -> recent durations in seconds
+        self.sessions = []
+
+    def service(self, service):
+        with self.lock:
+            if service not in self.breakers:
+                self.breakers[service] = CircuitBreaker()
+                self.stats[service] = {'calls': 0, 'errors': 0, 'retries': 0, 'rejected': 0,
+                                       'in_flight': 0, 'max_in_flight': 0}
+                self.latency[service] = deque(maxlen=LATENCY_SAMPLES)
+            return self.breakers[service], self.stats[service]
+
+    def call(self, service, fn, *args, retries=0, retryable=is_failure, **kwargs):
+        breaker, stats = self.service(service)
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            with self.lock:
+                if not breaker.allow():
+                    stats['rejected'] += 1
+                    raise CircuitOpen(service)
+                stats['calls'] += 1
+                stats['in_flight'] += 1
+                stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+            started = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                with self.lock:
+                    stats['errors'] += 1
+                    breaker.record(not is_failure(e))
+                if attempt >= retries or not retryable(e):
+                    raise
+                attempt += 1
+                with self.lock:
+                    stats['retries'] += 1
+                pause(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+                continue
+            else:
+                with self.lock:
+                    breaker.record(True)
+                return result
+            finally:
+                with self.lock:
+                    stats['in_flight'] -= 1
+                    self.latency[service].append(time.time() - started)
+
+    def mount(self, session) -> None:
+        # bounded keep-alive pool per host, callers wait for a free connection instead of opening more
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.sessions.append(session)
+
+    def session(self, service) -> 'OutboundSession':
+        return OutboundSession(self, service)
+
+    def pools(self) -> dict:
+        # per host: connections opened so far and kept-alive ones waiting in the pool (empty slots are None)
+        occupancy = {}
+        for session in self.sessions:
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    idle = sum(conn is not None for conn in list(pool.pool.queue)) if pool.pool else 0
+                    occupancy[f'{key.key_scheme}://{key.key_host}'] = {
+                        'opened': pool.num_connections, 'idle': idle, 'size': self.pool_size}
+        return occupancy
+
+    def metrics(self) -> dict:
+        services = {}
+        with self.lock:
+            for service, stats in self.stats.items():
+                ordered = sorted(self.latency[service])
+                services[service] = dict(
+                    stats,
+                    breaker=self.breakers[service].state,
+                    p50_ms=percentile_ms(ordered, 0.5),
+                    p99_ms=percentile_ms(ordered, 0.99),
+                )
+        return {'services': services, 'pools': self.pools()}
+
+
+class OutboundSession(requests.Session):
+    """requests.Session for one service, every request goes through Outbound.call."""
+
+    def __init__(self, outbound, service):
+        super().__init__()
+        self.outbound = outbound
+        self.service = service
+        outbound.mount(self)
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+
+        def retryable(error):
+            if isinstance(error, RetryableResponse):
+                return method in IDEMPOTENT_METHODS or error.response.status_code in UNSENT_STATUSES
+            if isinstance(error, requests.ConnectTimeout):
+                return True  # never reached the server
+            return method in IDEMPOTENT_METHODS and isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+        try:
+            return self.outbound.call(self.service, self.send_once, method, url, retries=self.outbound.retries,
+                                      retryable=retryable, **kwargs)
+        except RetryableResponse as e:
+            # out of retries, hand the error response to the caller as requests would
+            return e.response
+
+    def send_once(self, method, url, **kwargs):
+        response = super().request(method, url, **kwargs)
+        if response.status_code in RETRY_STATUSES:
+            raise RetryableResponse(response)
+        return response
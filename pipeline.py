@@ -0,0 +1,68 @@
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import eventlet
+from eventlet import tpool
+
+from latency import percentile_ms
+
+PIPELINE_POOL_SIZE = int(os.environ.get('PIPELINE_POOL_SIZE', 64))  # stages in flight across all requests
+LATENCY_SAMPLES = 1000
+
+
+class StagePipeline:
+    """Runs the outbound calls of a request as named, timed stages.
+
+    Independent stages are spawned on a shared GreenPool so they overlap. The
+    call of each stage runs in eventlet's thread pool, so blocking clients
+    (requests, grpc) neither stall the hub nor serialize the stages, whether
+    or not the process is monkey patched. Latency is kept per stage name.
+    """
+
+    def __init__(self, pool_size=PIPELINE_POOL_SIZE):
+        self.pool = eventlet.GreenPool(pool_size)
+        self.latency = {}  # stage -> recent durations in seconds
+        self.errors = {}  # stage -> count
+
+    def record(self, stage, seconds) -> None:
+        self.latency.setdefault(stage, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+    def call(self, stage, fn, *args):
+        started = time.time()
+        try:
+            return tpool.execute(fn, *args)
+        except Exception:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+        finally:
+            self.record(stage, time.time() - started)
+
+    def spawn(self, stage, fn, *args):
+        return self.pool.spawn(self.call, stage, fn, *args)
+
+    @contextmanager
+    def timed(self, stage):
+        # end to end time of a whole flow
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - started)
+
+    def metrics(self) -> dict:
+        stages = {}
+        for stage, samples in self.latency.items():
+            ordered = sorted(samples)
+            stages[stage] = {'count': len(ordered), 'errors': self.errors.get(stage, 0),
+                             'p50_ms': percentile_ms(ordered, 0.5), 'p99_ms': percentile_ms(ordered, 0.99)}
+        return stages
+
+
+def outcome(thread):
+    """(result, None) or (None, exception) of a spawned stage."""
+    try:
+        return thread.wait(), None
+    except Exception as e:
+        return None, e
@@ -0,0 +1,57 @@
+from models import Presence
+
+DEBATER = 'debater'
+SPECTATOR = 'spectator'
+DISCONNECTED = 'disconnected'
+
+
+class PresenceIndex:
+    """Authoritative user_id -> Presence(room_id, role, sid) map.
+
+    Kept up to date by every handler that moves a user in or out of a room, so
+    "is this user already in another room" is a dict lookup instead of a scan
+    over all rooms. sids maps each connected socket back to its user, so the
+    room of a socket connected to any worker can be found too.
+    """
+
+    def __init__(self, users=None, sids=None):
+        self.users = users if users is not None else {}  # any dict-like, see store.RedisHash
+        self.sids = sids if sids is not None else {}  # sid -> user_id
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def set(self, user_id, room_id, role, sid) -> None:
+        previous = self.users.get(user_id)
+        if previous is not None and previous.sid is not None and previous.sid != sid:
+            self.sids.pop(previous.sid, None)
+        self.users[user_id] = Presence(room_id=room_id, role=role, sid=sid)
+        if sid is not None:
+            self.sids[sid] = user_id
+
+    def remove(self, user_id, room_id) -> None:
+        # only drop the entry if it still points at room_id, the user may have moved on
+        presence = self.users.get(user_id)
+        if presence is not None and presence.room_id == room_id:
+            self.users.pop(user_id)
+            if presence.sid is not None:
+                self.sids.pop(presence.sid, None)
+
+    def remove_room(self, room) -> None:
+        for user_id in list(room.users_list) + list(room.spectators_list) + list(room.disconnected):
+            self.remove(user_id, room.id)
+
+    def restore_room(self, room) -> None:
+        # re-index a room recovered after a restart (see Room.disconnect_all), only its disconnected
+        # debaters still belong to it until they rejoin
+        for user_id in room.disconnected:
+            self.set(user_id, room.id, DISCONNECTED, None)
+
+    def room_of_sid(self, sid):
+        user_id = self.sids.get(sid)
+        presence = self.users.get(user_id) if user_id is not None else None
+        return presence.room_id if presence is not None and presence.sid == sid else None
+
+    def in_other_room(self, user_id, room_id) -> bool:
+        presence = self.users.get(user_id)
+        return presence is not None and presence.room_id != room_id and presence.role == DEBATER
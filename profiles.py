@@ -0,0 +1,107 @@
+import os
+import time
+
+from cachetools import TTLCache
+
+from outbound import direct_call, threading
+
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))  # profiles kept in memory
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 300))  # seconds, bounds staleness across workers
+
+
+def fetch_all(db, references, timeout=None):
+    # get_all streams its results, the round trip happens while iterating
+    return list(db.get_all(references, timeout=timeout))
+
+
+class ProfileCache:
+    """Read-through LRU/TTL cache in front of the users collection, user_id -> profile dict.
+
+    Every write to a profile must go through set / update / delete so the cached
+    copy is written through or dropped. Writes made by other workers show up
+    after at most PROFILE_CACHE_TTL seconds. Missing profiles are cached as None
+    too, so a signup in progress doesn't hit Firestore on every poll. Safe to use
+    from the pipeline's threads, Firestore calls happen outside the lock.
+    get_many reads all the misses of a batch with one get_all of db.
+    """
+
+    def __init__(self, collection, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, clock=time.monotonic,
+                 call=direct_call, db=None):
+        self.collection = collection  # a Firestore collection or local_backend.MemoryCollection
+        self.call = call  # see outbound.direct_call
+        self.db = db  # client of the collection, for get_all
+        self.profiles = TTLCache(maxsize=maxsize, ttl=ttl, timer=clock)
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'invalidations': 0, 'batch_reads': 0}
+
+    def get(self, user_id):
+        """Return a copy of the profile, None if there is none."""
+        with self.lock:
+            cached = user_id in self.profiles
+            profile = self.profiles.get(user_id)
+            self.stats['hits' if cached else 'misses'] += 1
+        if not cached:
+            profile = self.call(self.collection.document(user_id).get).to_dict()
+            with self.lock:
+                self.profiles[user_id] = profile
+        return dict(profile) if profile is not None else None
+
+    def get_many(self, user_ids) -> dict:
+        """user_id -> copy of the profile (None if there is none) for each of user_ids."""
+        profiles = {}
+        missing = []
+        with self.lock:
+            for user_id in dict.fromkeys(user_ids):
+                if user_id in self.profiles:
+                    profiles[user_id] = self.profiles[user_id]
+                    self.stats['hits'] += 1
+                else:
+                    missing.append(user_id)
+                    self.stats['misses'] += 1
+        if missing:
+            if self.db is None:
+                fetched = {user_id: self.call(self.collection.document(user_id).get).to_dict() for user_id in missing}
+            else:
+                snapshots = self.call(fetch_all, self.db, [self.collection.document(user_id) for user_id in missing])
+                fetched = dict.fromkeys(missing)
+                fetched.update((snapshot.id, snapshot.to_dict()) for snapshot in snapshots)
+            with self.lock:
+                self.profiles.update(fetched)
+                if self.db is not None:
+                    self.stats['batch_reads'] += 1
+            profiles.update(fetched)
+        return {user_id: dict(profile) if profile is not None else None for user_id, profile in profiles.items()}
+
+    def set(self, user_id, data) -> None:
+        self.call(self.collection.document(user_id).set, data)
+        with self.lock:
+            self.profiles[user_id] = dict(data)
+            self.stats['writes'] += 1
+
+    def update(self, user_id, fields) -> None:
+        self.call(self.collection.document(user_id).update, fields)
+        with self.lock:
+            cached = self.profiles.get(user_id)
+            if cached is not None and not any('.' in field for field in fields):
+                self.profiles[user_id] = dict(cached, **fields)
+                self.stats['writes'] += 1
+                return
+        # not cached or nested field paths, leave the merge to Firestore
+        self.invalidate(user_id)
+
+    def delete(self, user_id) -> None:
+        self.call(self.collection.document(user_id).delete)
+        self.invalidate(user_id)
+
+    def referenced(self, field, value) -> bool:
+        """Whether any stored profile has field == value, asked of Firestore rather than the cache."""
+        query = self.collection.where(field, '==', value).select([]).limit(1)
+        return bool(self.call(lambda timeout=None: list(query.stream(timeout=timeout))))
+
+    def invalidate(self, user_id) -> None:
+        with self.lock:
+            if self.profiles.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.stats, cached=len(self.profiles))
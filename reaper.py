@@ -0,0 +1,77 @@
+import os
+import time
+
+ROOM_START_GRACE = float(os.environ.get('ROOM_START_GRACE', 30 * 60))  # seconds an empty room outlives its time_to_start
+ROOM_ABANDONED_TTL = float(os.environ.get('ROOM_ABANDONED_TTL', 10 * 60))  # seconds a conversation survives without debaters
+DISCONNECTED_TTL = float(os.environ.get('ROOM_DISCONNECTED_TTL', 15 * 60))  # seconds a disconnected debater may rejoin
+
+
+class RoomReaper:
+    """Evicts idle rooms and stale disconnected debaters through scheduler deadlines.
+
+    Every room change re-evaluates only that room: an idle room gets an
+    ('expire', room_id) deadline, a room in use has it cancelled. Each entry of
+    Room.disconnected gets its own ('disconnected', room_id, user_id) deadline.
+    Nothing ever scans all rooms. expire_room(room_id) and
+    expire_disconnected(room_id, user_id) do the actual removal and return True
+    if they removed something.
+    """
+
+    def __init__(self, scheduler, expire_room, expire_disconnected, start_grace=ROOM_START_GRACE,
+                 abandoned_ttl=ROOM_ABANDONED_TTL, disconnected_ttl=DISCONNECTED_TTL):
+        self.scheduler = scheduler
+        self.expire_room = expire_room
+        self.expire_disconnected = expire_disconnected
+        self.start_grace = start_grace
+        self.abandoned_ttl = abandoned_ttl
+        self.disconnected_ttl = disconnected_ttl
+        self.stats = {'expired_rooms': 0, 'expired_disconnected': 0}
+
+    @staticmethod
+    def is_idle(room) -> bool:
+        # a conversation is abandoned once its debaters are gone, a lobby room while nobody is in it
+        if room.is_conversation:
+            return not room.users_list
+        return not room.users_list and not room.spectators_list
+
+    def room_changed(self, room) -> None:
+        key = ('expire', room.id)
+        if not self.is_idle(room):
+            self.scheduler.cancel(key)
+        elif key not in self.scheduler:
+            # an already running countdown is kept, so spectators coming and going don't extend it
+            if room.is_conversation:
+                deadline = time.time() + self.abandoned_ttl
+            else:
+                deadline = room.time_to_start + self.start_grace
+            room_id = room.id
+            self.scheduler.schedule(key, deadline, lambda: self.on_room_deadline(room_id))
+
+    def room_restored(self, room) -> None:
+        # a room recovered after a restart, its disconnected debaters get a fresh countdown
+        self.room_changed(room)
+        for user_id in room.disconnected:
+            self.user_disconnected(room.id, user_id)
+
+    def room_deleted(self, room) -> None:
+        self.scheduler.cancel(('expire', room.id))
+        for user_id in room.disconnected:
+            self.scheduler.cancel(('disconnected', room.id, user_id))
+
+    def user_disconnected(self, room_id, user_id) -> None:
+        self.scheduler.schedule(('disconnected', room_id, user_id), time.time() + self.disconnected_ttl,
+                                lambda: self.on_disconnected_deadline(room_id, user_id))
+
+    def user_returned(self, room_id, user_id) -> None:
+        self.scheduler.cancel(('disconnected', room_id, user_id))
+
+    def on_room_deadline(self, room_id) -> None:
+        if self.expire_room(room_id):
+            self.stats['expired_rooms'] += 1
+
+    def on_disconnected_deadline(self, room_id, user_id) -> None:
+        if self.expire_disconnected(room_id, user_id):
+            self.stats['expired_disconnected'] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
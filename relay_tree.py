@@ -0,0 +1,126 @@
+import os
+
+RELAY_TREE = os.environ.get('SIGNALING_RELAY_TREE') == '1'  # spectators relay the streams to each other
+RELAY_FANOUT = int(os.environ.get('RELAY_FANOUT', 3))  # spectators one spectator forwards to
+RELAY_ROOT_FANOUT = int(os.environ.get('RELAY_ROOT_FANOUT', 4))  # spectators fed by the debaters directly
+
+ROOT = None  # parent of the spectators that pull from the debaters
+
+
+class RelayTree:
+    """Bounded fan-out relay tree over the spectators of one room.
+
+    A spectator gets the debaters' streams either from the debaters (parent ROOT)
+    or from its parent spectator, which forwards what it receives. Nobody feeds
+    more than its fan-out, so upload per peer stays constant however large the
+    audience. New spectators attach at the shallowest free slot. When a spectator
+    with children leaves, the deepest spectator takes its place, so a repair
+    moves one spectator and re-parents only the orphans.
+
+    add() and remove() return the (spectator, new parent) assignments to send out.
+    """
+
+    def __init__(self, fanout=RELAY_FANOUT, root_fanout=RELAY_ROOT_FANOUT):
+        self.fanout = fanout
+        self.root_fanout = root_fanout
+        self.parent = {}  # spectator -> parent spectator or ROOT
+        self.children = {ROOT: set()}
+        self.depth = {ROOT: 0}
+        self.by_depth = {}  # depth -> spectators at that depth
+        self.open_by_depth = {0: {ROOT}}  # depth -> nodes with a free slot
+        self.moves = 0
+
+    def __contains__(self, user_id):
+        return user_id in self.parent
+
+    def __len__(self):
+        return len(self.parent)
+
+    def children_of(self, user_id):
+        return set(self.children.get(user_id, ()))
+
+    def max_depth(self) -> int:
+        return max(self.by_depth, default=0)
+
+    def capacity(self, node) -> int:
+        return self.root_fanout if node is ROOT else self.fanout
+
+    def update_open(self, node) -> None:
+        depth = self.depth[node]
+        if len(self.children[node]) < self.capacity(node):
+            self.open_by_depth.setdefault(depth, set()).add(node)
+        else:
+            self.discard(self.open_by_depth, depth, node)
+
+    @staticmethod
+    def discard(sets, depth, node) -> None:
+        nodes = sets.get(depth)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del sets[depth]
+
+    def attach(self, user_id, parent, children=()) -> None:
+        self.parent[user_id] = parent
+        self.children[parent].add(user_id)
+        self.children[user_id] = set(children)
+        for child in children:
+            self.parent[child] = user_id
+        self.depth[user_id] = self.depth[parent] + 1
+        self.by_depth.setdefault(self.depth[user_id], set()).add(user_id)
+        self.update_open(parent)
+        self.update_open(user_id)
+
+    def detach(self, user_id):
+        """Take user_id out of the tree, return (parent, children)."""
+        parent = self.parent.pop(user_id)
+        children = self.children.pop(user_id)
+        depth = self.depth.pop(user_id)
+        self.discard(self.by_depth, depth, user_id)
+        self.discard(self.open_by_depth, depth, user_id)
+        if parent in self.children:
+            self.children[parent].discard(user_id)
+            self.update_open(parent)
+        return parent, children
+
+    def add(self, user_id):
+        if user_id in self.parent:
+            return []
+        parent = next(iter(self.open_by_depth[min(self.open_by_depth)]))
+        self.attach(user_id, parent)
+        return [(user_id, parent)]
+
+    def remove(self, user_id):
+        if user_id not in self.parent:
+            return []
+        parent, orphans = self.detach(user_id)
+        if not orphans:
+            return []
+        # the deepest spectator has no children, moving it into the hole keeps every other depth
+        replacement = next(iter(self.by_depth[self.max_depth()]))
+        self.detach(replacement)
+        orphans.discard(replacement)
+        self.attach(replacement, parent, orphans)
+        self.moves += 1 + len(orphans)
+        return [(replacement, parent)] + [(orphan, replacement) for orphan in orphans]
+
+    def metrics(self) -> dict:
+        return {'spectators': len(self.parent), 'depth': self.max_depth(), 'moves': self.moves,
+                'max_upload': max((len(children) for children in self.children.values()), default=0)}
+
+
+if __name__ == '__main__':
+    # simulated churn: upload per peer and signaling per change stay bounded as the audience grows
+    import random
+    for audience in (10, 100, 1000, 10000):
+        tree = RelayTree()
+        members = []
+        messages = changes = 0
+        while len(members) < audience:
+            changes += 1
+            if members and random.random() < 0.3:
+                messages += len(tree.remove(members.pop(random.randrange(len(members)))))
+            else:
+                members.append(changes)
+                messages += len(tree.add(changes))
+        print(f"{audience:>6} spectators: {tree.metrics()}, {messages / changes:.2f} assignments per change")
@@ -0,0 +1,94 @@
+class ReportTally:
+    """Report bookkeeping for one room.
+
+    Keeps the reporters of every target as a set, the reverse reporter -> targets
+    map and a blacklist set. Targets that are not blacklisted yet are bucketed by
+    report count, so finding who crossed the threshold only walks the buckets at or
+    above it instead of every user in the room.
+    """
+    __slots__ = ('reporters', 'reported_by', 'blacklist', 'by_count', 'max_count')
+
+    def __init__(self, user_reports=None, blacklist=None):
+        self.reporters = {}  # target -> set of reporter ids
+        self.reported_by = {}  # reporter -> set of target ids
+        self.blacklist = set(blacklist or [])
+        self.by_count = {}  # report count -> set of targets that are not blacklisted
+        self.max_count = 0
+        for target, reporters in (user_reports or {}).items():
+            self.add_target(target)
+            for reporter in reporters:
+                self.toggle(reporter, target)
+
+    def add_target(self, target) -> bool:
+        # returns True if the target was not tracked yet
+        if target in self.reporters:
+            return False
+        self.reporters[target] = set()
+        return True
+
+    def reporters_of(self, target):
+        return list(self.reporters.get(target, ()))
+
+    def toggle(self, reporter, target) -> bool:
+        """Add the report, or take it back if it was already made. Returns True if added."""
+        self.add_target(target)
+        reporters = self.reporters[target]
+        old_count = len(reporters)
+        if reporter in reporters:
+            reporters.discard(reporter)
+            self.reported_by[reporter].discard(target)
+            if not self.reported_by[reporter]:
+                self.reported_by.pop(reporter)
+            added = False
+        else:
+            reporters.add(reporter)
+            self.reported_by.setdefault(reporter, set()).add(target)
+            added = True
+        self.rebucket(target, old_count, len(reporters))
+        return added
+
+    def remove_user(self, user_id):
+        """Forget a user that left the room, as a reporter and as a target.
+
+        Returns (targets whose reporter set changed, whether user_id was a target).
+        """
+        changed = []
+        for target in self.reported_by.pop(user_id, ()):
+            reporters = self.reporters[target]
+            reporters.discard(user_id)
+            self.rebucket(target, len(reporters) + 1, len(reporters))
+            changed.append(target)
+        was_target = user_id in self.reporters
+        if was_target:
+            self.rebucket(user_id, len(self.reporters.pop(user_id)), 0)
+        return changed, was_target
+
+    def check(self, threshold, eligible):
+        """Blacklist every eligible target with at least threshold reports.
+
+        Returns the newly blacklisted targets, each target is returned only once.
+        """
+        blacklisted = []
+        for count in range(self.max_count, max(threshold, 1) - 1, -1):
+            for target in [target for target in self.by_count.get(count, ()) if eligible(target)]:
+                self.rebucket(target, count, 0)
+                self.blacklist.add(target)
+                blacklisted.append(target)
+        return blacklisted
+
+    def rebucket(self, target, old_count, new_count) -> None:
+        if target in self.blacklist:
+            return
+        if old_count:
+            bucket = self.by_count[old_count]
+            bucket.discard(target)
+            if not bucket:
+                self.by_count.pop(old_count)
+        if new_count:
+            self.by_count.setdefault(new_count, set()).add(target)
+            self.max_count = max(self.max_count, new_count)
+        while self.max_count and self.max_count not in self.by_count:
+            self.max_count -= 1
+
+    def user_reports(self) -> dict:
+        return {target: list(reporters) for target, reporters in self.reporters.items()}
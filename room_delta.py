@@ -0,0 +1,13 @@
+"""Patch operations sent with the room_delta event.
+
+A path is a list of keys into the room dict, e.g. ['users_list', 'alice', 'ready'].
+Lists are used instead of dotted strings since user ids may contain dots.
+"""
+
+
+def set_op(path, value):
+    return {'op': 'set', 'path': path, 'value': value}
+
+
+def del_op(path):
+    return {'op': 'del', 'path': path}
@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import time
+from collections import deque
+
+import eventlet
+from eventlet.event import Event
+
+from latency import mean_ms, percentile_ms
+
+LATENESS_SAMPLES = 1000
+
+
+class DeadlineScheduler:
+    """Runs keyed callbacks at their deadline from a single greenlet.
+
+    Deadlines sit in a heap, so schedule and cancel are O(log n) and the runner
+    sleeps exactly until the earliest one instead of scanning on a fixed tick.
+    Scheduling a key again replaces its previous deadline; replaced and cancelled
+    entries are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []  # [deadline, seq, key, callback], callback is None once cancelled
+        self.entries = {}  # key -> heap entry
+        self.counter = itertools.count()
+        self.wakeup = Event()
+        self.lateness = deque(maxlen=LATENESS_SAMPLES)  # seconds between deadline and run
+        self.stats = {'scheduled': 0, 'cancelled': 0, 'fired': 0, 'errors': 0}
+
+    def schedule(self, key, deadline, callback) -> None:
+        self.cancel(key, count=False)
+        entry = [deadline, next(self.counter), key, callback]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        self.stats['scheduled'] += 1
+        if self.heap[0] is entry and not self.wakeup.ready():
+            # the runner may be sleeping towards a later deadline
+            self.wakeup.send()
+
+    def cancel(self, key, count=True) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        entry[3] = None
+        if count:
+            self.stats['cancelled'] += 1
+        if len(self.heap) > 64 and len(self.entries) < len(self.heap) // 2:
+            # mostly cancelled entries, rebuild instead of letting the heap grow
+            self.heap = [entry for entry in self.heap if entry[3] is not None]
+            heapq.heapify(self.heap)
+
+    def deadline(self, key):
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def run_due(self):
+        """Run every callback whose deadline passed, return the seconds until the next one."""
+        while self.heap:
+            deadline, _, key, callback = self.heap[0]
+            if callback is None:
+                heapq.heappop(self.heap)
+                continue
+            now = self.clock()
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.heap)
+            self.entries.pop(key, None)
+            self.lateness.append(now - deadline)
+            self.stats['fired'] += 1
+            try:
+                callback()
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"scheduler: {key} failed: {e}")
+        return None
+
+    def run(self) -> None:
+        while True:
+            delay = self.run_due()
+            self.wakeup = Event()
+            with eventlet.Timeout(delay, False):
+                self.wakeup.wait()
+
+    def metrics(self) -> dict:
+        lateness = sorted(self.lateness)
+        return dict(
+            self.stats,
+            pending=len(self.entries),
+            heap=len(self.heap),
+            lateness_ms_mean=mean_ms(lateness),
+            lateness_ms_p99=percentile_ms(lateness, 0.99),
+            lateness_ms_max=percentile_ms(lateness, 1.0),
+        )
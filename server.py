@@ -1,24 +1,51 @@
-import eventlet
-import dataclasses
-import math
 import os
 import time
+STARTED = time.time()
+import eventlet
+ROOM_STORE_URL = os.environ.get('ROOM_STORE_URL')  # e.g. redis://localhost:6379/0, rooms stay in this process if unset
+SHARD_WORKER_ID = os.environ.get('SHARD_WORKER_ID')  # set to own rooms by consistent hashing instead, needs ROOM_STORE_URL
+SHARD_WORKER_URL = os.environ.get('SHARD_WORKER_URL')  # where clients are redirected to reach this worker
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', None if SHARD_WORKER_ID else ROOM_STORE_URL)
+if ROOM_STORE_URL or SOCKETIO_MESSAGE_QUEUE:
+    # the redis clients of the store and the message queue must not block the eventlet loop
+    eventlet.monkey_patch()
+import functools
+import io
+import math
 import uuid
-import firebase_admin
-import pyrebase
-from firebase_admin import credentials, auth
-from firebase_admin import firestore, storage
+from eventlet import tpool
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from flask_socketio import SocketIO, join_room, leave_room, emit, close_room
+from flask_socketio import SocketIO, join_room, leave_room, emit
 from default_rooms import get_mock_rooms
+from lobby import LobbyBroadcaster, InvalidQuery, lobby_topic
+from presence import DEBATER, SPECTATOR, DISCONNECTED
 from models import Room, User
+from room_delta import set_op, del_op
+from store import create_room_store, RoomConflict
+from sharding import create_sharded_store, LobbyRelay, WorkerRegistry
+from journal import RoomJournal, ROOM_JOURNAL_DIR
+from scheduler import DeadlineScheduler
+from reaper import RoomReaper
+from relay_tree import RelayTree, RELAY_TREE
+from signaling import SignalRelay
+from wire import MSGPACK, binary_room, encode, create_client_capabilities
+from tokens import TokenVerifier, InvalidToken, SigningKeysUnavailable
+from profiles import ProfileCache
+from usernames import UsernameIndex
+from pipeline import StagePipeline
+from outbound import Outbound
+from images import ImagePublisher, ImageTooLarge, IMAGE_MAX_BYTES
+from backends import Backends
+IMPORTED = time.time()
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/etc/secrets/debate-center-firebase-key.json"
 app = Flask(__name__)
+# Werkzeug refuses larger bodies before buffering them, the headroom is for the multipart framing and form fields
+app.config['MAX_CONTENT_LENGTH'] = IMAGE_MAX_BYTES + 64 * 1024
 origins = ["https://debate-center-dd720.web.app", "https://debate-center-dd720.firebaseapp.com"]
 CORS(app, origins=origins)
-socketio = SocketIO(app, cors_allowed_origins=origins)
+# with a message queue, emits reach sockets connected to any worker
+socketio = SocketIO(app, cors_allowed_origins=origins, message_queue=SOCKETIO_MESSAGE_QUEUE)
 
 config = {
     'apiKey': os.environ.get('FIREBASE_API_KEY'),
@@ -30,17 +57,34 @@ config = {
     'appId': os.environ.get('FIREBASE_APP_ID')
 }
 
-# Initialize Firebase Admin SDK for Firestore
-cred_firestore = credentials.Certificate("/etc/secrets/debate-center-firebase-key.json")
-app_firestore = firebase_admin.initialize_app(cred_firestore, name='Firestore', options={
-    'storageBucket': config['storageBucket']
-})
-
-db_firestore = firestore.client(app_firestore)
-
-# Auth
-firebase_auth = pyrebase.initialize_app(config)
-auths = firebase_auth.auth()
+# deadlines, circuit breakers and metrics of every call to Firebase
+outbound = Outbound()
+firestore_call = functools.partial(outbound.call, 'firestore')
+storage_call = functools.partial(outbound.call, 'storage')
+# Firebase (or BACKEND_MODE=local stand-ins), each client is created on first use
+backends = Backends(config, outbound)
+storage_bucket = backends.deferred('bucket')
+auths = backends.deferred('auth')
+image_publisher = ImagePublisher(storage_bucket, storage_call)
+# every read and write of a users document goes through here
+profile_cache = ProfileCache(backends.collection('users'), call=firestore_call, db=backends.deferred('firestore'))
+username_index = UsernameIndex(backends, call=firestore_call)
+PROFILES_BATCH_MAX = int(os.environ.get('PROFILES_BATCH_MAX', 100))  # user ids per /api/profiles request
+
+token_verifier = TokenVerifier(backends.project_id, fetch_keys=backends.signing_keys)
+# outbound calls of signup / signin, see StagePipeline
+auth_pipeline = StagePipeline()
+
+def verify_token(token):
+    # (user_id, email, sign-in provider) of an ID token, checked locally.
+    # Google is only asked when its signing keys can't be fetched
+    try:
+        claims = token_verifier.verify(token)
+        return claims['sub'], claims.get('email'), claims.get('firebase', {}).get('sign_in_provider')
+    except SigningKeysUnavailable as e:
+        print(f"verify_token: {e}, falling back to get_account_info")
+        user_info = auths.get_account_info(token)['users'][0]
+        return user_info['localId'], user_info.get('email'), user_info['providerUserInfo'][0]['providerId']
 
 @app.route('/', methods=['GET'])
 def index():
@@ -50,17 +94,50 @@ def index():
 def handle_connect():
     print('Client connected. id=', request.sid)
 
-def is_username_exists(username):
-    query = db_firestore.collection('users').where('username', '==', username).limit(1)
-    results = query.stream()
-    return len(list(results)) > 0
-
 # ---------- GET CONFIG ---------- #
 @app.route('/api/get_auth', methods=['GET'])
 def get_auth():
     return jsonify(config)
 
+# ---------- METRICS ---------- #
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({
+        'lobby': lobby_broadcaster.metrics(),
+        'journal': room_journal.metrics() if room_journal is not None else None,
+        'tokens': token_verifier.metrics(),
+        'profiles': profile_cache.metrics(),
+        'usernames': username_index.metrics(),
+        'auth_pipeline': auth_pipeline.metrics(),
+        'scheduler': scheduler.metrics(),
+        'reaper': room_reaper.metrics(),
+        'relay_trees': {'rooms': len(relay_trees),
+                        'spectators': sum(len(tree) for tree in relay_trees.values()),
+                        'depth': max((tree.max_depth() for tree in relay_trees.values()), default=0),
+                        'moves': sum(tree.moves for tree in relay_trees.values())},
+        'signaling': signal_relay.metrics(),
+        'outbound': outbound.metrics(),
+        'images': image_publisher.metrics(),
+        'backends': backends.metrics(),
+    })
+
+# ---------- USERNAME AVAILABILITY ---------- #
+@app.route('/api/username_available', methods=['GET'])
+def username_available():
+    # cheap enough to call while the user types. eventually consistent across workers, signup has the final say
+    username = request.args.get('username', '')
+    if not username:
+        return jsonify({'error': 'Missing username'}), 400
+    return jsonify({'username': username, 'available': not username_index.exists(username)})
+
 # ---------- SIGN UP ---------- #
+def undo_signup_stage(stage, fn, *args):
+    # a failed rollback is only logged, the error that made it necessary is the one to report
+    try:
+        auth_pipeline.call(stage, fn, *args)
+    except Exception as e:
+        print(f"signup: {stage} failed during rollback: {e}")
+
 @app.route('/api/signup', methods=['POST'])
 def signup():
     # sign up user without image
@@ -74,23 +151,32 @@ def signup():
     print(f"!!! signup requsted: \nemail: {email}\npassword: {password}\nname: {name}\nusername: {username}\ntags: {tags}")
 
     try:
-        if is_username_exists(username):
-            raise Exception('Username already exists')
-        
-        # create new user base on email and password
-        new_user = auths.create_user_with_email_and_password(email=email, password=password)
-        login_user = auths.sign_in_with_email_and_password(email, password)
-        token = login_user['idToken']
-        user_info = auths.get_account_info(token)['users'][0]
-        user_id = user_info['localId']
-
-        # Add user details to database
-        user_ref = db_firestore.collection('users').document(user_id)
-        user_ref.set({
-            'name': name,
-            'username': username,
-            'tags':tags
-        })
+        with auth_pipeline.timed('signup'):
+            # the reservation is usually answered by the bloom filter, so a taken username
+            # is turned away before an account is created for it
+            if not auth_pipeline.call('reserve_username', username_index.reserve, username):
+                raise Exception('Username already exists')
+            try:
+                new_user = auth_pipeline.call('create_account', auths.create_user_with_email_and_password, email, password)
+            except Exception:
+                undo_signup_stage('release_username', username_index.release, username)
+                raise
+
+            # the new account's token and id come with the create response, no sign in needed
+            token = new_user['idToken']
+            user_id = new_user['localId']
+
+            # Add user details to database
+            try:
+                auth_pipeline.call('create_profile', profile_cache.set, user_id, {
+                    'name': name,
+                    'username': username,
+                    'tags':tags
+                })
+            except Exception:
+                undo_signup_stage('delete_account', auths.delete_user_account, token)
+                undo_signup_stage('release_username', username_index.release, username)
+                raise
         
         # Return success response
         return jsonify({'message': 'Signup successful', 'userId': username, 'token': token, 'tags': tags }), 200
@@ -98,7 +184,7 @@ def signup():
     except Exception as e:
         # Handle other errors
         if 'Username already exists' in str(e):
-            return jsonify({'username': 'Username already exists'}), 500
+            return jsonify({'username': 'Username already exists'}), 409
         else:
             return jsonify({'email': 'Invalid email or already exists'}), 500
 
@@ -106,67 +192,53 @@ def signup():
 @app.route('/api/upload_image', methods=['POST'])
 def upload_file():
 
-    username = request.form['username']
     token = request.form['token']
-    user_info = auths.get_account_info(token)['users'][0]
-    user_id = user_info['localId']
-    user_ref = db_firestore.collection('users').document(user_id)
+    user_id, _, _ = verify_token(token)
+    profile = profile_cache.get(user_id) or {}
+    old_image = profile.get('image')
 
     if 'file' not in request.files:
-        user_ref.update({
+        profile_cache.update(user_id, {
             'image': ''
         })
+        release_image(old_image, profile.get('username'))
         return jsonify({'message': 'Empty upload successful', 'profilePhotoURL': ''})
     
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    # Upload the file to Firebase Storage
-    destination_blob_name = f'users/{username}/profile _image'
-    bucket = storage.bucket(app=app_firestore)
-    # Check if the blob already exists
+    # the URL is final right away, the thumbnail is published in the background. the publisher
+    # takes Werkzeug's spooled upload over, the request gets an empty stream to close instead
+    stream, file.stream = file.stream, io.BytesIO()
     try:
-        existing_blob = bucket.get_blob(destination_blob_name)
-        if existing_blob:
-            blob = existing_blob
-            blob.upload_from_file(file, content_type=file.content_type)
-            profilePhotoURL = manage_blob(blob, username, False)
-        else:
-            blob = bucket.blob(destination_blob_name)
-            blob.upload_from_file(file, content_type=file.content_type)
-            profilePhotoURL = manage_blob(blob, username, True)
-    except Exception as e:
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_file(file, content_type=file.content_type)
-        profilePhotoURL = manage_blob(blob, username, True)
-    
-    user_ref.update({
+        profilePhotoURL = image_publisher.submit(stream, file.content_type)
+    except ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+
+    profile_cache.update(user_id, {
         'image': profilePhotoURL
         })
-
-
+    if old_image != profilePhotoURL:
+        release_image(old_image, profile.get('username'))
 
     return jsonify({'message': 'Upload successful', 'profilePhotoURL': profilePhotoURL})
 
-def manage_blob(blob, username ,is_first_time):
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f"request larger than {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+def release_image(url, username=None):
+    # images are shared by everyone who uploaded the same file, delete one only when no profile uses it.
+    # a photo from before that is the user's own object at users/<username>/profile _image
     try:
-        destination_blob_name_url = f'users%2F{username}%2Fprofile _image'
-        token = uuid.uuid4()
-        metageneration_match_precondition = None
-        metadata = {"firebaseStorageDownloadTokens": token}
-        blob.metadata = metadata
-        blob.make_public()
-        blob.patch(if_metageneration_match=metageneration_match_precondition)
-        # Fetches a public URL from GCS.
-        gcs_storageURL = blob.public_url
-        # Generates a URL with Access Token from Firebase.
-        firebase_storageURL = 'https://firebasestorage.googleapis.com/v0/b/{}/o/{}?alt=media&token={}'.format(blob.bucket.name, destination_blob_name_url, token)
-        return firebase_storageURL
+        if image_publisher.name_of(url):
+            if not profile_cache.referenced('image', url):
+                image_publisher.delete(url)
+        elif username:
+            image_publisher.delete_legacy(username)
     except Exception as e:
-        return jsonify({'error': e}), 500
-
-
+        print(f"images: releasing {url or username} failed: {e}")
 
 # ---------- SIGN IN REGULAR ---------- #
 @app.route('/api/signin', methods=['POST'])
@@ -176,12 +248,11 @@ def signin():
     password = user_data.get('password')
     print(f"!!! signin requsted: \nemail: {email}\npassword: {password}")
     try:
-        login_user = auths.sign_in_with_email_and_password(email, password)
-        token = login_user['idToken']
-        user_info = auths.get_account_info(token)['users'][0]
-        user_id = user_info['localId']
-        users_ref = db_firestore.collection('users').document(user_id)
-        users_user_data = users_ref.get().to_dict()
+        with auth_pipeline.timed('signin'):
+            login_user = auth_pipeline.call('sign_in', auths.sign_in_with_email_and_password, email, password)
+            token = login_user['idToken']
+            # sign in already returns the user id, the token doesn't need to be looked up
+            users_user_data = auth_pipeline.call('load_profile', profile_cache.get, login_user['localId'])
         username = users_user_data['username']
         tags = users_user_data['tags']
         try:
@@ -201,14 +272,11 @@ def signin():
 def get_user():
     id_token = request.headers.get('Authorization')
     try:
-        decoded_token = auths.get_account_info(id_token)['users'][0]
-        user_uid = decoded_token['localId']
-        provider = decoded_token['providerUserInfo'][0]['providerId']
+        user_uid, email, provider = verify_token(id_token)
         user_doc = {}
-        user_doc["email"] = decoded_token['email']
+        user_doc["email"] = email
         user_doc["provider"] = provider
-        user_ref = db_firestore.collection('users').document(user_uid)
-        user_doc.update(user_ref.get().to_dict())
+        user_doc.update(profile_cache.get(user_uid))
         return jsonify(user_doc)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -217,29 +285,67 @@ def get_user():
 def check_user_data():
     user_id= request.headers.get('UserId')
     try:
-        user_ref = db_firestore.collection('users').document(user_id)
-        user_doc = user_ref.get().to_dict()
+        user_doc = profile_cache.get(user_id)
         return jsonify(user_doc)
     except Exception as e:
         return
 
+# ---------- PROFILES OF MANY USERS ---------- #
+@app.route('/api/profiles', methods=['GET'])
+def get_profiles():
+    # everyone in a room (?roomId=) or a list of users (?userIds=a,b,c), with one Firestore read for the misses
+    room_id = request.args.get('roomId')
+    if room_id:
+        # a room owned by another shard is read from the lobby directory, lobby_rooms is rooms when unsharded
+        try:
+            room = rooms.get(room_id) or lobby_rooms.get(room_id)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        if room is None:
+            return jsonify({'error': 'Room not found'}), 404
+        user_ids = [*room.users_list, *room.spectators_list]
+        if room.moderator:
+            user_ids.append(room.moderator)
+        user_ids = list(dict.fromkeys(user_ids))[:PROFILES_BATCH_MAX]
+    else:
+        user_ids = [user_id for user_id in request.args.get('userIds', '').split(',') if user_id]
+        if not user_ids:
+            return jsonify({'error': 'Missing roomId or userIds'}), 400
+        if len(user_ids) > PROFILES_BATCH_MAX:
+            return jsonify({'error': f'At most {PROFILES_BATCH_MAX} userIds'}), 400
+    try:
+        return jsonify({'profiles': profile_cache.get_many(user_ids)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ---------- UPDATE_USER ---------- #
 @app.route('/api/update_user', methods=['POST'])
 def update_user():
-    user_data = request.get_json()
+    user_data = request.get_json() or {}
     user_dict = dict(user_data)
+    user_dict.pop('token', None)
     try:
-        user_dict.pop('token')
-
+        user_id, _, _ = verify_token(user_data.get('token'))
+    except InvalidToken as e:
+        return jsonify({'error': str(e)}), 401
     except Exception as e:
-        pass
+        return jsonify({'error': str(e)}), 500
 
     try:
-        token = user_data.get('token')
-        user_info = auths.get_account_info(token)['users'][0]
-        user_id = user_info['localId']
-        user_ref = db_firestore.collection('users').document(user_id).update(user_dict)
-        return jsonify({'message': 'Update successful', "tags": user_dict["tags"] }), 200
+        old_username = (profile_cache.get(user_id) or {}).get('username')
+        new_username = user_dict.get('username')
+        renamed = bool(new_username) and new_username != old_username
+        if renamed and not username_index.reserve(new_username):
+            return jsonify({'error': 'Username already exists'}), 409
+        try:
+            profile_cache.update(user_id, user_dict)
+        except Exception:
+            if renamed:
+                username_index.release(new_username)
+            raise
+        if renamed and old_username:
+            username_index.release(old_username)
+        return jsonify({'message': 'Update successful', "tags": user_dict.get("tags") }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -247,23 +353,34 @@ def update_user():
 # ---------- UPDATE_STAGE_USER ---------- #
 @app.route('/api/update_stage_user', methods=['POST'])
 def update_stage_user():
-    user_data = request.get_json()
+    # the first time google/facebook account login
+    user_data = request.get_json() or {}
     user_dict = dict(user_data)
+    token = user_dict.pop('token', None)
+    username = user_dict.get('username')
+    if not username:
+        return jsonify({'error': 'Missing username'}), 400
     try:
-        if is_username_exists(user_dict['username']):
-            raise Exception('Username already exists')  
-        user_dict.pop('token')
+        user_id, _, _ = verify_token(token)
+        profile = profile_cache.get(user_id)
+    except InvalidToken as e:
+        return jsonify({'error': str(e)}), 401
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
+    old_username = (profile or {}).get('username')
+    reserved = username != old_username
+    if reserved and not username_index.reserve(username):
+        return jsonify({'error': 'Username already exists'}), 409
+    try:
+        profile_cache.set(user_id, user_dict)
     except Exception as e:
-        if 'Username already exists' in str(e):
-            return jsonify({'error': 'Username already exists'}), 500
-    
-    # the first time google/facebook account login
-    token = user_data.get('token')
-    user_info = auths.get_account_info(token)['users'][0]
-    user_id = user_info['localId']
-    user_ref = db_firestore.collection('users').document(user_id).set(dict(user_data))
-    return jsonify({'message': 'Create Database, Update successful', 'token': token, 'userId': user_data["username"], "tags": user_dict["tags"]  }), 200
+        if reserved:
+            username_index.release(username)
+        return jsonify({'error': str(e)}), 500
+    if reserved and old_username:
+        username_index.release(old_username)
+    return jsonify({'message': 'Create Database, Update successful', 'token': token, 'userId': username, "tags": user_dict.get("tags")  }), 200
 
 # ---------- DELETE USER ---------- #
 @app.route('/api/delete_user', methods=['POST'])
@@ -271,21 +388,15 @@ def delete_user():
     user_data = request.get_json()
     try:
         token = user_data.get('token')
-        user_info = auths.get_account_info(token)['users'][0]
-        user_id = user_info['localId']
+        user_id, _, _ = verify_token(token)
+        profile = profile_cache.get(user_id)
         auths.delete_user_account(token)
-        user_ref = db_firestore.collection('users').document(user_id).delete()
+        profile_cache.delete(user_id)
+        if profile and profile.get('username'):
+            username_index.release(profile['username'])
 
-        destination_blob_name = f'users/{user_data.get("username")}/profile _image'
-        bucket = storage.bucket(app=app_firestore)
-        # Check if the blob already exists
-        try:
-            existing_blob = bucket.get_blob(destination_blob_name)
-            if existing_blob:
-                print("deleting blob")
-                existing_blob.delete()
-        except Exception as e:
-            pass
+        if profile:
+            release_image(profile.get('image'), profile.get('username'))
 
         return jsonify({'message': 'Delete successful', 'userId': user_data.get('username'), 'token': token }), 200
 
@@ -296,9 +407,200 @@ def delete_user():
 # user_to_socket = {}
 # room_to_users = {}
 # room_to_sockets = {}
+# sockets stay on the worker that accepted them (sticky sessions), so these maps are per process
 socket_to_user = {}
 socket_to_room = {}
-rooms = get_mock_rooms()
+
+# sid -> set of capability names, see handle_client_capabilities. shared through the store,
+# since emits to a socket of another worker must be encoded for that client too
+client_capabilities = create_client_capabilities(ROOM_STORE_URL)
+
+def has_capability(sid, capability):
+    return client_capabilities.has(sid, capability)
+
+def join_wire_room(room, sid=None):
+    # msgpack clients join the parallel binary room, so each broadcast is encoded once per format
+    sid = sid or request.sid
+    join_room(binary_room(room) if has_capability(sid, MSGPACK) else room, sid=sid)
+
+def leave_wire_room(room, sid=None):
+    leave_room(room, sid=sid)
+    leave_room(binary_room(room), sid=sid)
+
+def close_wire_room(room):
+    socketio.close_room(room)
+    socketio.close_room(binary_room(room))
+
+def broadcast(event, payload=None, to=None, **kwargs):
+    # JSON clients get the payload as is, msgpack clients the payload encoded once through the binary room
+    args = () if payload is None else (payload,)
+    socketio.emit(event, *args, to=to, **kwargs)
+    if SOCKETIO_MESSAGE_QUEUE or client_capabilities.any_local(MSGPACK):
+        # with a message queue the binary clients may sit on another worker
+        socketio.emit(event, *(encode(arg) for arg in args), to=binary_room(to), **kwargs)
+
+def emit_to_sid(event, payload, sid):
+    socketio.emit(event, encode(payload) if has_capability(sid, MSGPACK) else payload, to=sid)
+
+def emit_to_topic(event, payload, topic):
+    broadcast(event, payload, topic)
+
+if SHARD_WORKER_ID:
+    # every room lives only on the worker that owns it, lobby_rooms is the cross-shard view for the lobby
+    shard_client, rooms, lobby_index, presence, lobby_rooms = create_sharded_store(ROOM_STORE_URL)
+    lobby_relay = LobbyRelay(shard_client, emit_to_topic)
+    lobby_broadcaster = LobbyBroadcaster(lobby_relay.publish, shared=True, on_flush=lobby_rooms.publish)
+    shard_registry = WorkerRegistry(shard_client, SHARD_WORKER_ID, SHARD_WORKER_URL, on_tick=lambda ring, changed: rebalance_shard(ring, changed))
+    shard_registry.heartbeat()
+else:
+    rooms, lobby_index, presence = create_room_store(ROOM_STORE_URL)
+    lobby_rooms = rooms
+    lobby_broadcaster = LobbyBroadcaster(emit_to_topic, shared=bool(SOCKETIO_MESSAGE_QUEUE))
+    shard_registry = None
+
+# the journal only makes sense where this process holds the authoritative rooms
+room_journal = RoomJournal(ROOM_JOURNAL_DIR) if ROOM_JOURNAL_DIR and (SHARD_WORKER_ID or not ROOM_STORE_URL) else None
+
+# timers of every room (bot turns, auto start, expiry) run from this one greenlet
+scheduler = DeadlineScheduler()
+room_reaper = RoomReaper(scheduler, lambda room_id: expire_room(room_id),
+                         lambda room_id, user_id: expire_disconnected(room_id, user_id))
+
+def record_room(room):
+    if room_journal is not None:
+        room_journal.record(room)
+
+def record_room_deleted(room_id):
+    if room_journal is not None:
+        room_journal.record_delete(room_id)
+
+def owns_room(room_id):
+    return shard_registry is None or shard_registry.owns(room_id)
+
+def redirect_to_owner(room_id, sid):
+    owner = shard_registry.ring.owner(room_id)
+    socketio.emit('room_redirect', {'roomId': room_id, 'url': shard_registry.worker_url(owner)}, room=sid)
+
+def rebalance_shard(ring, changed):
+    # hand the rooms this worker no longer owns to their new owner and send their sockets there
+    if changed:
+        moved = [room_id for room_id in rooms if ring.owner(room_id) != SHARD_WORKER_ID]
+        for room_id in moved:
+            room = rooms.pop(room_id)
+            record_room_deleted(room_id)
+            lobby_rooms.hand_off(room, ring.owner(room_id))
+            release_room(room)
+            broadcast('room_redirect', {'roomId': room_id, 'url': shard_registry.worker_url(ring.owner(room_id))}, to=room_id)
+            close_wire_room(room_id)
+        if moved:
+            moved = set(moved)
+            for sid in [sid for sid, room_id in socket_to_room.items() if room_id in moved]:
+                socket_to_room.pop(sid)
+    for room in lobby_rooms.take_handoffs(SHARD_WORKER_ID):
+        rooms[room.id] = room
+        record_room(room)
+        schedule_start(room)
+        room_reaper.room_restored(room)
+
+ROOM_SAVE_ATTEMPTS = 3
+
+def retry_on_conflict(handler):
+    # with a shared room store another worker may save the room first, run the handler again on a fresh copy
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        for attempt in range(ROOM_SAVE_ATTEMPTS):
+            try:
+                return handler(*args, **kwargs)
+            except RoomConflict as e:
+                print(f"{handler.__name__}: room {e} changed by another worker, attempt {attempt + 1}")
+        print(f"{handler.__name__}: giving up after {ROOM_SAVE_ATTEMPTS} attempts")
+    return wrapper
+
+def add_room(room):
+    rooms[room.id] = room
+    record_room(room)
+    lobby_index.add(room)
+    lobby_broadcaster.room_new(room)
+    schedule_start(room)
+    room_reaper.room_changed(room)
+
+def delete_room(room_id):
+    lobby_index.remove(room_id)
+    room = rooms.pop(room_id)
+    record_room_deleted(room_id)
+    presence.remove_room(room)
+    release_room(room)
+    lobby_broadcaster.room_deleted(room)
+    return room
+
+def release_room(room):
+    # drop the timers and relay tree this worker keeps for a room it deleted or handed off
+    scheduler.cancel(('start', room.id))
+    room_reaper.room_deleted(room)
+    bot_room_manager.remove_room(room.id)
+    relay_trees.pop(room.id, None)
+
+# spectator relay trees, room_id -> RelayTree, only kept with SIGNALING_RELAY_TREE=1
+relay_trees = {}
+
+def relay_join(room, user_id):
+    if RELAY_TREE:
+        emit_relay_parents(room, relay_trees.setdefault(room.id, RelayTree()).add(user_id))
+
+def relay_leave(room, user_id):
+    tree = relay_trees.get(room.id)
+    if tree is None or user_id not in tree:
+        return
+    emit_relay_parents(room, tree.remove(user_id))
+    if not tree:
+        relay_trees.pop(room.id)
+
+def relay_sid_changed(room, user_id):
+    # a spectator that reconnected must pull from its parent again, and its children must signal its new sid
+    tree = relay_trees.get(room.id)
+    if tree is not None and user_id in tree:
+        emit_relay_parents(room, [(user_id, tree.parent[user_id])]
+                           + [(child, user_id) for child in tree.children_of(user_id)])
+
+def emit_relay_parents(room, assignments):
+    # tell each moved spectator where to pull the streams from, parentSid None means from the debaters
+    for user_id, parent in assignments:
+        spectator = room.spectators_list.get(user_id)
+        if spectator is None:
+            continue
+        parent_sid = room.spectators_list[parent].sid if parent in room.spectators_list else None
+        emit_to_sid('relay_parent', {'roomId': room.id, 'parentId': parent, 'parentSid': parent_sid}, spectator.sid)
+
+def expire_room(room_id):
+    room = rooms.get(room_id)
+    if room is None or not room_reaper.is_idle(room):
+        return False
+    print(f"reaper: room {room_id} expired")
+    if room.is_conversation:
+        broadcast('allUsersLeft', to=room_id)
+    # goes out to the lobby with the other deletions of this flush
+    delete_room(room_id)
+    close_wire_room(room_id)
+    return True
+
+@retry_on_conflict
+def expire_disconnected(room_id, user_id):
+    room = rooms.get(room_id)
+    if room is None or user_id not in room.disconnected:
+        return False
+    room.disconnected.remove(user_id)
+    presence.remove(user_id, room_id)
+    emit_room_delta(room, [set_op(['disconnected'], room.disconnected)])
+    return True
+
+def emit_room_delta(room, ops):
+    # bump the room version and send only the changed fields to the room.
+    # a client that sees a version gap should re-fetch the room with fetch_room_data
+    room.touch()
+    rooms.save(room)
+    record_room(room)
+    room_reaper.room_changed(room)
+    broadcast('room_delta', {'roomId': room.id, 'version': room.version, 'ops': ops}, to=room.id)
 
 # ---------- HOME PAGE ---------- #
 @socketio.on("fetch_all_rooms")
@@ -306,8 +608,47 @@ def get_all_rooms():
     sid = request.sid
 
     print(f"!!! fetch_all_rooms sid: {sid}")
-    rooms_to_send = {room_id: dataclasses.asdict(room_data) for room_id, room_data in rooms.items()}
-    socketio.emit("all_rooms", rooms_to_send, room=sid)
+    rooms_to_send = {room_id: room_data.snapshot() for room_id, room_data in lobby_rooms.items()}
+    emit_to_sid("all_rooms", rooms_to_send, sid)
+
+
+@socketio.on("subscribe_lobby")
+def subscribe_lobby(data=None):
+    # lobby_changes frames only go to subscribed sockets, pass a tag to get only that tag's rooms
+    sid = request.sid
+    topic = lobby_topic((data or {}).get('tag'))
+    join_wire_room(topic)
+    lobby_broadcaster.subscribe(sid, topic)
+
+
+@socketio.on("unsubscribe_lobby")
+def unsubscribe_lobby(data=None):
+    # without a tag, drop every lobby subscription of this socket
+    sid = request.sid
+    tag = (data or {}).get('tag')
+    for topic in lobby_broadcaster.unsubscribe(sid, None if tag is None else lobby_topic(tag)):
+        leave_wire_room(topic)
+
+
+@socketio.on("query_rooms")
+def query_rooms(data):
+    # one page of the lobby, sorted by time_to_start. pass back nextCursor to get the next page
+    sid = request.sid
+    data = data or {}
+    try:
+        page, next_cursor = lobby_index.query(
+            lobby_rooms,
+            tag=data.get('tag'),
+            teams=data.get('teams'),
+            allow_spectators=data.get('allowSpectators'),
+            not_full=data.get('notFull', False),
+            cursor=data.get('cursor'),
+            limit=data.get('limit', 20),
+        )
+    except InvalidQuery as e:
+        emit_to_sid('query_rooms_error', {'error': str(e)}, sid)
+        return
+    emit_to_sid("rooms_page", {'rooms': [room.snapshot() for room in page], 'nextCursor': next_cursor}, sid)
 
 
 # ---------- CREATE ROOM PAGE ---------- #
@@ -315,6 +656,9 @@ def get_all_rooms():
 def create_room():
     room_data = request.json
     room_id = uuid.uuid4().hex
+    while not owns_room(room_id):
+        # keep the room on the worker that creates it
+        room_id = uuid.uuid4().hex
 
     room = Room(
         id = room_id,
@@ -333,8 +677,7 @@ def create_room():
         blacklist=[],
         user_reports={},
     )
-    rooms[room_id] = room
-    socketio.emit('rooms_new', dataclasses.asdict(room))
+    add_room(room)
 
     print(f"!!! create_room room_id: {room_id}, room_data: {room_data}")
 
@@ -344,6 +687,7 @@ def create_room():
 
 # -------------- ROOM PAGE ------------- #
 @socketio.on('join_room')
+@retry_on_conflict
 def join_debate_room(data):
     # Get the request data
     sid = request.sid
@@ -356,6 +700,10 @@ def join_debate_room(data):
         return
     print(f"join_room room_id: {room_id}, sid: {sid}, user_id: {user_id}")
 
+    if not owns_room(room_id):
+        redirect_to_owner(room_id, sid)
+        return
+
     if room_id not in rooms:
         # Room not found, send a specific response
         socketio.emit('room not found', {'error': 'Room not found'}, room=sid)
@@ -363,44 +711,52 @@ def join_debate_room(data):
 
     room = rooms[room_id]
 
-    if user_id in room.blacklist:
+    if user_id in room.reports.blacklist:
         socketio.emit('kick from room', room=sid)
         return
 
-    # if no moderator, set the user to be the moderator
-    if not room.moderator:
-        room.moderator = user_id
-
+    ops = []
     if user_id in room.users_list or user_id in room.spectators_list:
         print("user tried to join room he is already in")
         # update the user's socket id
         old_sid = room.users_list[user_id].sid if user_id in room.users_list else room.spectators_list[user_id].sid
         socket_to_room.pop(old_sid, None)
         socket_to_user.pop(old_sid, None)
-        leave_room(room_id, sid=old_sid)
+        leave_wire_room(room_id, sid=old_sid)
         socket_to_room[sid] = room_id
         socket_to_user[sid] = user_id
         if user_id in room.users_list:
             room.users_list[user_id].sid = sid 
+            ops.append(set_op(['users_list', user_id, 'sid'], sid))
+            presence.set(user_id, room_id, DEBATER, sid)
         else:
             room.spectators_list[user_id].sid = sid
-        socketio.emit('user_join', dataclasses.asdict(room), room=sid)
-        socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
-        socketio.emit('rooms_updated', dataclasses.asdict(room), skip_sid=room_id)
-        join_room(room_id)
+            ops.append(set_op(['spectators_list', user_id, 'sid'], sid))
+            presence.set(user_id, room_id, SPECTATOR, sid)
+            relay_sid_changed(room, user_id)
+        set_missing_moderator(room, user_id, ops)
+        emit_room_delta(room, ops)
+        emit_to_sid('user_join', room.snapshot(), sid)
+        lobby_broadcaster.room_updated(room)
+        join_wire_room(room_id)
+        unsubscribe_lobby({})
         return
     
-    elif any(user_id in another_room.users_list for another_room in rooms.values()):
+    elif presence.in_other_room(user_id, room_id):
         print("user tried to join room when he is already in another room")
         socketio.emit('user already in another room', room=sid)
         return
     
+    join_event = 'user_join'
     if room.is_conversation:
         if user_id in room.disconnected:
             print("user reconnected", user_id, sid)
             room.disconnected.remove(user_id)
-            room.users_list[user_id] = User(sid=sid, photo_url=photo_url)
-            emit('user_join', dataclasses.asdict(room), room=sid)
+            room_reaper.user_returned(room_id, user_id)
+            room.add_user(user_id, User(sid=sid, photo_url=photo_url))
+            presence.set(user_id, room_id, DEBATER, sid)
+            ops.append(set_op(['disconnected'], room.disconnected))
+            ops.append(set_op(['users_list', user_id], room.users_list[user_id].to_dict()))
 
         elif not room.allow_spectators:
             emit('conversation already started', room=sid)
@@ -408,35 +764,77 @@ def join_debate_room(data):
         
         else:
             room.spectators_list[user_id] = User(sid=sid, photo_url=photo_url)
-            emit('spectator_join', dataclasses.asdict(room), room=sid)
+            presence.set(user_id, room_id, SPECTATOR, sid)
+            ops.append(set_op(['spectators_list', user_id], room.spectators_list[user_id].to_dict()))
+            join_event = 'spectator_join'
+            relay_join(room, user_id)
 
-    elif len(room.users_list) >= room.room_size:
+    elif room.is_full():
         if not room.allow_spectators:
             # Room is full, send a specific response
             socketio.emit('room is full', room=sid)
             return
-        # TODO: add user to spectators list
-        room.spectators_list.append(user_id)
-        socketio.emit('user_join', dataclasses.asdict(room) ,room=sid)
+        room.spectators_list[user_id] = User(sid=sid, photo_url=photo_url)
+        presence.set(user_id, room_id, SPECTATOR, sid)
+        ops.append(set_op(['spectators_list', user_id], room.spectators_list[user_id].to_dict()))
+        relay_join(room, user_id)
 
     else:  # room is not full, add user to room
-        team = room.teams and len([other_user for other_user in room.users_list.values() if other_user.team]) < len(room.users_list) / 2
-        room.users_list.update({user_id: User(sid=sid, team=team, photo_url=photo_url)})
-        if user_id not in room.user_reports.keys():
-            room.user_reports[user_id] = []
-        socketio.emit('user_join', dataclasses.asdict(room), room=sid)
-        
-    # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
-    socketio.emit('rooms_updated', dataclasses.asdict(room), skip_sid=room_id)
+        team = bool(room.teams) and room.team_counts[True] < len(room.users_list) / 2
+        room.add_user(user_id, User(sid=sid, team=team, photo_url=photo_url))
+        presence.set(user_id, room_id, DEBATER, sid)
+        ops.append(set_op(['users_list', user_id], room.users_list[user_id].to_dict()))
+        if room.reports.add_target(user_id):
+            ops.append(set_op(['user_reports', user_id], []))
+
+    set_missing_moderator(room, user_id, ops)
+
+    # Notify all users in the room about the change, the snapshot is built once for this version
+    emit_room_delta(room, ops)
+    emit_to_sid(join_event, room.snapshot(), sid)
+    lobby_broadcaster.room_updated(room)
     
     # Join the SocketIO broadcast room
     socket_to_room[sid] = room_id
     socket_to_user[sid] = user_id
-    join_room(room_id)
-    
+    join_wire_room(room_id)
+    unsubscribe_lobby({})
+
+
+def set_missing_moderator(room, user_id, ops):
+    # if no moderator, set the user to be the moderator
+    if not room.moderator:
+        room.moderator = user_id
+        ops.append(set_op(['moderator'], user_id))
+
+
+def remove_from_reports(room, user_id, ops):
+    # forget the reports of a departing user, then re-check only the users they had reported
+    changed, was_target = room.reports.remove_user(user_id)
+    for target in changed:
+        ops.append(set_op(['user_reports', target], room.reports.reporters_of(target)))
+    if was_target:
+        ops.append(del_op(['user_reports', user_id]))
+    return blacklist_reported(room, ops)
+
+
+def blacklist_reported(room, ops, reported_user_id=None):
+    # returns the newly blacklisted users, each user is blacklisted once
+    blacklisted = room.reports.check(room.majority(), lambda target: target in room.users_list or target == reported_user_id)
+    if blacklisted:
+        ops.append(set_op(['blacklist'], list(room.reports.blacklist)))
+    return blacklisted
+
+
+def reassign_moderator(room, user_id, ops):
+    # If the moderator left, assign a new moderator
+    if user_id == room.moderator:
+        room.moderator = room.first_user() or room.first_spectator()
+        ops.append(set_op(['moderator'], room.moderator))
+
 
 @socketio.on('leave_click')
+@retry_on_conflict
 def leave_debate_room(data):
     # Get the request data
     sid = request.sid
@@ -456,74 +854,64 @@ def leave_debate_room(data):
     room = rooms[room_id]
 
     if user_id in room.users_list:
-        room.users_list.pop(user_id)
+        room.pop_user(user_id)
+        ops = [del_op(['users_list', user_id])]
     elif user_id in room.spectators_list:
         room.spectators_list.pop(user_id)
+        relay_leave(room, user_id)
+        ops = [del_op(['spectators_list', user_id])]
     else:
         emit('leave_room_error', {'error': 'User is not in the room'}, room=sid)
-        leave_room(room_id)
+        leave_wire_room(room_id)
         return
+    presence.remove(user_id, room_id)
     
-    # delete user_id from user_reports list
-    for other_user in room.users_list.keys():
-        if user_id in room.user_reports[other_user]:
-            room.user_reports[other_user].remove(user_id)
-    
-    # delete user_id from user_reports
-    room.user_reports.pop(user_id)
-    
-    # check users_report after user leaves
-    for check_user in room.users_list.keys():
-        if  len(room.user_reports[check_user]) >= int(len(room.users_list) / 2) + 1 :
-            room.blacklist.append(check_user)
-            socketio.emit('check_report_user_list',{'reportedUserId':check_user,
-                            'roomData': dataclasses.asdict(room)} ,to=room_id)
+    blacklisted = remove_from_reports(room, user_id, ops)
                             
     if not room.users_list and room.is_conversation:
         # Delete the conversation if no users are left, send a message to the spectators
-        leave_room(room_id)
-        socketio.emit('allUsersLeft', to=room_id)
-        rooms.pop(room_id)
-        close_room(room_id)
-        socketio.emit('rooms_deleted', dataclasses.asdict(room), skip_sid=room_id)
-        bot_room_manager.remove_room(room_id)
+        leave_wire_room(room_id)
+        broadcast('allUsersLeft', to=room_id)
+        delete_room(room_id)
+        close_wire_room(room_id)
         return
 
-    # If the moderator left, assign a new moderator
-    if user_id == room.moderator:
-        if room.users_list:
-            room.moderator = list(room.users_list.keys())[0]
-        elif room.spectators_list:
-            room.moderator = list(room.spectators_list.keys())[0]
-        else:
-            room.moderator = None
+    reassign_moderator(room, user_id, ops)
 
     # leave the SocketIO broadcast room
-    leave_room(room_id)
+    leave_wire_room(room_id)
     # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
-    socketio.emit('rooms_updated', dataclasses.asdict(room), skip_sid=room_id)
-    socketio.emit('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
+    emit_room_delta(room, ops)
+    for check_user in blacklisted:
+        broadcast('check_report_user_list',{'reportedUserId':check_user,
+                        'roomData': room.snapshot()} ,to=room_id)
+    lobby_broadcaster.room_updated(room)
+    broadcast('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
 
 
 @socketio.on('fetch_room_data')
 def fetch_room_data(data):
-    # Get the request data
+    # Get the request data, also used by clients to resync after a room_delta version gap
     sid = request.sid
     room_id = data.get('roomId')
 
+    if not owns_room(room_id):
+        redirect_to_owner(room_id, sid)
+        return
+
     if room_id not in rooms:
         # Room not found, send a specific response
         socketio.emit('fetch_room_data_error', {'error': 'Room not found'}, room=sid)
         return
 
     room = rooms[room_id]
-    socketio.emit('room_data', dataclasses.asdict(room), room=sid)
+    emit_to_sid('room_data', room.snapshot(), sid)
 
 # -------------------------------------- #
 
 # ------------- USERS SHOW ------------- #
 @socketio.on('switch_team')
+@retry_on_conflict
 def switch_team(data):
     room_id = data.get('roomId')
     user_id = data.get('userId')
@@ -537,12 +925,13 @@ def switch_team(data):
         return
     
     user = room.users_list[user_id]
-    user.team = not user.team
+    room.set_team(user_id, not user.team)
 
     # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
+    emit_room_delta(room, [set_op(['users_list', user_id, 'team'], user.team)])
 
 @socketio.on('spectator_click')
+@retry_on_conflict
 def handle_spectator_click(data):
     room_id = data.get('roomId')
     user_id = data.get('userId')
@@ -554,11 +943,15 @@ def handle_spectator_click(data):
     
     if user_id not in room.users_list:
         return
-    user = room.users_list.pop(user_id)
+    user = room.pop_user(user_id)
     room.spectators_list[user_id] = user
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
+    presence.set(user_id, room_id, SPECTATOR, user.sid)
+    relay_join(room, user_id)
+    emit_room_delta(room, [del_op(['users_list', user_id]),
+                           set_op(['spectators_list', user_id], user.to_dict())])
 
 @socketio.on('debater_click')
+@retry_on_conflict
 def handle_debater_click(data):
     room_id = data.get('roomId')
     user_id = data.get('userId')
@@ -571,13 +964,17 @@ def handle_debater_click(data):
     if user_id not in room.spectators_list:
         return
     user = room.spectators_list.pop(user_id)
-    room.users_list[user_id] = user
+    relay_leave(room, user_id)
+    room.add_user(user_id, user)
+    presence.set(user_id, room_id, DEBATER, user.sid)
     # if teams are enabled, check if teams would become unbalanced
-    if room.teams and len([other_user for other_user in room.users_list.values() if other_user.team == user.team]) > math.ceil(room.room_size / 2):
-        user.team = not user.team
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
+    if room.teams and room.team_counts[user.team] > math.ceil(room.room_size / 2):
+        room.set_team(user_id, not user.team)
+    emit_room_delta(room, [del_op(['spectators_list', user_id]),
+                           set_op(['users_list', user_id], user.to_dict())])
 
 @socketio.on('ready_click')
+@retry_on_conflict
 def handle_ready_click(data):
     room_id = data.get('roomId')
     user_id = data.get('userId')
@@ -592,12 +989,13 @@ def handle_ready_click(data):
         return
     
     user = room.users_list[user_id]
-    user.ready = not user.ready
+    room.set_ready(user_id, not user.ready)
 
     # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
+    emit_room_delta(room, [set_op(['users_list', user_id, 'ready'], user.ready)])
 
 @socketio.on('report_user')
+@retry_on_conflict
 def report_user(data):
     reported_user_id = data.get('reportedUserId')
     user_id = data.get('userId')
@@ -610,26 +1008,21 @@ def report_user(data):
     room = rooms[room_id] 
 
     # add or remove from user_reports
-    if reported_user_id not in room.user_reports.keys():
-        room.user_reports[reported_user_id] = []
-
-    if user_id not in room.user_reports[reported_user_id]:
-        room.user_reports[reported_user_id].append(user_id)
-    else:
-        room.user_reports[reported_user_id].remove(user_id)
+    room.reports.toggle(user_id, reported_user_id)
+    ops = [set_op(['user_reports', reported_user_id], room.reports.reporters_of(reported_user_id))]
 
     # update blacklist
-    if  len(room.user_reports[reported_user_id]) >= int(len(room.users_list) / 2) + 1 :
-        room.blacklist.append(reported_user_id)
-        socketio.emit('check_report_user_list',{'reportedUserId':reported_user_id,
-                        'roomData': dataclasses.asdict(room)} ,to=room_id)
-
+    blacklisted = blacklist_reported(room, ops, reported_user_id)
 
     # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
+    emit_room_delta(room, ops)
+    for check_user in blacklisted:
+        broadcast('check_report_user_list',{'reportedUserId':check_user,
+                        'roomData': room.snapshot()} ,to=room_id)
 
 
 @socketio.on('kick_user')
+@retry_on_conflict
 def kick_user(data):
     # Get the request data
     sid = request.sid
@@ -648,77 +1041,84 @@ def kick_user(data):
 
     room = rooms[room_id]
 
-    # delete user_id from user_reports list
-    for other_user in room.users_list.keys():
-        if user_id in room.user_reports[other_user]:
-            room.user_reports[other_user].remove(user_id)
-    
     # delete user_id from users_list and user_reports
     if user_id in room.users_list:
-        room.users_list.pop(user_id)
+        room.pop_user(user_id)
+        ops = [del_op(['users_list', user_id])]
     elif user_id in room.spectators_list:
         room.spectators_list.pop(user_id)
+        relay_leave(room, user_id)
+        ops = [del_op(['spectators_list', user_id])]
     else: 
         socketio.emit('leave_room_error', {'error': 'User is not in the room'}, room=sid)
-        leave_room(room_id)
+        leave_wire_room(room_id)
         return
-    
-    room.user_reports.pop(user_id)
-    
-    # check users_report after user leaves
-    for check_user in room.users_list.keys():
-        if  len(room.user_reports[check_user]) >= int(len(room.users_list.keys()) / 2) + 1 :
-            room.blacklist.append(check_user)
-            socketio.emit('check_report_user_list',{'reportedUserId':check_user,
-                            'roomData': dataclasses.asdict(room)} ,to=room_id)
+    presence.remove(user_id, room_id)
+
+    blacklisted = remove_from_reports(room, user_id, ops)
 
     if not room.users_list and room.is_conversation:
         # Delete the conversation if no users are left, send a message to the spectators
-        leave_room(room_id)
-        socketio.emit('allUsersLeft', to=room_id)
-        rooms.pop(room_id)
-        close_room(room_id)
-        socketio.emit('rooms_deleted', dataclasses.asdict(room), skip_sid=room_id)
+        leave_wire_room(room_id)
+        broadcast('allUsersLeft', to=room_id)
+        delete_room(room_id)
+        close_wire_room(room_id)
         return
 
-    # If the moderator left, assign a new moderator
-    if user_id == room.moderator:
-        if room.users_list:
-            room.moderator = list(room.users_list.keys())[0]
-        elif room.spectators_list:
-            room.moderator = list(room.spectators_list.keys())[0]
-        else:
-            room.moderator = None
+    reassign_moderator(room, user_id, ops)
 
     # leave the SocketIO broadcast room
-    leave_room(room_id)
+    leave_wire_room(room_id)
     # Notify all users in the room about the change
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
-    socketio.emit('rooms_updated', dataclasses.asdict(room), skip_sid=room_id)
-    socketio.emit('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
+    emit_room_delta(room, ops)
+    for check_user in blacklisted:
+        broadcast('check_report_user_list',{'reportedUserId':check_user,
+                        'roomData': room.snapshot()} ,to=room_id)
+    lobby_broadcaster.room_updated(room)
+    broadcast('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
 
 # -------------------------------------- #
 
 # -------------- CONVERSATION PAGE ------------- #
 
-@socketio.on('start_conversation_click')  # TODO: add a thread that checks the timer for each room and starts conversation when it reaches 0
+@socketio.on('start_conversation_click')
+@retry_on_conflict
 def handle_conversation_start(data):
-    room_id = data.get('roomId')
+    start_conversation(data.get('roomId'))
+
+@retry_on_conflict
+def auto_start_conversation(room_id):
+    room = rooms.get(room_id)
+    if room is None or not room.users_list:
+        # nobody to debate, the room is left to expire
+        return
+    start_conversation(room_id)
 
+def schedule_start(room):
+    # (re)schedule the automatic start at time_to_start, call again whenever time_to_start changes
+    if not room.is_conversation:
+        scheduler.schedule(('start', room.id), room.time_to_start, lambda: auto_start_conversation(room.id))
+
+def start_conversation(room_id):
     if room_id not in rooms:
         return
     
-    rooms[room_id].is_conversation = True
+    room = rooms[room_id]
+    scheduler.cancel(('start', room_id))
+    if not room.is_conversation:
+        room.is_conversation = True
+        emit_room_delta(room, [set_op(['is_conversation'], True)])
     
     # Notify all users in the room about the change
-    socketio.emit('conversation_start', to=room_id)
+    broadcast('conversation_start', to=room_id)
 
     # Bot room manager
-    if rooms[room_id].teams is True:
+    if room.teams is True:
         bot_room_manager.add_room(room_id)
 
 
-@socketio.on('WebcamReady')  # TODO: add a thread that checks the timer for each room and starts conversation when it reaches 0
+@socketio.on('WebcamReady')
+@retry_on_conflict
 def handle_webcam_ready(payload):
     sid = request.sid
     print("WebcamReady from:", sid, payload)
@@ -731,68 +1131,102 @@ def handle_webcam_ready(payload):
         return
 
     user.camera_ready = True
+    emit_room_delta(room, [set_op(['users_list', user_id, 'camera_ready'], True)])
     # Notify all users in the room about the change
-    socketio.emit('userInConversationReady', { "userId": user_id, "userSid": user.sid }, to=room_id, include_self=False)
+    broadcast('userInConversationReady', { "userId": user_id, "userSid": user.sid }, to=room_id, include_self=False)
     # Notify user about other user in the room - not needed
-    socketio.emit('usersInConversation', dataclasses.asdict(room), room=sid)
+    emit_to_sid('usersInConversation', room.snapshot(), sid)
+
+# ---------- SIGNALING ---------- #
+signal_relay = SignalRelay(emit_to_sid, has_capability)
+
+@socketio.on('client_capabilities')
+def handle_client_capabilities(data):
+    # e.g. {'capabilities': ['signalBatch', 'msgpack']}, sent once after connecting and before joining anything.
+    # with msgpack, room snapshots, deltas, lobby frames and signals arrive as msgpack encoded binary payloads
+    sid = request.sid
+    client_capabilities.set(sid, data.get('capabilities', []))
+
+def in_same_room(sid, other_sid):
+    # the other socket may be connected to another worker, its room comes from the shared presence index
+    room_id = socket_to_room.get(sid) or presence.room_of_sid(sid)
+    return room_id is not None and presence.room_of_sid(other_sid) == room_id
 
-# -------------- SIGNALING ------------- #
-    
 @socketio.on('sendingSignal')
 def handle_sending_signal(payload):
+    sid = request.sid
     user_sid_to_send_signal = payload['userSidToSendSignal']
-    user_id = payload['userId']
+    if not in_same_room(sid, user_sid_to_send_signal):
+        signal_relay.reject()
+        return
     # caller_id should be request.sid
-    print(f"got sendingSignal from user: {user_id}, sid: {request.sid}, caller_id: {payload['callerId']}, is_spectator: {payload['isSpectator']}, to: {user_sid_to_send_signal}")
-    print(f"sending sendingSignalAck to sid: {user_sid_to_send_signal}")
-    socketio.emit('sendingSignalAck', {'signal': payload['signal'], 'callerId': payload['callerId'], 'userId': user_id, 'isSpectator': payload['isSpectator']}, to=user_sid_to_send_signal)
+    signal_relay.offer(payload['callerId'], user_sid_to_send_signal)
+    signal_relay.send(sid, user_sid_to_send_signal, 'sendingSignalAck',
+                      {'signal': payload['signal'], 'callerId': payload['callerId'], 'userId': payload['userId'], 'isSpectator': payload['isSpectator']})
 
 @socketio.on('returningSignal')
 def handle_returning_signal(payload):
+    sid = request.sid
     caller_id = payload['callerId']
-    user_id = payload['userId']
-    print(f"got returningSignal from user: {user_id}, sid: {request.sid}, caller_id: {caller_id}")
-    print(f"sending returningSignalAck to sid: {caller_id}")
-    socketio.emit('returningSignalAck', {'signal': payload['signal'], 'calleeId': request.sid, 'userId': user_id}, to=caller_id)
+    if not in_same_room(sid, caller_id):
+        signal_relay.reject()
+        return
+    signal_relay.answer(caller_id, sid)
+    signal_relay.send(sid, caller_id, 'returningSignalAck',
+                      {'signal': payload['signal'], 'calleeId': sid, 'userId': payload['userId']})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     # Get the request data
     sid = request.sid
-    room_id = socket_to_room.get(sid)
-    user_id = socket_to_user.get(sid)
+    room_id = socket_to_room.pop(sid, None)
+    user_id = socket_to_user.pop(sid, None)
     print(f'Client disconnected with sid: {sid}, room_id: {room_id}, user_id: {user_id}',)
 
-    if sid in socket_to_room:
-        socket_to_room.pop(sid)
-    if sid in socket_to_user:
-        socket_to_user.pop(sid)
+    lobby_broadcaster.unsubscribe(sid)
+    signal_relay.forget(sid)
+    client_capabilities.forget(sid)
 
-    if room_id is None or room_id not in rooms:
+    if room_id is None or user_id is None:
         return
-    room = rooms[room_id]
-    if user_id is None:
+    leave_on_disconnect(sid, room_id, user_id)
+
+@retry_on_conflict
+def leave_on_disconnect(sid, room_id, user_id):
+    # the socket maps are already cleared, a retry gets the ids passed in again
+    room = rooms.get(room_id)
+    if room is None:
         return
+    ops = []
     if user_id in room.users_list:
-        room.users_list.pop(user_id)
+        room.pop_user(user_id)
+        ops.append(del_op(['users_list', user_id]))
         if room.is_conversation:
             room.disconnected.append(user_id)
+            room_reaper.user_disconnected(room_id, user_id)
+            ops.append(set_op(['disconnected'], room.disconnected))
+            presence.set(user_id, room_id, DISCONNECTED, None)
+        else:
+            presence.remove(user_id, room_id)
     if user_id in room.spectators_list:
         room.spectators_list.pop(user_id)
+        relay_leave(room, user_id)
+        ops.append(del_op(['spectators_list', user_id]))
+        presence.remove(user_id, room_id)
 
-    leave_room(room=room_id)
+    leave_wire_room(room_id)
 
     if not room.users_list and not room.spectators_list:
         # Delete the room if no users are left
-        rooms.pop(room_id)
-        close_room(room_id)
-        socketio.emit('rooms_deleted', dataclasses.asdict(room), skip_sid=room_id)
+        delete_room(room_id)
+        close_wire_room(room_id)
         return
 
     # update room data and notify users
-    socketio.emit('room_data_updated', dataclasses.asdict(room), to=room_id)
-    socketio.emit('rooms_updated', dataclasses.asdict(room), skip_sid=room_id)
-    socketio.emit('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
+    if ops:
+        emit_room_delta(room, ops)
+    lobby_broadcaster.room_updated(room)
+    broadcast('userLeft', { "sid": sid, "userId": user_id }, to=room_id)  # for conversations only
 
 
 # ---------- CHAT ---------- #        
@@ -803,7 +1237,7 @@ def handle_send_message(payload, bot=False):
     message = payload['message']
     room_id = payload['roomId']
     user_id = payload.get('userId') # f"{request.remote_addr}"  # change to user_id when ready
-    socketio.emit('receiveMessage', {'message': message, 'userId': user_id, 'bot': bot}, to=room_id)
+    broadcast('receiveMessage', {'message': message, 'userId': user_id, 'bot': bot}, to=room_id)
 
 
 class BotRoom:
@@ -905,10 +1339,23 @@ class BotRoom:
         elif total_elapsed_time >= self.max_duration:
             self.close_room()
 
+    def next_deadline(self):
+        # when manage has something to do next, None once closed
+        if self.state == 'waiting':
+            return self.last_action_time + self.ready_time
+        if self.state.startswith('team_'):
+            team_duration = self.team_time[self.current_team - 1]
+            return min(self.last_action_time + team_duration,
+                       self.last_action_time + self.announce_time,
+                       self.start_time + self.max_duration - 5)
+        if self.state == 'closing':
+            return self.start_time + self.max_duration
+        return None
+
 class BotRoomManager:
-    def __init__(self):
+    def __init__(self, scheduler):
         self.rooms = {}
-        self.to_remove = []
+        self.scheduler = scheduler
 
     def add_room(self, room_id) -> None:
         if room_id in self.rooms:
@@ -918,27 +1365,70 @@ class BotRoomManager:
         self.rooms[room_id] = room
         print(f"Room {room_id} added.")
         room.init_msg()
+        self.schedule(room)
 
     def remove_room(self, id) -> None:
         if id not in self.rooms:
             # print(f"Room {id} does not exist.")
             return
         self.rooms.pop(id)
+        self.scheduler.cancel(('bot', id))
         print(f"Room {id} removed.")
 
-    def run(self) -> None:
-        while True:
-            current_time = time.time()
-            rooms_copy = self.rooms.copy()
-            for id, room in rooms_copy.items():
-                if room.state == 'closed':
-                    self.remove_room(id)
-                else:
-                    room.manage(current_time)
-            eventlet.sleep(10)
-
-bot_room_manager = BotRoomManager()
-eventlet.spawn(bot_room_manager.run)
+    def schedule(self, room) -> None:
+        deadline = room.next_deadline()
+        if deadline is None:
+            self.remove_room(room.room_id)
+        else:
+            self.scheduler.schedule(('bot', room.room_id), deadline, lambda: self.on_deadline(room))
+
+    def on_deadline(self, room) -> None:
+        if self.rooms.get(room.room_id) is not room:
+            return
+        room.manage(time.time())
+        self.schedule(room)
+
+bot_room_manager = BotRoomManager(scheduler)
+
+def warm_backends():
+    # create the clients off the hub instead of on the first request, then index the usernames
+    backends.warm()
+    username_index.warm()
+
+SET_UP = time.time()
+if room_journal is not None:
+    # rebuild the rooms from before the restart, users get back in through join_room
+    for room in room_journal.recover().values():
+        if owns_room(room.id):
+            # the sids from before the restart are gone
+            room.disconnect_all()
+            rooms[room.id] = room
+            lobby_index.add(room)
+            presence.restore_room(room)
+            schedule_start(room)
+            room_reaper.room_restored(room)
+            record_room(room)
+
+for mock_room in get_mock_rooms().values():
+    if owns_room(mock_room.id) and mock_room.id not in rooms:
+        rooms[mock_room.id] = mock_room
+        lobby_index.add(mock_room)
+        schedule_start(mock_room)
+        room_reaper.room_changed(mock_room)
+        if shard_registry is not None:
+            lobby_rooms.publish([mock_room], [])
+
+eventlet.spawn(scheduler.run)
+eventlet.spawn(image_publisher.run)
+if room_journal is not None:
+    eventlet.spawn(room_journal.run, rooms)
+if shard_registry is not None:
+    eventlet.spawn(shard_registry.run)
+    eventlet.spawn(lobby_relay.run)
+eventlet.spawn(tpool.execute, warm_backends)
+print(f"startup: ready in {(time.time() - STARTED) * 1000:.0f} ms (imports {(IMPORTED - STARTED) * 1000:.0f} ms, "
+      f"setup {(SET_UP - IMPORTED) * 1000:.0f} ms, rooms {(time.time() - SET_UP) * 1000:.0f} ms), "
+      f"{backends.mode} backend clients created in the background")
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=8000, use_reloader=False)
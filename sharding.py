@@ -0,0 +1,203 @@
+import bisect
+import hashlib
+import json
+import time
+from collections.abc import Mapping
+
+import eventlet
+
+from models import Room
+from presence import PresenceIndex
+from store import InMemoryRoomStore, RedisLobbyIndex, RedisHash, encode_presence, decode_presence
+
+RING_REPLICAS = 128  # virtual nodes per worker
+HEARTBEAT_INTERVAL = 2  # seconds
+WORKER_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+
+class HashRing:
+    """Consistent hashing of room ids over the worker ids.
+
+    Every worker gets RING_REPLICAS points on the ring and a room belongs to the
+    first point after its hash, so adding or removing one of N workers only moves
+    about 1/N of the rooms.
+    """
+
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self.hashes = []
+        self.owners = []
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def add(self, node) -> None:
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = self.hash(f'{node}#{replica}')
+            position = bisect.bisect_left(self.hashes, point)
+            self.hashes.insert(position, point)
+            self.owners.insert(position, node)
+
+    def remove(self, node) -> None:
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self.hashes, self.owners) if owner != node]
+        self.hashes = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        position = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[position]
+
+
+class RoomDirectory(Mapping):
+    """Lobby view of the rooms of every shard, room_id -> Room.
+
+    Each owner publishes the snapshots of its changed rooms when the lobby
+    broadcaster flushes, so room events never wait on Redis.
+    """
+
+    def __init__(self, client, prefix='debate'):
+        self.client = client
+        self.key = f'{prefix}:directory'
+        self.handoff_prefix = f'{prefix}:handoff'
+
+    def __getitem__(self, room_id):
+        data = self.client.hget(self.key, room_id)
+        if data is None:
+            raise KeyError(room_id)
+        return Room.from_dict(json.loads(data))
+
+    def __iter__(self):
+        return (room_id.decode() for room_id in self.client.hkeys(self.key))
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+    def items(self):
+        return [(room_id.decode(), Room.from_dict(json.loads(data)))
+                for room_id, data in self.client.hgetall(self.key).items()]
+
+    def publish(self, changed, deleted) -> None:
+        pipe = self.client.pipeline()
+        if changed:
+            pipe.hset(self.key, mapping={room.id: json.dumps(room.snapshot()) for room in changed})
+        if deleted:
+            pipe.hdel(self.key, *deleted)
+        pipe.execute()
+
+    def hand_off(self, room, worker_id) -> None:
+        # park a room for its new owner after a rebalance
+        self.client.hset(f'{self.handoff_prefix}:{worker_id}', room.id, json.dumps(room.snapshot()))
+
+    def take_handoffs(self, worker_id):
+        key = f'{self.handoff_prefix}:{worker_id}'
+        pipe = self.client.pipeline()
+        pipe.hgetall(key)
+        pipe.delete(key)
+        parked, _ = pipe.execute()
+        return [Room.from_dict(json.loads(data)) for data in parked.values()]
+
+
+class WorkerRegistry:
+    """Worker membership through heartbeats in a Redis hash, rebuilds the ring when it changes."""
+
+    def __init__(self, client, worker_id, url, on_tick, prefix='debate'):
+        self.client = client
+        self.worker_id = worker_id
+        self.url = url
+        self.on_tick = on_tick  # on_tick(ring, changed)
+        self.key = f'{prefix}:workers'
+        self.urls = {worker_id: url}
+        self.ring = HashRing([worker_id])
+
+    def worker_url(self, worker_id):
+        return self.urls.get(worker_id)
+
+    def owns(self, room_id) -> bool:
+        return self.ring.owner(room_id) == self.worker_id
+
+    def heartbeat(self) -> bool:
+        now = time.time()
+        self.client.hset(self.key, self.worker_id, json.dumps({'url': self.url, 'seen': now}))
+        live = {}
+        for worker_id, data in self.client.hgetall(self.key).items():
+            worker = json.loads(data)
+            if now - worker['seen'] <= WORKER_TIMEOUT:
+                live[worker_id.decode()] = worker['url']
+        self.urls = live
+        if set(live) == self.ring.nodes:
+            return False
+        ring = HashRing(self.ring.nodes)
+        for worker_id in self.ring.nodes - set(live):
+            ring.remove(worker_id)
+        for worker_id in set(live) - self.ring.nodes:
+            ring.add(worker_id)
+        self.ring = ring
+        print(f"worker {self.worker_id}: ring is now {sorted(ring.nodes)}")
+        return True
+
+    def run(self) -> None:
+        while True:
+            try:
+                changed = self.heartbeat()
+                self.on_tick(self.ring, changed)
+            except Exception as e:
+                print(f"worker {self.worker_id}: heartbeat failed: {e}")
+            eventlet.sleep(HEARTBEAT_INTERVAL)
+
+
+class LobbyRelay:
+    """Fans lobby frames out to the lobby viewers of every worker over Redis pub/sub.
+
+    Used instead of a Socket.IO message queue in sharded mode, so only lobby frames
+    travel through Redis and room events stay local to the owning worker.
+    """
+
+    def __init__(self, client, emit, channel='debate:lobby'):
+        self.client = client
+        self.emit = emit  # emit(event, payload, topic) on this worker
+        self.channel = channel
+
+    def publish(self, event, payload, topic) -> None:
+        self.client.publish(self.channel, json.dumps([event, payload, topic]))
+
+    def run(self) -> None:
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    try:
+                        event, payload, topic = json.loads(message['data'])
+                        self.emit(event, payload, topic)
+                    except Exception as e:
+                        print(f"lobby relay: dropped a frame: {e}")
+            except Exception as e:
+                print(f"lobby relay: subscription failed: {e}, resubscribing")
+            finally:
+                pubsub.close()
+            eventlet.sleep(HEARTBEAT_INTERVAL)
+
+
+def create_sharded_store(url):
+    """Return (client, rooms, lobby_index, presence, directory) for a sharded worker.
+
+    Rooms live in this process only; the lobby index, the presence index and the
+    room directory are shared through Redis.
+    """
+    import redis
+    client = redis.Redis.from_url(url)
+    presence = PresenceIndex(RedisHash(client, 'debate:presence', encode_presence, decode_presence),
+                             RedisHash(client, 'debate:presence:sids', str, bytes.decode))
+    return client, InMemoryRoomStore(), RedisLobbyIndex(client), presence, RoomDirectory(client)
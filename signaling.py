@@ -0,0 +1,75 @@
+import os
+import time
+from collections import deque
+
+import eventlet
+
+from latency import mean_ms, percentile_ms
+
+SIGNAL_BATCH_WINDOW = float(os.environ.get('SIGNAL_BATCH_WINDOW', 0.005))  # seconds
+SIGNAL_BATCH = 'signalBatch'  # client capability and event name
+SETUP_SAMPLES = 1000
+
+
+class SignalRelay:
+    """Relays WebRTC signals (offers, answers, trickled ICE candidates) between sids.
+
+    A client that announced the signalBatch capability gets every signal for a
+    (from, to) pair that arrives within the batch window as one signalBatch frame,
+    in order. Other clients get each signal as its own event, as before.
+    The time from the first signal of a caller to the first answer of its callee
+    is kept as the connection setup latency.
+    """
+
+    def __init__(self, emit, has_capability, window=SIGNAL_BATCH_WINDOW):
+        self.emit = emit  # emit(event, payload, sid)
+        self.has_capability = has_capability  # has_capability(sid, name)
+        self.window = window
+        self.pending = {}  # (from_sid, to_sid) -> [{'event': ..., 'data': ...}]
+        self.flush_scheduled = False
+        self.offers = {}  # caller sid -> {callee sid: time of the first signal, None once answered}
+        self.setup = deque(maxlen=SETUP_SAMPLES)  # seconds
+        self.stats = {'signals': 0, 'frames': 0, 'rejected': 0}
+
+    def forget(self, sid) -> None:
+        self.offers.pop(sid, None)
+
+    def reject(self) -> None:
+        self.stats['rejected'] += 1
+
+    def offer(self, caller_sid, callee_sid) -> None:
+        self.offers.setdefault(caller_sid, {}).setdefault(callee_sid, time.time())
+
+    def answer(self, caller_sid, callee_sid) -> None:
+        offers = self.offers.get(caller_sid)
+        started = offers.get(callee_sid) if offers is not None else None
+        if started is not None:
+            self.setup.append(time.time() - started)
+            offers[callee_sid] = None
+
+    def send(self, from_sid, to_sid, event, payload) -> None:
+        self.stats['signals'] += 1
+        if not self.has_capability(to_sid, SIGNAL_BATCH):
+            self.emit(event, payload, to_sid)
+            self.stats['frames'] += 1
+            return
+        self.pending.setdefault((from_sid, to_sid), []).append({'event': event, 'data': payload})
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            eventlet.spawn_after(self.window, self.flush)
+
+    def flush(self) -> None:
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, {}
+        for (from_sid, to_sid), signals in pending.items():
+            self.emit(SIGNAL_BATCH, {'from': from_sid, 'signals': signals}, to_sid)
+            self.stats['frames'] += 1
+
+    def metrics(self) -> dict:
+        setup = sorted(self.setup)
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            setup_ms_mean=mean_ms(setup),
+            setup_ms_p99=percentile_ms(setup, 0.99),
+        )
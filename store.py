@@ -0,0 +1,207 @@
+import json
+from collections.abc import MutableMapping
+
+from lobby import LobbyIndex, encode_cursor, decode_cursor, page_limit, query_indexes
+from models import Room, Presence
+from presence import PresenceIndex
+
+
+class RoomConflict(Exception):
+    """Another worker changed the room since it was loaded, the handler should run again."""
+
+
+class InMemoryRoomStore(dict):
+    """The rooms of a single process, room_id -> Room. Objects are shared so save is a no-op."""
+
+    def save(self, room) -> None:
+        pass
+
+
+# compare-and-set on the room version, so two workers can't overwrite each other's changes.
+# a room another worker deleted is a conflict too, saving it would leave a hash no listing knows about
+SAVE_ROOM_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version')
+if not current or tonumber(current) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'version', ARGV[2], 'data', ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[4])
+return 1
+"""
+
+
+class RedisRoomStore(MutableMapping):
+    """Rooms shared by every worker, stored as one hash per room in Redis.
+
+    Reading a room decodes a fresh Room. A mutated room must be written back with
+    save(), which fails with RoomConflict if another worker saved a newer version
+    or deleted the room in the meantime. New rooms are stored by assignment.
+    """
+
+    def __init__(self, client, prefix='debate'):
+        self.client = client
+        self.prefix = prefix
+        self.ids_key = f'{prefix}:rooms'
+        self.save_script = client.register_script(SAVE_ROOM_SCRIPT)
+
+    def room_key(self, room_id) -> str:
+        return f'{self.prefix}:room:{room_id}'
+
+    def __getitem__(self, room_id):
+        data = self.client.hget(self.room_key(room_id), 'data')
+        if data is None:
+            raise KeyError(room_id)
+        return Room.from_dict(json.loads(data))
+
+    def __setitem__(self, room_id, room):
+        pipe = self.client.pipeline()
+        pipe.hset(self.room_key(room_id), mapping={'version': room.version, 'data': json.dumps(room.snapshot())})
+        pipe.sadd(self.ids_key, room_id)
+        pipe.execute()
+
+    def __delitem__(self, room_id):
+        pipe = self.client.pipeline()
+        pipe.delete(self.room_key(room_id))
+        pipe.srem(self.ids_key, room_id)
+        deleted, _ = pipe.execute()
+        if not deleted:
+            raise KeyError(room_id)
+
+    def __contains__(self, room_id):
+        return bool(self.client.sismember(self.ids_key, room_id))
+
+    def __iter__(self):
+        return (room_id.decode() for room_id in self.client.sscan_iter(self.ids_key))
+
+    def __len__(self):
+        return self.client.scard(self.ids_key)
+
+    def save(self, room) -> None:
+        saved = self.save_script(keys=[self.room_key(room.id), self.ids_key],
+                                 args=[room.version - 1, room.version, json.dumps(room.snapshot()), room.id])
+        if not saved:
+            raise RoomConflict(room.id)
+
+
+class RedisHash(MutableMapping):
+    """A Redis hash seen as a dict, values go through encode / decode."""
+
+    def __init__(self, client, key, encode, decode):
+        self.client = client
+        self.key = key
+        self.encode = encode
+        self.decode = decode
+
+    def __getitem__(self, field):
+        value = self.client.hget(self.key, field)
+        if value is None:
+            raise KeyError(field)
+        return self.decode(value)
+
+    def __setitem__(self, field, value):
+        self.client.hset(self.key, field, self.encode(value))
+
+    def __delitem__(self, field):
+        if not self.client.hdel(self.key, field):
+            raise KeyError(field)
+
+    def __iter__(self):
+        return (field.decode() for field in self.client.hkeys(self.key))
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+
+class RedisLobbyIndex:
+    """LobbyIndex on Redis sorted sets (score = time_to_start), shared by every worker."""
+
+    def __init__(self, client, prefix='debate'):
+        self.client = client
+        self.prefix = prefix
+        self.keys_key = f'{prefix}:lobby:keys'
+
+    def index_key(self, key) -> str:
+        return f'{self.prefix}:lobby:' + ':'.join(str(part) for part in key)
+
+    def add(self, room) -> None:
+        keys = [self.index_key(key) for key in LobbyIndex.index_keys(room)]
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.zadd(key, {room.id: room.time_to_start})
+        pipe.hset(self.keys_key, room.id, json.dumps(keys))
+        pipe.execute()
+
+    def remove(self, room_id) -> None:
+        keys = self.client.hget(self.keys_key, room_id)
+        if keys is None:
+            return
+        pipe = self.client.pipeline()
+        for key in json.loads(keys):
+            pipe.zrem(key, room_id)
+        pipe.hdel(self.keys_key, room_id)
+        pipe.execute()
+
+    def update(self, room) -> None:
+        self.remove(room.id)
+        self.add(room)
+
+    def query(self, rooms, tag=None, teams=None, allow_spectators=None, not_full=False, cursor=None, limit=20):
+        limit = page_limit(limit)
+        candidates = query_indexes(tag, teams, allow_spectators)
+        pipe = self.client.pipeline()
+        for key in candidates:
+            pipe.zcard(self.index_key(key))
+        sizes = pipe.execute()
+        index_key = self.index_key(candidates[sizes.index(min(sizes))])
+
+        after = decode_cursor(cursor) if cursor else None
+        low = after[0] if after else '-inf'
+        offset = 0
+        page = []
+        while True:
+            chunk = self.client.zrangebyscore(index_key, low, '+inf', start=offset, num=limit * 2, withscores=True)
+            if not chunk:
+                return page, None
+            offset += len(chunk)
+            for room_id, time_to_start in chunk:
+                room_id = room_id.decode()
+                if after and (time_to_start, room_id) <= after:
+                    continue
+                room = rooms.get(room_id)
+                if room is None:
+                    continue
+                if tag is not None and tag not in (room.tags or []):
+                    continue
+                if teams is not None and bool(room.teams) != bool(teams):
+                    continue
+                if allow_spectators is not None and bool(room.allow_spectators) != bool(allow_spectators):
+                    continue
+                if not_full and room.is_full():
+                    continue
+                page.append(room)
+                if len(page) == limit:
+                    return page, encode_cursor((time_to_start, room_id))
+
+
+def encode_presence(presence) -> str:
+    return json.dumps([presence.room_id, presence.role, presence.sid])
+
+
+def decode_presence(value) -> Presence:
+    room_id, role, sid = json.loads(value)
+    return Presence(room_id=room_id, role=role, sid=sid)
+
+
+def create_room_store(url=None):
+    """Return (rooms, lobby_index, presence) for the configured backend.
+
+    Without a url everything lives in this process. With a redis:// url the rooms,
+    lobby indexes and presence are shared by every worker using that url.
+    """
+    if not url:
+        return InMemoryRoomStore(), LobbyIndex(), PresenceIndex()
+    import redis
+    client = redis.Redis.from_url(url)
+    presence = PresenceIndex(RedisHash(client, 'debate:presence', encode_presence, decode_presence),
+                             RedisHash(client, 'debate:presence:sids', str, bytes.decode))
+    return RedisRoomStore(client), RedisLobbyIndex(client), presence
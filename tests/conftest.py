@@ -0,0 +1,42 @@
+import os
+import sys
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the server runs against the in-memory stand-ins of local_backend, no credentials or network
+os.environ['BACKEND_MODE'] = 'local'
+
+import pytest
+
+
+@pytest.fixture
+def make_room():
+    from models import Room, User
+
+    def make_room(room_id, time_to_start=0.0, tags=(), teams=False, allow_spectators=True, users=(), room_size=4):
+        return Room(id=room_id, name=room_id, tags=list(tags), teams=teams, team_names=['A', 'B'] if teams else [],
+                    room_size=room_size, time_to_start=time_to_start, allow_spectators=allow_spectators,
+                    users_list={user_id: User(f'sid-{user_id}') for user_id in users}, spectators_list={},
+                    moderator=None, is_conversation=False, pictureId=None, user_reports={}, blacklist=[])
+    return make_room
+
+
+@pytest.fixture(scope='session')
+def server():
+    import server
+    return server
+
+
+@pytest.fixture
+def connect(server):
+    """Connect a Socket.IO test client, returns (client, sid)."""
+    clients = []
+
+    def connect():
+        client = server.socketio.test_client(server.app)
+        clients.append(client)
+        return client, server.socketio.server.manager.sid_from_eio_sid(client.eio_sid, '/')
+    yield connect
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
@@ -0,0 +1,93 @@
+import io
+import itertools
+
+import eventlet
+import pytest
+
+from images import LEGACY_IMAGE_NAME
+
+emails = (f'user{n}@example.com' for n in itertools.count())
+
+
+@pytest.fixture
+def http(server):
+    return server.app.test_client()
+
+
+def signup(http, username, email=None):
+    return http.post('/api/signup', json={'email': email or next(emails), 'password': 'secret123',
+                                          'name': username, 'username': username, 'tags': []})
+
+
+def test_signup_with_a_taken_username_is_a_conflict(http):
+    assert signup(http, 'dora').status_code == 200
+    response = signup(http, 'dora')
+    assert response.status_code == 409 and response.get_json() == {'username': 'Username already exists'}
+
+
+def test_rename_moves_the_reservation(http, server):
+    token = signup(http, 'erin').get_json()['token']
+    assert http.post('/api/update_user', json={'token': token, 'username': 'erin2', 'tags': []}).status_code == 200
+    assert http.get('/api/username_available?username=erin').get_json()['available']
+    assert signup(http, 'erin2').status_code == 409
+
+
+def test_taken_username_creates_no_account(http, server):
+    signup(http, 'fay')
+    accounts = len(server.auths.accounts)
+    assert signup(http, 'fay').status_code == 409
+    assert len(server.auths.accounts) == accounts
+
+
+def test_failed_account_creation_releases_the_username(http, server):
+    signup(http, 'gus', email='gus@example.com')
+    assert signup(http, 'gus2', email='gus@example.com').status_code == 500
+    assert http.get('/api/username_available?username=gus2').get_json()['available']
+
+
+def test_failed_rollback_does_not_hide_the_original_error(http, server, monkeypatch):
+    def unavailable(*args):
+        raise RuntimeError('firestore unavailable')
+    monkeypatch.setattr(server.profile_cache, 'set', unavailable)
+    monkeypatch.setattr(server.username_index, 'release', unavailable)
+    accounts = len(server.auths.accounts)
+    response = signup(http, 'hana')
+    assert response.status_code == 500 and 'email' in response.get_json()
+    # the account was still rolled back, only the username release failed
+    assert len(server.auths.accounts) == accounts
+
+
+def upload(http, token, data):
+    return http.post('/api/upload_image', data={'token': token, 'file': (io.BytesIO(data), 'photo.png')},
+                     content_type='multipart/form-data')
+
+
+def test_shared_images_are_deleted_with_their_last_user(http, server):
+    first, second = signup(http, 'ivan').get_json()['token'], signup(http, 'jade').get_json()['token']
+    url = upload(http, first, b'same photo').get_json()['profilePhotoURL']
+    assert upload(http, second, b'same photo').get_json()['profilePhotoURL'] == url
+    eventlet.sleep(0.2)
+    name = server.image_publisher.name_of(url)
+    assert http.post('/api/delete_user', json={'token': first}).status_code == 200
+    assert server.storage_bucket.get_blob(name) is not None
+    upload(http, second, b'another photo')
+    assert server.storage_bucket.get_blob(name) is None
+
+
+def test_legacy_photos_are_deleted_on_upload_and_on_account_deletion(http, server):
+    for username in ('kim', 'lou'):
+        token = signup(http, username).get_json()['token']
+        blob = server.storage_bucket.blob(LEGACY_IMAGE_NAME.format(username))
+        blob.upload_from_string(b'old photo')
+        server.profile_cache.update(server.verify_token(token)[0], {'image': blob.public_url})
+        if username == 'kim':
+            upload(http, token, b'new photo of kim')
+        else:
+            http.post('/api/delete_user', json={'token': token})
+        assert server.storage_bucket.get_blob(LEGACY_IMAGE_NAME.format(username)) is None
+
+
+def test_oversized_uploads_are_refused_before_reading(http, server):
+    token = signup(http, 'max').get_json()['token']
+    response = upload(http, token, b'x' * (server.IMAGE_MAX_BYTES + 128 * 1024))
+    assert response.status_code == 413 and 'error' in response.get_json()
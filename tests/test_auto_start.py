@@ -0,0 +1,37 @@
+import time
+
+import eventlet
+import pytest
+
+from store import InMemoryRoomStore
+
+
+@pytest.fixture
+def rooms(server, monkeypatch):
+    rooms = InMemoryRoomStore()
+    monkeypatch.setattr(server, 'rooms', rooms)
+    return rooms
+
+
+def test_room_with_debaters_starts_at_time_to_start(server, rooms, make_room):
+    server.add_room(make_room('starts', time_to_start=time.time() + 0.05, users=['alice']))
+    server.add_room(make_room('empty', time_to_start=time.time() + 0.05))
+    assert not rooms['starts'].is_conversation
+    eventlet.sleep(0.3)
+    assert rooms['starts'].is_conversation
+    assert not rooms['empty'].is_conversation
+    assert ('start', 'starts') not in server.scheduler
+    for room_id in list(rooms):
+        server.delete_room(room_id)
+
+
+def test_moving_time_to_start_moves_the_deadline(server, rooms, make_room):
+    room = make_room('later', time_to_start=time.time() + 0.05, users=['alice'])
+    server.add_room(room)
+    room.time_to_start = time.time() + 600
+    server.schedule_start(room)
+    eventlet.sleep(0.2)
+    assert not room.is_conversation
+    assert server.scheduler.deadline(('start', 'later')) == room.time_to_start
+    server.delete_room('later')
+    assert ('start', 'later') not in server.scheduler
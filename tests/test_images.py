@@ -0,0 +1,82 @@
+import io
+
+import pytest
+from PIL import Image
+
+from images import LEGACY_IMAGE_NAME, ImagePublisher, ImageTooLarge, content_hash
+from local_backend import MemoryBucket
+from outbound import direct_call
+
+
+def png(color, size=(400, 300)):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+@pytest.fixture
+def bucket():
+    return MemoryBucket('test-bucket')
+
+
+@pytest.fixture
+def publisher(bucket):
+    return ImagePublisher(bucket, direct_call, secret=b'secret')
+
+
+def publish_queued(publisher):
+    while publisher.queue.qsize():
+        name, stream, content_type = publisher.queue.get()
+        publisher.publish(name, stream, content_type)
+        stream.close()
+
+
+def test_upload_is_published_once_as_a_square_webp(publisher, bucket):
+    url = publisher.submit(io.BytesIO(png('red')), 'image/png')
+    assert publisher.submit(io.BytesIO(png('red')), 'image/png') == url
+    publish_queued(publisher)
+    blob = bucket.get_blob(publisher.name_of(url))
+    assert blob.content_type == 'image/webp'
+    assert Image.open(io.BytesIO(blob.data)).size == (256, 256)
+    assert publisher.token(blob.name) in blob.metadata['firebaseStorageDownloadTokens']
+    assert publisher.metrics()['published'] == 1 and publisher.metrics()['deduplicated'] == 1
+
+
+def test_urls_are_stable_across_publishers_with_the_same_secret(publisher, bucket):
+    url = publisher.submit(io.BytesIO(png('blue')), 'image/png')
+    publish_queued(publisher)
+    other = ImagePublisher(bucket, direct_call, secret=b'secret')
+    assert other.submit(io.BytesIO(png('blue')), 'image/png') == url
+    publish_queued(other)
+    assert other.metrics()['existing'] == 1 and other.metrics()['published'] == 0
+
+
+def test_unreadable_upload_is_published_as_is(publisher, bucket):
+    url = publisher.submit(io.BytesIO(b'not an image'), 'application/pdf')
+    publish_queued(publisher)
+    blob = bucket.get_blob(publisher.name_of(url))
+    assert blob.data == b'not an image' and blob.content_type == 'application/pdf'
+
+
+def test_content_hash_rewinds_and_enforces_the_size_limit():
+    stream = io.BytesIO(b'x' * 100)
+    assert content_hash(stream)[1] == 100 and stream.tell() == 0
+    with pytest.raises(ImageTooLarge):
+        content_hash(io.BytesIO(b'x' * 101), max_bytes=100)
+
+
+def test_only_own_urls_are_deleted(publisher, bucket):
+    url = publisher.submit(io.BytesIO(png('green')), 'image/png')
+    publish_queued(publisher)
+    assert publisher.name_of('https://example.com/o/images%2Fabc?alt=media&token=x') is None
+    assert publisher.name_of(url.replace('token=', 'token=x')) is None
+    assert publisher.delete(url) and bucket.blobs == {}
+    # deleted images are published again on the next upload
+    publisher.submit(io.BytesIO(png('green')), 'image/png')
+    assert publisher.queue.qsize() == 1
+
+
+def test_legacy_photos_are_deleted_by_username(publisher, bucket):
+    bucket.blob(LEGACY_IMAGE_NAME.format('alice')).upload_from_string(b'old photo')
+    assert publisher.delete_legacy('alice')
+    assert not publisher.delete_legacy('alice') and bucket.blobs == {}
@@ -0,0 +1,63 @@
+import os
+
+from journal import RoomJournal
+
+
+def journal(tmp_path):
+    return RoomJournal(str(tmp_path), flush_interval=0, snapshot_interval=3600)
+
+
+def test_recovers_the_latest_state_of_each_room(tmp_path, make_room):
+    first = journal(tmp_path)
+    first.recover()
+    room = make_room('r1')
+    first.record(room)
+    first.record(make_room('r2'))
+    first.flush()
+    room.name = 'renamed'
+    room.touch()
+    first.record(room)
+    first.record_delete('r2')
+    first.flush()
+    recovered = journal(tmp_path).recover()
+    assert list(recovered) == ['r1'] and recovered['r1'].name == 'renamed'
+
+
+def test_torn_last_line_is_dropped_and_the_next_journal_is_fresh(tmp_path, make_room):
+    first = journal(tmp_path)
+    first.recover()
+    first.record(make_room('r1'))
+    first.flush()
+    with open(first.path('journal', first.seq), 'a') as f:
+        f.write('{"put": {"id": "r2", "na')  # crashed mid write
+    second = journal(tmp_path)
+    assert list(second.recover()) == ['r1']
+    second.record(make_room('r3'))
+    second.flush()
+    assert second.seq == first.seq + 1
+    assert sorted(journal(tmp_path).recover()) == ['r1', 'r3']
+
+
+def test_snapshot_compacts_older_files(tmp_path, make_room):
+    first = journal(tmp_path)
+    first.recover()
+    rooms = {room_id: make_room(room_id) for room_id in ('r1', 'r2')}
+    for room in rooms.values():
+        first.record(room)
+    first.flush()
+    del rooms['r2']
+    first.record_delete('r2')
+    first.snapshot(rooms)
+    first.record(make_room('r4'))
+    first.flush()
+    assert sorted(os.listdir(tmp_path)) == [f'journal-{first.seq}.log', f'snapshot-{first.seq}.json']
+    assert sorted(journal(tmp_path).recover()) == ['r1', 'r4']
+
+
+def test_recovered_conversation_waits_for_its_debaters(make_room):
+    room = make_room('r1', users=['alice', 'bob'])
+    room.is_conversation = True
+    room.spectators_list['carol'] = room.users_list['alice']
+    room.disconnect_all()
+    assert room.users_list == {} and room.spectators_list == {}
+    assert room.disconnected == ['alice', 'bob'] and room.team_counts == [0, 0]
@@ -0,0 +1,60 @@
+import fakeredis
+import pytest
+
+from lobby import InvalidQuery, LobbyIndex
+from store import RedisLobbyIndex
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def index(request):
+    return LobbyIndex() if request.param == 'memory' else RedisLobbyIndex(fakeredis.FakeRedis())
+
+
+@pytest.fixture
+def rooms(index, make_room):
+    rooms = {}
+    for n in range(7):
+        room = make_room(f'r{n}', time_to_start=float(n), tags=['news'] if n % 2 else ['sport'],
+                         teams=n % 3 == 0, users=['u'] * (n == 5), room_size=1)
+        rooms[room.id] = room
+        index.add(room)
+    return rooms
+
+
+def walk(index, rooms, **filters):
+    ids, cursor = [], None
+    while True:
+        page, cursor = index.query(rooms, cursor=cursor, limit=2, **filters)
+        ids += [room.id for room in page]
+        if cursor is None:
+            return ids
+
+
+def test_pages_follow_time_to_start(index, rooms):
+    assert walk(index, rooms) == [f'r{n}' for n in range(7)]
+
+
+def test_filters(index, rooms):
+    assert walk(index, rooms, tag='news') == ['r1', 'r3', 'r5']
+    assert walk(index, rooms, teams=True) == ['r0', 'r3', 'r6']
+    assert walk(index, rooms, tag='news', not_full=True) == ['r1', 'r3']
+
+
+def test_removed_room_is_skipped(index, rooms):
+    index.remove('r1')
+    del rooms['r1']
+    assert walk(index, rooms, tag='news') == ['r3', 'r5']
+
+
+@pytest.mark.parametrize('filters', [
+    {'tag': ['news']},
+    {'tag': {'a': 1}},
+    {'teams': 'yes'},
+    {'allow_spectators': 1},
+    {'limit': 'ten'},
+    {'cursor': ['x']},
+    {'cursor': 'soon:r1'},
+])
+def test_malformed_queries_are_rejected(index, rooms, filters):
+    with pytest.raises(InvalidQuery):
+        index.query(rooms, **filters)
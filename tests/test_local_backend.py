@@ -0,0 +1,62 @@
+import pytest
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+from local_backend import MemoryFirestore
+
+
+@pytest.fixture
+def users():
+    users = MemoryFirestore().collection('users')
+    users.document('a').set({'username': 'alice', 'age': 30, 'tags': ['x', 'y'], 'settings': {'theme': 'dark'}})
+    users.document('b').set({'username': 'bob', 'age': 25, 'tags': []})
+    users.document('c').set({'username': 'carol'})
+    return users
+
+
+def ids(query):
+    return sorted(doc.id for doc in query.stream())
+
+
+@pytest.mark.parametrize('field, op, value, expected', [
+    ('username', '==', 'bob', ['b']),
+    ('age', '!=', 30, ['b']),  # carol has no age and matches nothing
+    ('age', '<', 30, ['b']),
+    ('age', '>=', 25, ['a', 'b']),
+    ('username', 'in', ['alice', 'carol'], ['a', 'c']),
+    ('username', 'not-in', ['alice'], ['b', 'c']),
+    ('tags', 'array-contains', 'y', ['a']),
+    ('tags', 'array-contains-any', ['x', 'z'], ['a']),
+    ('settings.theme', '==', 'dark', ['a']),
+    ('age', '>', 'a string', []),
+])
+def test_where_operators(users, field, op, value, expected):
+    assert ids(users.where(field, op, value)) == expected
+
+
+def test_unknown_operator_is_rejected_like_firestore(users):
+    with pytest.raises(ValueError):
+        users.where('age', '=>', 3)
+
+
+def test_filters_and_limit_combine(users):
+    assert ids(users.where('age', '>', 0).where('tags', '==', []).limit(5)) == ['b']
+    assert len(ids(users.limit(2))) == 2
+
+
+def test_update_of_a_missing_document_is_not_found(users):
+    with pytest.raises(NotFound):
+        users.document('nobody').update({'age': 1})
+    with pytest.raises(AlreadyExists):
+        users.document('a').create({})
+
+
+def test_update_with_a_field_path_changes_the_nested_value(users):
+    users.document('a').update({'settings.font': 'mono', 'age': 31})
+    assert users.document('a').get().to_dict()['settings'] == {'theme': 'dark', 'font': 'mono'}
+    assert users.document('a').get().get('settings.font') == 'mono'
+
+
+def test_snapshot_get_of_a_missing_field_raises_key_error(users):
+    with pytest.raises(KeyError):
+        users.document('c').get().get('age')
+    assert users.document('nobody').get().get('age') is None
@@ -0,0 +1,125 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from backends import IdentityToolkit
+from outbound import CircuitBreaker, CircuitOpen, Outbound
+from tokens import SigningKeysUnavailable, fetch_google_certs
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Answers with the queued (status, body) replies, then 200, and records every request."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.server.seen.append((self.path, body))
+        status, reply = self.server.replies.pop(0) if self.server.replies else (200, {'ok': True})
+        data = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.seen, server.replies = [], []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outbound(monkeypatch):
+    monkeypatch.setattr('outbound.BACKOFF_BASE', 0.001)
+    return Outbound(retries=2)
+
+
+def test_unsent_post_is_retried_but_a_failed_post_is_not(stand_in, outbound):
+    session = outbound.session('svc')
+    stand_in.replies = [(503, {}), (200, {'n': 1})]
+    assert session.post(f'{stand_in.url}/a', json={}).json() == {'n': 1}
+    stand_in.replies = [(500, {}), (200, {'n': 2})]
+    assert session.post(f'{stand_in.url}/b', json={}).status_code == 500
+    assert [path for path, _ in stand_in.seen] == ['/a', '/a', '/b']
+    assert outbound.metrics()['services']['svc']['retries'] == 1
+
+
+def test_idempotent_requests_are_retried_until_the_budget_runs_out(stand_in, outbound):
+    session = outbound.session('svc')
+    stand_in.replies = [(502, {})] * 3
+    assert session.get(f'{stand_in.url}/c').status_code == 502
+    assert len(stand_in.seen) == 3
+
+
+def test_breaker_opens_after_consecutive_failures_and_closes_after_a_trial():
+    now = [0.0]
+    breaker = CircuitBreaker(failures=2, reset_after=10, clock=lambda: now[0])
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'open' and not breaker.allow()
+    now[0] += 10
+    assert breaker.allow() and breaker.state == 'half_open'
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+
+
+def test_open_breaker_fails_calls_fast(stand_in, outbound):
+    outbound.service('svc')[0].failures = 1
+    session = outbound.session('svc')
+    stand_in.replies = [(500, {})]
+    session.post(f'{stand_in.url}/d', json={})
+    with pytest.raises(CircuitOpen):
+        session.post(f'{stand_in.url}/d', json={})
+    assert len(stand_in.seen) == 1
+    assert outbound.metrics()['services']['svc']['rejected'] == 1
+
+
+def test_identity_toolkit_posts_through_the_auth_service(stand_in, outbound):
+    auth = IdentityToolkit('api-key', outbound.session('auth'), base_url=stand_in.url)
+    stand_in.replies = [(200, {'idToken': 't', 'localId': 'u'})]
+    assert auth.create_user_with_email_and_password('a@b.c', 'pw') == {'idToken': 't', 'localId': 'u'}
+    assert stand_in.seen[0] == ('/accounts:signUp?key=api-key',
+                              {'email': 'a@b.c', 'password': 'pw', 'returnSecureToken': True})
+    auth.get_account_info('t')
+    assert stand_in.seen[1] == ('/accounts:lookup?key=api-key', {'idToken': 't'})
+    assert outbound.metrics()['services']['auth']['calls'] == 2
+
+
+def test_identity_toolkit_raises_pyrebase_style_errors(stand_in, outbound):
+    auth = IdentityToolkit('api-key', outbound.session('auth'), base_url=stand_in.url)
+    stand_in.replies = [(400, {'error': {'message': 'EMAIL_EXISTS'}})]
+    with pytest.raises(requests.HTTPError) as raised:
+        auth.create_user_with_email_and_password('a@b.c', 'pw')
+    assert 'EMAIL_EXISTS' in raised.value.args[1]
+    # a client error is the caller's fault, it doesn't count against the service
+    assert outbound.metrics()['services']['auth']['breaker'] == 'closed'
+
+
+def test_cert_fetch_failures_are_reported_as_unavailable_keys(stand_in, outbound, monkeypatch):
+    monkeypatch.setattr('tokens.GOOGLE_CERTS_URL', f'{stand_in.url}/certs')
+    outbound.service('certs')[0].failures = 3
+    session = outbound.session('certs')
+    stand_in.replies = [(503, {})] * 3
+    with pytest.raises(SigningKeysUnavailable):
+        fetch_google_certs(session)
+    assert len(stand_in.seen) == 3  # a GET is retried
+    with pytest.raises(SigningKeysUnavailable):
+        fetch_google_certs(session)  # the breaker is open now
+    assert len(stand_in.seen) == 3
+    assert outbound.metrics()['services']['certs']['rejected'] == 1
@@ -0,0 +1,99 @@
+import pytest
+
+from local_backend import MemoryFirestore
+from profiles import ProfileCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Calls:
+    """Counts the Firestore calls made through the cache."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, fn, *args, **kwargs):
+        self.count += 1
+        return fn(*args, **kwargs)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def calls():
+    return Calls()
+
+
+@pytest.fixture
+def db():
+    db = MemoryFirestore()
+    db.collection('users').document('alice').set({'username': 'alice', 'tags': ['a']})
+    db.collection('users').document('bob').set({'username': 'bob', 'tags': []})
+    return db
+
+
+@pytest.fixture
+def cache(db, clock, calls):
+    return ProfileCache(db.collection('users'), ttl=60, clock=clock, call=calls, db=db)
+
+
+def test_reads_go_to_firestore_once_until_the_ttl(cache, clock, calls):
+    assert cache.get('alice')['username'] == 'alice'
+    assert cache.get('alice')['username'] == 'alice'
+    assert calls.count == 1
+    clock.now += 61
+    cache.get('alice')
+    assert calls.count == 2
+    assert cache.metrics()['hits'] == 1 and cache.metrics()['misses'] == 2
+
+
+def test_missing_profiles_are_cached_too(cache, calls):
+    assert cache.get('nobody') is None and cache.get('nobody') is None
+    assert calls.count == 1
+
+
+def test_returned_profiles_are_copies(cache):
+    cache.get('alice')['username'] = 'mallory'
+    assert cache.get('alice')['username'] == 'alice'
+
+
+def test_writes_go_through_the_cache(cache, db, calls):
+    cache.get('alice')
+    cache.update('alice', {'tags': ['b']})
+    assert cache.get('alice')['tags'] == ['b']
+    cache.set('carol', {'username': 'carol'})
+    assert cache.get('carol') == {'username': 'carol'}
+    assert calls.count == 3  # the read of alice and the two writes
+    assert db.collection('users').document('alice').get().to_dict()['tags'] == ['b']
+
+
+def test_nested_updates_and_deletes_invalidate(cache, calls):
+    cache.get('alice')
+    cache.update('alice', {'settings.theme': 'dark'})
+    cache.get('alice')
+    cache.delete('alice')
+    assert cache.get('alice') is None
+    assert cache.metrics()['invalidations'] == 2 and calls.count == 5
+
+
+def test_get_many_reads_all_misses_at_once(cache, calls):
+    cache.get('alice')
+    profiles = cache.get_many(['alice', 'bob', 'nobody', 'bob'])
+    assert list(profiles) == ['alice', 'bob', 'nobody'] and profiles['nobody'] is None
+    assert calls.count == 2 and cache.metrics()['batch_reads'] == 1
+    cache.get_many(['bob', 'nobody'])
+    assert calls.count == 2
+
+
+def test_referenced_asks_firestore(cache):
+    assert cache.referenced('username', 'bob')
+    assert not cache.referenced('username', 'carol')
@@ -0,0 +1,41 @@
+import fakeredis
+import pytest
+
+from sharding import RoomDirectory
+from store import InMemoryRoomStore
+
+
+@pytest.fixture
+def http(server, monkeypatch):
+    monkeypatch.setattr(server, 'rooms', InMemoryRoomStore())
+    server.profile_cache.set('p1', {'username': 'pia', 'tags': []})
+    server.profile_cache.set('p2', {'username': 'pat', 'tags': []})
+    return server.app.test_client()
+
+
+def test_profiles_of_listed_users(http):
+    profiles = http.get('/api/profiles?userIds=p1,p2,nobody').get_json()['profiles']
+    assert profiles['p1']['username'] == 'pia' and profiles['p2']['username'] == 'pat'
+    assert profiles['nobody'] is None
+
+
+def test_bad_requests(http, server):
+    assert http.get('/api/profiles').status_code == 400
+    too_many = ','.join(f'u{n}' for n in range(server.PROFILES_BATCH_MAX + 1))
+    assert http.get(f'/api/profiles?userIds={too_many}').status_code == 400
+    assert http.get('/api/profiles?roomId=nowhere').status_code == 404
+
+
+def test_profiles_of_a_room_are_capped(http, server, make_room, monkeypatch):
+    monkeypatch.setattr(server, 'PROFILES_BATCH_MAX', 2)
+    room = make_room('r1', users=['p1', 'p2', 'p3'])
+    room.moderator = 'p1'
+    server.rooms['r1'] = room
+    assert list(http.get('/api/profiles?roomId=r1').get_json()['profiles']) == ['p1', 'p2']
+
+
+def test_room_owned_by_another_worker_is_read_from_the_directory(http, server, make_room, monkeypatch):
+    directory = RoomDirectory(fakeredis.FakeRedis())
+    monkeypatch.setattr(server, 'lobby_rooms', directory)
+    directory.publish([make_room('elsewhere', users=['p2'])], [])
+    assert list(http.get('/api/profiles?roomId=elsewhere').get_json()['profiles']) == ['p2']
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from reaper import RoomReaper
+from scheduler import DeadlineScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def expired():
+    return {'rooms': [], 'disconnected': []}
+
+
+@pytest.fixture
+def reaper(clock, expired):
+    scheduler = DeadlineScheduler(clock=clock)
+
+    def expire_room(room_id):
+        expired['rooms'].append(room_id)
+        return True
+
+    def expire_disconnected(room_id, user_id):
+        expired['disconnected'].append((room_id, user_id))
+        return True
+    return RoomReaper(scheduler, expire_room, expire_disconnected, start_grace=100, abandoned_ttl=50,
+                      disconnected_ttl=30)
+
+
+def test_empty_room_expires_after_its_start_grace(reaper, clock, expired, make_room):
+    room = make_room('r1', time_to_start=clock.now + 10)
+    reaper.room_changed(room)
+    assert reaper.scheduler.deadline(('expire', 'r1')) == room.time_to_start + 100
+    clock.now += 109
+    reaper.scheduler.run_due()
+    assert expired['rooms'] == []
+    clock.now += 2
+    reaper.scheduler.run_due()
+    assert expired['rooms'] == ['r1'] and reaper.metrics()['expired_rooms'] == 1
+
+
+def test_room_in_use_has_no_deadline_and_a_countdown_is_not_extended(reaper, clock, make_room):
+    room = make_room('r1', time_to_start=clock.now, users=['alice'])
+    reaper.room_changed(room)
+    assert ('expire', 'r1') not in reaper.scheduler
+    room.pop_user('alice')
+    room.is_conversation = True
+    reaper.room_changed(room)
+    deadline = reaper.scheduler.deadline(('expire', 'r1'))
+    assert deadline == pytest.approx(time.time() + 50, abs=1)
+    room.spectators_list['bob'] = None
+    reaper.room_changed(room)  # spectators alone don't keep a conversation alive
+    assert reaper.scheduler.deadline(('expire', 'r1')) == deadline
+
+
+def test_disconnected_debater_expires_unless_they_return(reaper, clock, expired, make_room):
+    reaper.user_disconnected('r1', 'alice')
+    reaper.user_disconnected('r1', 'bob')
+    reaper.user_returned('r1', 'bob')
+    clock.now = time.time() + 31
+    reaper.scheduler.run_due()
+    assert expired['disconnected'] == [('r1', 'alice')]
+
+
+def test_deleted_room_drops_all_its_deadlines(reaper, make_room):
+    room = make_room('r1')
+    room.disconnected.append('alice')
+    reaper.room_restored(room)
+    assert len(reaper.scheduler) == 2
+    reaper.room_deleted(room)
+    assert len(reaper.scheduler) == 0
@@ -0,0 +1,73 @@
+import math
+import random
+
+import pytest
+
+from relay_tree import ROOT, RelayTree
+
+
+def check_invariants(tree):
+    for node, children in tree.children.items():
+        assert len(children) <= tree.capacity(node)
+        for child in children:
+            assert tree.parent[child] == node
+            assert tree.depth[child] == tree.depth[node] + 1
+    for user_id, parent in tree.parent.items():
+        assert user_id in tree.children[parent]
+
+
+def churn(tree, audience, seed, leave_rate=0.3):
+    rng = random.Random(seed)
+    members = []
+    changes = messages = 0
+    while len(members) < audience:
+        changes += 1
+        if members and rng.random() < leave_rate:
+            messages += len(tree.remove(members.pop(rng.randrange(len(members)))))
+        else:
+            members.append(changes)
+            messages += len(tree.add(changes))
+        check_invariants(tree)
+    return members, messages / changes
+
+
+@pytest.mark.parametrize('audience', [10, 100, 1000])
+def test_upload_per_peer_stays_bounded_under_churn(audience):
+    tree = RelayTree(fanout=3, root_fanout=4)
+    members, _ = churn(tree, audience, seed=audience)
+    assert len(tree) == len(members)
+    assert max(len(children) for node, children in tree.children.items() if node is not ROOT) <= 3
+    assert len(tree.children[ROOT]) <= 4
+    assert tree.metrics()['max_upload'] <= 4
+
+
+@pytest.mark.parametrize('audience', [100, 1000])
+def test_depth_and_signaling_grow_slowly(audience):
+    tree = RelayTree(fanout=3, root_fanout=4)
+    _, assignments_per_change = churn(tree, audience, seed=7)
+    assert tree.max_depth() <= math.ceil(math.log(audience, 3)) + 2
+    assert assignments_per_change < 2
+
+
+def test_remove_moves_the_deepest_spectator_into_the_hole():
+    tree = RelayTree(fanout=2, root_fanout=1)
+    for user_id in range(7):
+        tree.add(user_id)
+    leaving = next(iter(tree.children[ROOT]))
+    parent, orphans = ROOT, tree.children_of(leaving)
+    deepest = set(tree.by_depth[tree.max_depth()])
+    assignments = tree.remove(leaving)
+    replacement, new_parent = assignments[0]
+    assert new_parent == parent and replacement in deepest
+    assert sorted(assignments[1:]) == sorted((orphan, replacement) for orphan in orphans - {replacement})
+    assert leaving not in tree and tree.parent[replacement] == parent
+    check_invariants(tree)
+
+
+def test_leaf_leaving_moves_nobody():
+    tree = RelayTree()
+    tree.add('a')
+    tree.add('b')
+    assert tree.remove('b') == []
+    assert tree.remove('missing') == []
+    assert tree.add('a') == []
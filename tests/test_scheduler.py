@@ -0,0 +1,85 @@
+import time
+
+import eventlet
+
+from scheduler import DeadlineScheduler
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_callbacks_run_in_deadline_order_once_due():
+    clock = Clock()
+    scheduler = DeadlineScheduler(clock=clock)
+    fired = []
+    for key, deadline in (('c', 1030), ('a', 1010), ('b', 1020)):
+        scheduler.schedule(key, deadline, lambda key=key: fired.append(key))
+    assert scheduler.run_due() == 10
+    clock.now = 1025
+    assert scheduler.run_due() == 5 and fired == ['a', 'b']
+    clock.now = 1030
+    assert scheduler.run_due() is None and fired == ['a', 'b', 'c']
+    assert len(scheduler) == 0 and scheduler.metrics()['fired'] == 3
+
+
+def test_rescheduling_replaces_and_cancel_drops():
+    clock = Clock()
+    scheduler = DeadlineScheduler(clock=clock)
+    fired = []
+    scheduler.schedule('a', 1010, lambda: fired.append('first'))
+    scheduler.schedule('a', 1005, lambda: fired.append('second'))
+    scheduler.schedule('b', 1001, lambda: fired.append('b'))
+    scheduler.cancel('b')
+    scheduler.cancel('missing')
+    assert scheduler.deadline('a') == 1005 and 'b' not in scheduler
+    clock.now = 1100
+    scheduler.run_due()
+    assert fired == ['second']
+    assert scheduler.metrics()['cancelled'] == 1
+
+
+def test_cancelled_entries_do_not_pile_up_in_the_heap():
+    scheduler = DeadlineScheduler(clock=Clock())
+    for n in range(1000):
+        scheduler.schedule(n, 2000 + n, lambda: None)
+    for n in range(990):
+        scheduler.cancel(n)
+    assert len(scheduler) == 10 and len(scheduler.heap) < 200
+
+
+def test_a_failing_callback_does_not_stop_the_others():
+    clock = Clock()
+    scheduler = DeadlineScheduler(clock=clock)
+    fired = []
+    scheduler.schedule('bad', 1001, lambda: 1 / 0)
+    scheduler.schedule('good', 1002, lambda: fired.append('good'))
+    clock.now = 1002
+    scheduler.run_due()
+    assert fired == ['good'] and scheduler.metrics()['errors'] == 1
+
+
+def test_runner_wakes_up_for_an_earlier_deadline():
+    scheduler = DeadlineScheduler()
+    fired = []
+    runner = eventlet.spawn(scheduler.run)
+    try:
+        scheduler.schedule('late', time.time() + 60, lambda: fired.append('late'))
+        eventlet.sleep(0.01)  # the runner now sleeps towards the late deadline
+        scheduler.schedule('soon', time.time() + 0.02, lambda: fired.append('soon'))
+        eventlet.sleep(0.2)
+        assert fired == ['soon']
+    finally:
+        runner.kill()
+
+
+def test_bot_rooms_keep_one_deadline_each(server):
+    server.bot_room_manager.add_room('bot-room')
+    deadline = server.scheduler.deadline(('bot', 'bot-room'))
+    assert deadline is not None and deadline > time.time()
+    server.bot_room_manager.remove_room('bot-room')
+    assert ('bot', 'bot-room') not in server.scheduler
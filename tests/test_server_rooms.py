@@ -0,0 +1,40 @@
+import fakeredis
+import pytest
+
+from presence import DEBATER
+from store import RedisRoomStore
+
+
+@pytest.fixture
+def shared_rooms(server, monkeypatch):
+    store = RedisRoomStore(fakeredis.FakeRedis())
+    monkeypatch.setattr(server, 'rooms', store)
+    return store
+
+
+def test_disconnect_is_retried_after_a_conflict(server, connect, shared_rooms, make_room, monkeypatch):
+    client, sid = connect()
+    shared_rooms['r1'] = make_room('r1', users=['alice', 'bob'])
+    server.socket_to_room[sid] = 'r1'
+    server.socket_to_user[sid] = 'alice'
+    server.presence.set('alice', 'r1', DEBATER, sid)
+
+    save = shared_rooms.save
+    saves = []
+
+    def save_after_another_worker(room):
+        if not saves:
+            other = shared_rooms['r1']
+            other.name = 'changed elsewhere'
+            other.touch()
+            save(other)
+        saves.append(room.version)
+        save(room)
+    monkeypatch.setattr(shared_rooms, 'save', save_after_another_worker)
+
+    client.disconnect()
+    room = shared_rooms['r1']
+    assert len(saves) == 2
+    assert list(room.users_list) == ['bob'] and room.name == 'changed elsewhere'
+    assert server.presence.get('alice') is None
+    assert sid not in server.socket_to_room and sid not in server.socket_to_user
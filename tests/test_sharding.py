@@ -0,0 +1,81 @@
+import fakeredis
+import pytest
+
+from relay_tree import RelayTree
+from sharding import HashRing, RoomDirectory, WorkerRegistry
+from store import InMemoryRoomStore
+
+ROOM_IDS = [f'room-{n}' for n in range(2000)]
+
+
+def test_ring_spreads_rooms_and_moves_few_when_a_worker_joins():
+    ring = HashRing(['w1', 'w2', 'w3'])
+    before = {room_id: ring.owner(room_id) for room_id in ROOM_IDS}
+    counts = [list(before.values()).count(worker) for worker in ('w1', 'w2', 'w3')]
+    assert min(counts) > len(ROOM_IDS) / 3 * 0.6
+    ring.add('w4')
+    moved = [room_id for room_id in ROOM_IDS if ring.owner(room_id) != before[room_id]]
+    # only rooms taken over by the new worker move, about a quarter of them
+    assert all(ring.owner(room_id) == 'w4' for room_id in moved)
+    assert len(ROOM_IDS) * 0.15 < len(moved) < len(ROOM_IDS) * 0.35
+    ring.remove('w4')
+    assert {room_id: ring.owner(room_id) for room_id in ROOM_IDS} == before
+
+
+def test_ring_does_not_depend_on_the_order_of_workers():
+    assert all(HashRing(['a', 'b', 'c']).owner(room_id) == HashRing(['c', 'a', 'b']).owner(room_id)
+               for room_id in ROOM_IDS[:200])
+    assert HashRing().owner('room-1') is None
+
+
+def test_directory_lists_published_rooms_and_hands_off_once(make_room):
+    directory = RoomDirectory(fakeredis.FakeRedis())
+    directory.publish([make_room('r1'), make_room('r2')], [])
+    directory.publish([], ['r2'])
+    assert list(directory) == ['r1'] and directory['r1'].name == 'r1'
+    directory.hand_off(make_room('r3'), 'w2')
+    assert [room.id for room in directory.take_handoffs('w2')] == ['r3']
+    assert directory.take_handoffs('w2') == []
+
+
+@pytest.fixture
+def sharded(server, monkeypatch):
+    client = fakeredis.FakeRedis()
+    registry = WorkerRegistry(client, 'w1', 'http://w1', on_tick=None)
+    registry.urls = {'w1': 'http://w1', 'w2': 'http://w2'}
+    monkeypatch.setattr(server, 'SHARD_WORKER_ID', 'w1')
+    monkeypatch.setattr(server, 'shard_registry', registry)
+    monkeypatch.setattr(server, 'rooms', InMemoryRoomStore())
+    monkeypatch.setattr(server, 'lobby_rooms', RoomDirectory(client))
+    return registry
+
+
+def test_rebalance_releases_the_state_of_handed_off_rooms(server, connect, sharded, make_room):
+    ring = HashRing(['w1', 'w2'])
+    moving = next(room_id for room_id in ROOM_IDS if ring.owner(room_id) == 'w2')
+    staying = next(room_id for room_id in ROOM_IDS if ring.owner(room_id) == 'w1')
+    client, sid = connect()
+    for room_id in (moving, staying):
+        room = make_room(room_id, time_to_start=server.time.time() + 600, users=['alice'])
+        room.disconnected.append('carol')
+        server.add_room(room)
+        server.room_reaper.user_disconnected(room_id, 'carol')
+        server.relay_trees[room_id] = RelayTree()
+        server.relay_trees[room_id].add('bob')
+    server.socket_to_room[sid] = moving
+    server.socketio.server.enter_room(sid, moving, '/')
+
+    server.rebalance_shard(ring, True)
+
+    assert list(server.rooms) == [staying]
+    for key in (('start', moving), ('expire', moving), ('disconnected', moving, 'carol')):
+        assert key not in server.scheduler
+    assert ('start', staying) in server.scheduler and ('disconnected', staying, 'carol') in server.scheduler
+    assert moving not in server.relay_trees and staying in server.relay_trees
+    assert sid not in server.socket_to_room
+    assert {'name': 'room_redirect', 'args': [{'roomId': moving, 'url': 'http://w2'}], 'namespace': '/'} \
+        in client.get_received()
+    assert [room.id for room in server.lobby_rooms.take_handoffs('w2')] == [moving]
+
+    server.delete_room(staying)
+    assert ('start', staying) not in server.scheduler and staying not in server.relay_trees
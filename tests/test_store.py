@@ -0,0 +1,41 @@
+import fakeredis
+import pytest
+
+from store import RedisRoomStore, RoomConflict
+
+
+@pytest.fixture
+def store():
+    return RedisRoomStore(fakeredis.FakeRedis())
+
+
+def test_save_bumps_the_stored_version(store, make_room):
+    store['r1'] = make_room('r1')
+    room = store['r1']
+    room.name = 'renamed'
+    room.touch()
+    store.save(room)
+    assert store['r1'].name == 'renamed' and store['r1'].version == 1
+
+
+def test_stale_save_is_a_conflict(store, make_room):
+    store['r1'] = make_room('r1')
+    mine, theirs = store['r1'], store['r1']
+    theirs.touch()
+    store.save(theirs)
+    mine.name = 'stale'
+    mine.touch()
+    with pytest.raises(RoomConflict):
+        store.save(mine)
+    assert store['r1'].name == 'r1'
+
+
+def test_save_after_a_delete_does_not_recreate_the_room(store, make_room):
+    store['r1'] = make_room('r1')
+    room = store['r1']
+    del store['r1']
+    room.touch()
+    with pytest.raises(RoomConflict):
+        store.save(room)
+    assert 'r1' not in store and list(store) == []
+    assert not store.client.exists(store.room_key('r1'))
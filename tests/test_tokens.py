@@ -0,0 +1,108 @@
+import jwt
+import pytest
+
+from local_backend import MemoryAuth
+from tokens import InvalidToken, SigningKeysUnavailable, TokenVerifier
+
+PROJECT = 'debate-center-test'
+
+
+class Clock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def auth(clock):
+    auth = MemoryAuth(PROJECT, clock=clock)
+    auth.create_user_with_email_and_password('alice@example.com', 'secret')
+    return auth
+
+
+@pytest.fixture
+def verifier(auth, clock):
+    return TokenVerifier(PROJECT, fetch_keys=auth.signing_keys, clock=clock)
+
+
+def sign(auth, clock, **overrides):
+    now = int(clock())
+    claims = {'iss': f'https://securetoken.google.com/{PROJECT}', 'aud': PROJECT, 'sub': 'user-1',
+              'iat': now, 'exp': now + 3600, 'auth_time': now}
+    claims.update(overrides)
+    return jwt.encode(claims, auth.key, algorithm='RS256', headers={'kid': 'local'})
+
+
+def test_valid_token_is_verified_once_then_cached(auth, verifier):
+    token = auth.sign_in_with_email_and_password('alice@example.com', 'secret')['idToken']
+    claims = verifier.verify(token)
+    assert claims['email'] == 'alice@example.com'
+    assert verifier.verify(token) is claims
+    assert verifier.metrics()['hits'] == 1 and verifier.metrics()['misses'] == 1
+
+
+def test_expiry_follows_the_injected_clock(auth, verifier, clock):
+    token = auth.sign_in_with_email_and_password('alice@example.com', 'secret')['idToken']
+    verifier.verify(token)
+    clock.now += 3601
+    with pytest.raises(InvalidToken, match='expired'):
+        verifier.verify(token)
+    # a verifier that never saw the token rejects it too, on a cache miss
+    fresh = TokenVerifier(PROJECT, fetch_keys=auth.signing_keys, clock=clock)
+    with pytest.raises(InvalidToken, match='expired'):
+        fresh.verify(token)
+
+
+def test_token_from_the_future_is_rejected(auth, verifier, clock):
+    with pytest.raises(InvalidToken):
+        verifier.verify(sign(auth, clock, iat=int(clock()) + 600))
+    with pytest.raises(InvalidToken):
+        verifier.verify(sign(auth, clock, auth_time=int(clock()) + 600))
+
+
+@pytest.mark.parametrize('overrides', [
+    {'aud': 'another-project'},
+    {'iss': 'https://securetoken.google.com/another-project'},
+    {'sub': ''},
+])
+def test_wrong_claims_are_rejected(auth, verifier, clock, overrides):
+    with pytest.raises(InvalidToken):
+        verifier.verify(sign(auth, clock, **overrides))
+    assert verifier.metrics()['invalid'] == 1
+
+
+def test_missing_or_forged_tokens_are_rejected(auth, verifier, clock):
+    with pytest.raises(InvalidToken):
+        verifier.verify('')
+    with pytest.raises(InvalidToken):
+        verifier.verify('not.a.token')
+    forged = jwt.encode({'sub': 'user-1'}, MemoryAuth(PROJECT).key, algorithm='RS256', headers={'kid': 'local'})
+    with pytest.raises(InvalidToken):
+        verifier.verify(forged)
+
+
+def test_keys_are_refreshed_when_they_expire_and_on_unknown_kid(auth, verifier, clock):
+    verifier.verify(sign(auth, clock))
+    assert verifier.metrics()['key_refreshes'] == 1
+    clock.now += 120
+    with pytest.raises(InvalidToken, match='unknown key id'):
+        verifier.verify(jwt.encode({'sub': 'x'}, auth.key, algorithm='RS256', headers={'kid': 'rotated'}))
+    assert verifier.metrics()['key_refreshes'] == 2
+    clock.now += 3600
+    verifier.verify(sign(auth, clock))
+    assert verifier.metrics()['key_refreshes'] == 3
+
+
+def test_unavailable_keys_are_not_reported_as_an_invalid_token(auth, clock):
+    def unavailable():
+        raise SigningKeysUnavailable('no network')
+    verifier = TokenVerifier(PROJECT, fetch_keys=unavailable, clock=clock)
+    with pytest.raises(SigningKeysUnavailable):
+        verifier.verify(sign(auth, clock))
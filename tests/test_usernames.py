@@ -0,0 +1,71 @@
+import pytest
+
+from local_backend import MemoryFirestore
+from usernames import BloomFilter, UsernameIndex
+
+
+@pytest.fixture
+def db():
+    db = MemoryFirestore()
+    db.collection('users').document('u1').set({'username': 'alice'})
+    db.collection('users').document('u2').set({'tags': []})  # an account without a username
+    return db
+
+
+@pytest.fixture
+def index(db):
+    index = UsernameIndex(db, capacity=1000)
+    index.warm()
+    return index
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(1000, 0.01)
+    for n in range(1000):
+        bloom.add(f'user{n}')
+    assert all(f'user{n}' in bloom for n in range(1000))
+    false_positives = sum(f'other{n}' in bloom for n in range(10000))
+    assert false_positives < 300
+
+
+def test_warm_indexes_existing_accounts(index):
+    assert index.exists('alice')
+    assert not index.exists('bob')
+    assert index.metrics()['filter_negatives'] == 1 and index.metrics()['indexed'] == 1
+
+
+def test_reserve_is_exclusive_until_released(index):
+    assert index.reserve('bob')
+    assert index.exists('bob')
+    assert not index.reserve('bob') and not index.reserve('alice')
+    index.release('bob')
+    assert not index.exists('bob')  # still in the filter, confirmed as free
+    assert index.metrics()['false_positives'] == 1
+    assert index.reserve('bob')
+
+
+def test_reservation_made_elsewhere_is_never_handed_out_twice(db, index):
+    other_worker = UsernameIndex(db, capacity=1000)
+    other_worker.warm()
+    assert other_worker.reserve('carol')
+    # this worker's filter hasn't seen carol, the reservation document still decides
+    assert not index.exists('carol')
+    assert not index.reserve('carol')
+    assert index.metrics()['conflicts'] == 1
+
+
+def test_lookups_are_confirmed_before_warm(db):
+    index = UsernameIndex(db, capacity=1000)
+    assert index.exists('alice') and not index.exists('bob')
+    assert index.metrics()['confirmed'] == 2
+
+
+def test_warm_reads_go_through_the_call_runner(db):
+    calls = []
+
+    def call(fn, *args, **kwargs):
+        calls.append(kwargs.get('timeout'))
+        return fn(*args, **kwargs)
+    index = UsernameIndex(db, capacity=1000, call=call)
+    index.warm()
+    assert len(calls) == 2 and all(calls)
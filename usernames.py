@@ -0,0 +1,122 @@
+import hashlib
+import math
+import os
+import time
+
+from google.api_core.exceptions import AlreadyExists
+
+from outbound import direct_call, threading
+
+USERNAME_INDEX_CAPACITY = int(os.environ.get('USERNAME_INDEX_CAPACITY', 1000000))  # usernames before the error rate degrades
+USERNAME_INDEX_ERROR_RATE = float(os.environ.get('USERNAME_INDEX_ERROR_RATE', 0.01))
+USERNAME_WARM_TIMEOUT = float(os.environ.get('USERNAME_WARM_TIMEOUT', 300))  # seconds, deadline of each warm() read
+
+
+class BloomFilter:
+    """Set membership with false positives but no false negatives, in a few bits per item."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))  # bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # double hashing, k positions out of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item) -> None:
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+def first(query, timeout=None):
+    return next(iter(query.stream(timeout=timeout)), None)
+
+
+def stream_all(query, timeout=None):
+    return list(query.stream(timeout=timeout))
+
+
+class UsernameIndex:
+    """Answers "is this username taken" mostly in process, and reserves usernames atomically.
+
+    A bloom filter over every known username answers most negative lookups
+    without Firestore. A positive is confirmed against the usernames/<name>
+    reservation document and, for accounts older than reservations, the users
+    collection. Until warm() finished every lookup is confirmed. reserve()
+    creates usernames/<name>, which fails for everyone but the first of two
+    concurrent signups. Deleted usernames stay in the filter and are just
+    confirmed as free.
+
+    The filter is per worker and only learns the names reserved through this
+    worker, so exists() is eventually consistent: a name another worker
+    reserved since warm() may be reported free. reserve() never hands out a
+    taken name, the create of the reservation document is what decides.
+    """
+
+    def __init__(self, db, capacity=USERNAME_INDEX_CAPACITY, error_rate=USERNAME_INDEX_ERROR_RATE, call=direct_call):
+        self.call = call  # see outbound.direct_call
+        self.users = db.collection('users')
+        self.reservations = db.collection('usernames')
+        self.filter = BloomFilter(capacity, error_rate)
+        self.lock = threading.Lock()  # guards filter updates
+        self.warmed = False
+        self.stats = {'filter_negatives': 0, 'confirmed': 0, 'false_positives': 0, 'reserved': 0, 'conflicts': 0,
+                      'warm_ms': 0.0}
+
+    def warm(self) -> None:
+        started = time.time()
+        users = self.call(stream_all, self.users.select(['username']), timeout=USERNAME_WARM_TIMEOUT)
+        for doc in users:
+            # a real DocumentSnapshot.get raises KeyError on a missing field
+            username = (doc.to_dict() or {}).get('username')
+            if username:
+                self.add(username)
+        for doc in self.call(stream_all, self.reservations.select([]), timeout=USERNAME_WARM_TIMEOUT):
+            self.add(doc.id)
+        self.warmed = True
+        self.stats['warm_ms'] = (time.time() - started) * 1000
+        print(f"usernames: indexed {self.filter.count} usernames in {self.stats['warm_ms']:.1f} ms")
+
+    def add(self, username) -> None:
+        with self.lock:
+            self.filter.add(username)
+
+    def exists(self, username) -> bool:
+        if self.warmed and username not in self.filter:
+            self.stats['filter_negatives'] += 1
+            return False
+        self.stats['confirmed'] += 1
+        taken = (self.call(self.reservations.document(username).get).exists
+                 or self.call(first, self.users.where('username', '==', username).limit(1)) is not None)
+        if not taken and self.warmed:
+            self.stats['false_positives'] += 1
+        return taken
+
+    def reserve(self, username) -> bool:
+        """Claim username, False if it is taken."""
+        if self.exists(username):
+            self.stats['conflicts'] += 1
+            return False
+        try:
+            self.call(self.reservations.document(username).create, {'reserved_at': time.time()})
+        except AlreadyExists:
+            # another signup got it between the check and the create
+            self.stats['conflicts'] += 1
+            return False
+        self.add(username)
+        self.stats['reserved'] += 1
+        return True
+
+    def release(self, username) -> None:
+        self.call(self.reservations.document(username).delete)
+
+    def metrics(self) -> dict:
+        return dict(self.stats, indexed=self.filter.count, warmed=self.warmed)
@@ -0,0 +1,72 @@
+import msgpack
+from cachetools import TTLCache
+
+MSGPACK = 'msgpack'  # client capability, see the client_capabilities event
+
+
+def binary_room(room) -> str:
+    # clients in msgpack mode sit in this parallel Socket.IO room instead of room
+    return f'{room}#msgpack'
+
+
+def encode(payload) -> bytes:
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+class ClientCapabilities:
+    """sid -> capabilities of every connected client, visible to all workers when shared.
+
+    Sockets of this worker are answered from memory. With a shared map (a
+    store.RedisHash) the capabilities of sockets on other workers are looked up
+    there, so emits to them pick the right encoding, and kept for a while since
+    a client only announces them once.
+    """
+
+    def __init__(self, shared=None, remote_ttl=60):
+        self.local = {}  # sid -> set of capability names
+        self.holders = {}  # capability -> local sids that have it
+        self.shared = shared  # sid -> comma separated names, or None when there is one worker
+        self.remote = TTLCache(maxsize=10000, ttl=remote_ttl)
+
+    def set(self, sid, capabilities) -> None:
+        self.forget_local(sid)
+        self.local[sid] = set(capabilities)
+        for capability in self.local[sid]:
+            self.holders.setdefault(capability, set()).add(sid)
+        if self.shared is not None:
+            self.shared[sid] = ','.join(sorted(self.local[sid]))
+
+    def forget(self, sid) -> None:
+        if self.forget_local(sid) and self.shared is not None:
+            self.shared.pop(sid, None)
+
+    def forget_local(self, sid) -> bool:
+        capabilities = self.local.pop(sid, None)
+        for capability in capabilities or ():
+            self.holders[capability].discard(sid)
+            if not self.holders[capability]:
+                del self.holders[capability]
+        return capabilities is not None
+
+    def get(self, sid):
+        if sid in self.local:
+            return self.local[sid]
+        if self.shared is None:
+            return set()
+        if sid not in self.remote:
+            self.remote[sid] = set(filter(None, (self.shared.get(sid) or '').split(',')))
+        return self.remote[sid]
+
+    def has(self, sid, capability) -> bool:
+        return capability in self.get(sid)
+
+    def any_local(self, capability) -> bool:
+        return capability in self.holders
+
+
+def create_client_capabilities(url=None) -> ClientCapabilities:
+    if not url:
+        return ClientCapabilities()
+    import redis
+    from store import RedisHash
+    return ClientCapabilities(RedisHash(redis.Redis.from_url(url), 'debate:capabilities', str, bytes.decode))